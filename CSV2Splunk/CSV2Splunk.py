@@ -12,7 +12,17 @@
 # MERCHANTABILITY, OR FITNESS FOR A PARTICULAR PURPOSE. You are solely responsible
 # for determining the appropriateness of using or redistributing the Work and assume 
 # any risks associated with your exercise of permissions under this License.
-import csv, json, logging.handlers, sys, argparse, getpass
+import csv, json, logging.handlers, sys, argparse, bz2, getpass, gzip, hashlib, lzma, math, multiprocessing, os, \
+    queue, re, sqlite3, tempfile, threading, time, tracemalloc, urllib.parse, uuid, zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, ALL_COMPLETED, FIRST_COMPLETED
+from functools import partial
+from itertools import chain, islice
+
+# resource is only available on unix platforms.  Peak memory is not reported elsewhere.
+try:
+    import resource
+except ImportError:
+    resource = None
 
 
 # Define logging
@@ -38,18 +48,74 @@ def log_print(log_type, message):
         logging.warning(message)
     elif log_type.lower() == 'debug':
         logging.debug(message)
-    print(log_type.upper() + ': ' + message)
+    # One write per line so messages from the upload workers do not run together.
+    sys.stdout.write(log_type.upper() + ': ' + message + '\n')
 
 
 # import requests error handling
 try:
     import requests
+    from requests.adapters import HTTPAdapter
     from requests.auth import HTTPBasicAuth
 except ImportError:
     log_print('error', 'Add the requests repository to your PYTHONPATH to run the this command:\n'
                        'python -m pip install requests')
     sys.exit()
 
+# pyyaml is only needed for yaml manifests, json manifests work without it.
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+# responses that mean the request was too large for the search head, so the batch is split and sent again.  splunkd
+# also answers 400 for some searches over its limits, which is only split when the message says it was too large.
+SPLIT_STATUS_CODES = (413, 414)
+SPLIT_MESSAGE_PATTERN = re.compile(r'too (large|long|big)|exceed', re.IGNORECASE)
+
+# encoding and null handling pairs compared by the benchmark.  The columnar encoding always rebuilds nulls in one eval.
+BENCHMARK_VARIANTS = (('json', 'foreach'), ('json', 'client'), ('columnar', 'foreach'))
+
+# Delta uploads.  Key values are joined with the same separator on both sides before they are hashed with md5.
+DELTA_KEY_SEPARATOR = '\u241f'
+DELTA_HASH_MODULUS = 2 ** 64
+DELTA_DELETE_BATCH = 10000
+
+# bytes read from the start and end of the source file to tell if it changed before resuming.
+FINGERPRINT_BYTES = 1024 * 1024
+
+# HTTP Event Collector defaults.  Batches are kept under the 1 MB max_content_length of older splunk versions, a
+# busy collector answers 503, and an event that is not acknowledged within HEC_ACK_TIMEOUT seconds is sent again, up to
+# HEC_RETRIES times.
+HEC_BATCH_BYTES = 1000000
+HEC_RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+HEC_RETRIES = 5
+HEC_ACK_TIMEOUT = 300
+
+# compressed inputs are recognised by their first bytes, and the format by the file extension under the compression.
+COMPRESSION_MAGIC = ((b'\x1f\x8b', gzip.open), (b'BZh', bz2.open), (b'\xfd7zXZ\x00', lzma.open))
+COMPRESSION_EXTENSIONS = ('.gz', '.gzip', '.bz2', '.xz')
+INPUT_FORMAT_EXTENSIONS = {'.tsv': 'tsv', '.tab': 'tsv', '.jsonl': 'jsonl', '.ndjson': 'jsonl'}
+
+# number of dedup keys held in memory before the seen keys are spilled to a temporary sqlite file.
+DEDUP_MEMORY_KEYS = 1000000
+FILTER_PATTERN = re.compile(r'^\s*(.+?)\s*(!=|=|~)(.*)$')
+
+# seconds between status checks of an async search job, backing off from the first to the second.
+JOB_POLL_INTERVALS = (0.25, 5)
+
+# Separators used by the columnar encoding.  These are the printable symbols for the ascii record and unit separators,
+# so they pass through the search string unchanged and are very unlikely to show up in csv data.
+COLUMNAR_RECORD_SEPARATOR = '\u241e'
+COLUMNAR_UNIT_SEPARATOR = '\u241f'
+COLUMNAR_UNSAFE_CHARACTERS = ('"', '\\', '\n', '\r', COLUMNAR_RECORD_SEPARATOR, COLUMNAR_UNIT_SEPARATOR)
+COLUMNAR_UNSAFE_VALUE_CHARACTERS = ('\n', '\r', COLUMNAR_RECORD_SEPARATOR, COLUMNAR_UNIT_SEPARATOR)
+
+# gzip request bodies.  A wbits of 31 makes zlib write a gzip header and trailer instead of a zlib one.
+COMPRESSION_LEVEL = 6
+GZIP_WBITS = 31
+
 
 def main():
     # user inputs
@@ -58,9 +124,9 @@ def main():
                     'passes that json into a makeresults search in splunk.  Splunk will then parse the json back ' +
                     'into a csv in the search and do an output lookup to the lookup filename you specify.\n' +
                     'WARNING! Extremely large files may fail due to your users defined limits in splunk\'s' +
-                    ' configurations.  Reduce the batch size if that is the case.')
+                    ' configurations.  Reduce the batch size or set batch_bytes if that is the case.')
     parser.add_argument('-splunk_host',
-                        help='Host/Domain that csv will be pushed to. WARNING: When sending data to a search head cluster, it works best if you use a specific search head in the cluster as your host instead of using a load balanced address. This is because it is possible for you to be routed to a different search head when appending to the lookup file in batches which may or may not have the most up to date copy of the lookup file replicated to it. To avoid this problem use a specific search head in your request.',
+                        help='Host/Domain that csv will be pushed to. WARNING: When sending data to a search head cluster, it works best if you use a specific search head in the cluster as your host instead of using a load balanced address. This is because it is possible for you to be routed to a different search head when appending to the lookup file in batches which may or may not have the most up to date copy of the lookup file replicated to it. To avoid this problem use a specific search head in your request.  splunkd is reached on port 8089 unless another port is given after a colon, as in sh1.example.com:8090.',
                         required=True)
     parser.add_argument('-splunk_user',
                         help='User that has splunk credentials.',
@@ -69,14 +135,23 @@ def main():
                         help='User\'s password that has splunk credentials.',
                         required=False)
     parser.add_argument('-splunk_csv_name',
-                        help='Name of the file you want to push the csv into in splunk. ex: MyTempFile.csv',
-                        required=True)
+                        help='Name of the file you want to push the csv into in splunk. ex: MyTempFile.csv  When '
+                             'target is kvstore this is the name of the KV Store collection instead, and when target '
+                             'is hec it is the source of the events.  Required unless a manifest is provided.',
+                        required=False)
     parser.add_argument('-cert_location',
                         help='Provide directory to certificate location.  Set to False if you want to send unsecured.',
                         required=True)
     parser.add_argument('-source_csv_file',
-                        help='Absolute path to csv file. ex: /var/tmp/MyCsvFile.csv',
-                        required=True)
+                        help='Absolute path to csv file. ex: /var/tmp/MyCsvFile.csv  The file may be gzip, bz2 or xz '
+                             'compressed, and may be tsv or json lines instead of csv.  Required unless a manifest is '
+                             'provided.',
+                        required=False)
+    parser.add_argument('-input_format',
+                        help='Format of the source file.  Defaults to "tsv" for .tsv and .tab files, "jsonl" for '
+                             '.jsonl and .ndjson files, and "csv" for anything else, ignoring any .gz, .bz2 or .xz '
+                             'extension.',
+                        required=False, choices=['csv', 'tsv', 'jsonl'])
     parser.add_argument('-overwrite',
                         help='Set to "Y" if you want to overwrite the file with new data.  Set to "N" or do not set to '
                              'append to the lookup file.',
@@ -85,6 +160,137 @@ def main():
                         help='Size of batches that process will cycle through.  Defaults to 10,000 per batch. '
                              'Only accepts integers.',
                         required=False)
+    parser.add_argument('-stream',
+                        help='Set to "Y" to read the csv file lazily one batch at a time instead of loading the whole '
+                             'file into memory first.  Peak memory then depends on the batch size instead of the file '
+                             'size.  Defaults to "N".',
+                        required=False, choices=['Y', 'y', 'N', 'n'])
+    parser.add_argument('-workers',
+                        help='Number of batches to keep in flight against the search head at the same time.  All '
+                             'batches share one keep-alive connection pool.  Defaults to 1.  Only accepts integers.',
+                        required=False)
+    parser.add_argument('-target',
+                        help='Where the rows are written.  "lookup" runs a makeresults search that does an '
+                             'outputlookup to a csv lookup file.  "kvstore" writes the rows straight into an existing '
+                             'KV Store collection through the batch_save REST endpoint.  "hec" sends every row as an '
+                             'event to the HTTP Event Collector so it is indexed instead.  Defaults to "lookup".',
+                        required=False, choices=['lookup', 'kvstore', 'hec'])
+    parser.add_argument('-batch_bytes',
+                        help='Maximum size in bytes of the search sent for each batch.  The search is measured before '
+                             'it is sent and batches over the limit are split.  When target is hec it is the largest '
+                             'request sent to the collector instead.  Defaults to no limit, or 1000000 when target is '
+                             'hec.  Only accepts integers.',
+                        required=False)
+    parser.add_argument('-adaptive',
+                        help='Set to "Y" to grow or shrink the number of rows per batch so each batch takes about '
+                             'target_latency seconds.  Defaults to "N".',
+                        required=False, choices=['Y', 'y', 'N', 'n'])
+    parser.add_argument('-target_latency',
+                        help='Number of seconds each batch should take when adaptive is "Y".  Defaults to 30.  Only '
+                             'accepts integers.',
+                        required=False)
+    parser.add_argument('-encoding',
+                        help='How each batch is packed into the makeresults search.  "json" sends a json list of rows.  '
+                             '"columnar" sends the column names once followed by delimited rows, which is much smaller '
+                             'for files with many columns.  Batches that can not be packed as columnar fall back to '
+                             'json.  Defaults to "json".',
+                        required=False, choices=['json', 'columnar'])
+    parser.add_argument('-null_handling',
+                        help='How empty csv cells are turned into null fields with the json encoding.  "foreach" runs '
+                             'an eval for every field of every row on the search head.  "client" leaves empty cells '
+                             'out of the json before it is sent, so the search head has nothing left to do.  The '
+                             'columnar encoding always uses a single eval.  Defaults to "foreach".',
+                        required=False, choices=['foreach', 'client'])
+    parser.add_argument('-benchmark',
+                        help='Set to "Y" to compare the encodings and null handling on the first batch instead of '
+                             'uploading.  Each variant is run on the search head without writing the lookup and the '
+                             'bytes per row and search run duration are reported.  Defaults to "N".',
+                        required=False, choices=['Y', 'y', 'N', 'n'])
+    parser.add_argument('-benchmark_runs',
+                        help='Number of times each variant is run when benchmark is "Y".  Defaults to 3.  Only accepts '
+                             'integers.',
+                        required=False)
+    parser.add_argument('-compress',
+                        help='Set to "Y" to gzip compress request bodies.  A small compressed search is sent first and '
+                             'bodies are sent uncompressed if the search head does not accept it.  Defaults to "N".',
+                        required=False, choices=['Y', 'y', 'N', 'n'])
+    parser.add_argument('-checkpoint_file',
+                        help='Path of the checkpoint journal that records which batches have been uploaded.  Defaults '
+                             'to CSV2Splunk_<splunk_csv_name>.checkpoint in the current directory.  The journal is '
+                             'removed once the upload completes.',
+                        required=False)
+    parser.add_argument('-resume',
+                        help='Set to "Y" to resume a failed upload from its checkpoint journal.  Batches that already '
+                             'completed are skipped and the overwrite is not run again.  Defaults to "N".',
+                        required=False, choices=['Y', 'y', 'N', 'n'])
+    parser.add_argument('-delta',
+                        help='Set to "Y" to only send the rows that were added or changed since the last successful '
+                             'delta upload of this lookup, and remove deleted rows with one search on the lookup.  The '
+                             'first run, or a run with overwrite set to "Y", uploads the whole file.  Defaults to "N".',
+                        required=False, choices=['Y', 'y', 'N', 'n'])
+    parser.add_argument('-key_fields',
+                        help='Comma separated list of columns that identify a row when delta is "Y".  Defaults to '
+                             'every column, so a changed row is treated as a deleted row and an added row.',
+                        required=False)
+    parser.add_argument('-delta_state_file',
+                        help='Path of the file that keeps the row hashes of the last delta upload.  Defaults to '
+                             'CSV2Splunk_<splunk_csv_name>.delta in the current directory.',
+                        required=False)
+    parser.add_argument('-columns',
+                        help='Comma separated list of columns to upload.  Every other column is dropped before the '
+                             'rows are batched.  Defaults to every column.',
+                        required=False)
+    parser.add_argument('-filter',
+                        help='Comma separated list of conditions a row must all match to be uploaded.  Each condition '
+                             'is column=value, column!=value or column~regex.  ex: status=active,host~^web',
+                        required=False)
+    parser.add_argument('-dedup_fields',
+                        help='Comma separated list of columns that identify a row.  Only the first row of each key is '
+                             'uploaded.',
+                        required=False)
+    parser.add_argument('-async_jobs',
+                        choices=['Y', 'y', 'N', 'n'],
+                        help='Set to "Y" to dispatch each batch as a normal search job and poll it for completion '
+                             'instead of waiting on a oneshot search, so the next batch is read and encoded while '
+                             'splunk runs the current one.  Defaults to "N".',
+                        required=False)
+    parser.add_argument('-max_jobs',
+                        help='Maximum number of search jobs in flight at once when async_jobs is "Y".  Keep it under '
+                             'the search quota of the splunk_user role.  Defaults to workers.  Only accepts integers.',
+                        required=False)
+    parser.add_argument('-manifest',
+                        help='Path to a json or yaml manifest listing many csv files to upload in one run.  Each entry '
+                             'has a source_file, a splunk_csv_name, and optionally overwrite and splunk_host.  Files '
+                             'are read in parallel processes and uploaded over one shared connection pool, with at most '
+                             '"workers" batches in flight per search head.',
+                        required=False)
+    parser.add_argument('-parse_workers',
+                        help='Number of processes that read csv files when a manifest is provided.  Defaults to the '
+                             'number of cpus.  Only accepts integers.',
+                        required=False)
+    parser.add_argument('-kv_app',
+                        help='App that owns the KV Store collection when target is kvstore.  Defaults to "search".',
+                        required=False)
+    parser.add_argument('-hec_token',
+                        help='HTTP Event Collector token used when target is hec.  You will be prompted for it if it '
+                             'is not provided.',
+                        required=False)
+    parser.add_argument('-hec_port',
+                        help='Port of the HTTP Event Collector when target is hec.  Defaults to 8088.  Only accepts '
+                             'integers.',
+                        required=False)
+    parser.add_argument('-hec_index',
+                        help='Index the events are written to when target is hec.  Defaults to the default index of '
+                             'the token.',
+                        required=False)
+    parser.add_argument('-hec_sourcetype',
+                        help='Sourcetype of the events when target is hec.  Defaults to "csv".',
+                        required=False)
+    parser.add_argument('-hec_ack',
+                        choices=['Y', 'y', 'N', 'n'],
+                        help='Set to "Y" if indexer acknowledgment is turned on for the token.  Each batch is then '
+                             'polled until it is acknowledged and sent again if it is not.  Defaults to "N".',
+                        required=False)
     args = parser.parse_args()
 
     splunk_host = args.splunk_host.strip()
@@ -96,7 +302,10 @@ def main():
     else:
         overwrite = args.overwrite.strip().upper()
 
-    if args.splunk_pw is None:
+    if args.splunk_pw is None and args.target == 'hec':
+        # the event collector authenticates with its token instead.
+        splunk_pw = ''
+    elif args.splunk_pw is None:
         splunk_pw = getpass.getpass('Password for splunk: ').strip()
     else:
         splunk_pw = args.splunk_pw.strip()
@@ -106,9 +315,15 @@ def main():
     else:
         cert_info = args.cert_location.strip()
 
-    csv_location = args.source_csv_file.strip()
+    if args.manifest is None and (args.source_csv_file is None or args.splunk_csv_name is None):
+        log_print('error', 'Both source_csv_file and splunk_csv_name are required unless a manifest is provided.')
+        sys.exit()
+
+    csv_location = '' if args.source_csv_file is None else args.source_csv_file.strip()
+
+    input_format = None if args.input_format is None else args.input_format.strip().lower()
 
-    splunk_csv_name = args.splunk_csv_name.strip()
+    splunk_csv_name = '' if args.splunk_csv_name is None else args.splunk_csv_name.strip()
 
     if args.batch_size is None:
         batch_size = 10000
@@ -119,86 +334,1514 @@ def main():
             log_print('error', 'Invalid input provided for batch_size. Only accepts integers. ' + str(e))
             sys.exit()
 
-    # reading csv extracted and importing as an object
-    try:
-        logging.info('Reading CSV file.')
-        print('Reading CSV file.')
-        with open(csv_location, encoding='utf-8') as c:
-            r = csv.DictReader(c)
-            table = []
-            for row in r:
-                table.append(row)
-            c.close()
-    except Exception as e:
-        log_print('error', 'CSV read failed with exception:\n' + str(e))
+    if args.workers is None:
+        workers = 1
+    else:
+        try:
+            workers = int(args.workers.strip())
+            if workers < 1:
+                raise ValueError('workers must be at least 1.')
+        except Exception as e:
+            log_print('error', 'Invalid input provided for workers. Only accepts positive integers. ' + str(e))
+            sys.exit()
+
+    if args.batch_bytes is None:
+        batch_bytes = None
+    else:
+        try:
+            batch_bytes = int(args.batch_bytes.strip().replace(',', ''))
+        except Exception as e:
+            log_print('error', 'Invalid input provided for batch_bytes. Only accepts integers. ' + str(e))
+            sys.exit()
+
+    if args.adaptive is None:
+        adaptive = 'N'
+    else:
+        adaptive = args.adaptive.strip().upper()
+
+    if args.target_latency is None:
+        target_latency = 30
+    else:
+        try:
+            target_latency = int(args.target_latency.strip())
+        except Exception as e:
+            log_print('error', 'Invalid input provided for target_latency. Only accepts integers. ' + str(e))
+            sys.exit()
+
+    if args.encoding is None:
+        encoding = 'json'
+    else:
+        encoding = args.encoding.strip().lower()
+
+    if args.null_handling is None:
+        null_handling = 'foreach'
+    else:
+        null_handling = args.null_handling.strip().lower()
+
+    if args.benchmark is None:
+        benchmark = 'N'
+    else:
+        benchmark = args.benchmark.strip().upper()
+
+    if args.benchmark_runs is None:
+        benchmark_runs = 3
+    else:
+        try:
+            benchmark_runs = int(args.benchmark_runs.strip())
+            if benchmark_runs < 1:
+                raise ValueError('benchmark_runs must be at least 1.')
+        except Exception as e:
+            log_print('error', 'Invalid input provided for benchmark_runs. Only accepts positive integers. ' + str(e))
+            sys.exit()
+
+    sizer = BatchSizer(batch_size, adaptive == 'Y', target_latency)
+
+    if args.target is None:
+        target = 'lookup'
+    else:
+        target = args.target.strip().lower()
+
+    if args.kv_app is None:
+        kv_app = 'search'
+    else:
+        kv_app = args.kv_app.strip()
+
+    if target == 'hec':
+        if args.hec_token is None:
+            hec_token = getpass.getpass('HTTP Event Collector token: ').strip()
+        else:
+            hec_token = args.hec_token.strip()
+
+        if args.hec_port is None:
+            hec_port = 8088
+        else:
+            try:
+                hec_port = int(args.hec_port.strip())
+            except Exception as e:
+                log_print('error', 'Invalid input provided for hec_port. Only accepts integers. ' + str(e))
+                sys.exit()
+
+        if args.hec_sourcetype is None:
+            hec_sourcetype = 'csv'
+        else:
+            hec_sourcetype = args.hec_sourcetype.strip()
+
+        hec_index = None if args.hec_index is None else args.hec_index.strip()
+
+        if args.hec_ack is None:
+            hec_ack = 'N'
+        else:
+            hec_ack = args.hec_ack.strip().upper()
+
+        if overwrite == 'Y':
+            log_print('error', 'Overwrite can not be used when target is hec.  Indexed events can not be replaced.')
+            sys.exit()
+
+    if args.compress is None:
+        compress = 'N'
+    else:
+        compress = args.compress.strip().upper()
+
+    if args.checkpoint_file is None:
+        checkpoint_file = 'CSV2Splunk_' + re.sub(r'[^\w.-]', '_', splunk_csv_name) + '.checkpoint'
+    else:
+        checkpoint_file = args.checkpoint_file.strip()
+
+    if args.resume is None:
+        resume = 'N'
+    else:
+        resume = args.resume.strip().upper()
+
+    if args.delta is None:
+        delta = 'N'
+    else:
+        delta = args.delta.strip().upper()
+
+    if args.key_fields is None:
+        key_fields = None
+    else:
+        key_fields = [x.strip() for x in args.key_fields.strip().split(',') if x.strip() != '']
+
+    if args.delta_state_file is None:
+        delta_state_file = 'CSV2Splunk_' + re.sub(r'[^\w.-]', '_', splunk_csv_name) + '.delta'
+    else:
+        delta_state_file = args.delta_state_file.strip()
+
+    if delta == 'Y' and target != 'lookup':
+        log_print('error', 'Delta set to "Y" is only supported when target is lookup.')
         sys.exit()
 
-    log_print('info', 'CSV File read successfully.')
+    if args.columns is None and args.filter is None and args.dedup_fields is None:
+        transform = None
+    else:
+        transform_columns = None if args.columns is None else \
+            [x.strip() for x in args.columns.strip().split(',') if x.strip() != '']
+        dedup_fields = None if args.dedup_fields is None else \
+            [x.strip() for x in args.dedup_fields.strip().split(',') if x.strip() != '']
+        filters = []
+        for condition in ([] if args.filter is None else args.filter.strip().split(',')):
+            match = FILTER_PATTERN.match(condition)
+            if match is None:
+                log_print('error', 'Invalid input provided for filter. "' + condition + '" is not column=value, '
+                                   'column!=value or column~regex.')
+                sys.exit()
+            try:
+                filters.append((match.group(1), match.group(2), re.compile(match.group(3)) if match.group(2) == '~'
+                                else match.group(3)))
+            except re.error as e:
+                log_print('error', 'Invalid input provided for filter. "' + condition + '" is not a valid regex. ' +
+                          str(e))
+                sys.exit()
+        transform = RowTransform(transform_columns, filters, dedup_fields)
+
+    if args.stream is None:
+        stream = 'N'
+    else:
+        stream = args.stream.strip().upper()
+
+    if args.async_jobs is None:
+        async_jobs = 'N'
+    else:
+        async_jobs = args.async_jobs.strip().upper()
+
+    if args.max_jobs is None:
+        max_jobs = workers
+    else:
+        try:
+            max_jobs = int(args.max_jobs.strip())
+            if max_jobs < 1:
+                raise ValueError('max_jobs must be at least 1.')
+        except Exception as e:
+            log_print('error', 'Invalid input provided for max_jobs. Only accepts positive integers. ' + str(e))
+            sys.exit()
+
+    if async_jobs == 'Y' and target != 'lookup':
+        log_print('error', 'async_jobs is only supported when target is lookup.')
+        sys.exit()
+
+    if args.parse_workers is None:
+        parse_workers = os.cpu_count() or 1
+    else:
+        try:
+            parse_workers = int(args.parse_workers.strip())
+            if parse_workers < 1:
+                raise ValueError('parse_workers must be at least 1.')
+        except Exception as e:
+            log_print('error', 'Invalid input provided for parse_workers. Only accepts positive integers. ' + str(e))
+            sys.exit()
+
+    if args.manifest is not None:
+        if target != 'lookup' or 'Y' in (delta, resume, benchmark, adaptive, async_jobs) or transform is not None:
+            log_print('error', 'A manifest only supports the lookup target, and can not be used with delta, resume, '
+                               'benchmark, adaptive, async_jobs, columns, filter or dedup_fields.')
+            sys.exit()
+        entries = load_manifest(args.manifest.strip(), splunk_host, overwrite)
+        run_manifest(entries, splunk_user, splunk_pw, cert_info, batch_size, workers, parse_workers, batch_bytes,
+                     encoding, null_handling, compress)
+        return
+
+    if stream == 'Y':
+        log_print('info', 'Stream set to "Y".  Reading CSV file one batch at a time.')
+        rows = read_rows(csv_location, input_format)
+        # reading the first row up front so a missing or unreadable file fails before the lookup is overwritten.
+        first_row = next(rows, None)
+        if first_row is not None:
+            rows = chain([first_row], rows)
+    else:
+        # reading csv extracted and importing as an object
+        try:
+            logging.info('Reading CSV file.')
+            print('Reading CSV file.')
+            table = list(read_rows(csv_location, input_format))
+        except Exception as e:
+            log_print('error', 'CSV read failed with exception:\n' + str(e))
+            sys.exit()
+
+        log_print('info', 'CSV File read successfully.')
+
+        rows = iter(table)
 
-    if overwrite == 'Y':
+    if transform is not None:
+        rows = transform.apply(rows)
+        # pulling the first kept row so a bad column name fails before the lookup is overwritten.
+        first_row = next(rows, None)
+        if first_row is not None:
+            rows = chain([first_row], rows)
+
+    # with async jobs one batch more than the job limit is kept in hand, so the next batch is already read and encoded
+    # when a job finishes.
+    if async_jobs == 'Y':
+        jobs = SearchJobs(max_jobs)
+        workers = max(workers, max_jobs) + 1
+    else:
+        jobs = None
+
+    session = create_session(workers)
+
+    if benchmark == 'Y':
+        benchmark_table = list(islice(rows, batch_size))
+        if len(benchmark_table) == 0:
+            log_print('error', 'No rows found in the csv file to benchmark.')
+            sys.exit()
+        benchmark_encodings(benchmark_table, splunk_host, HTTPBasicAuth(splunk_user, splunk_pw), cert_info, session,
+                            benchmark_runs)
+        return
+
+    delta_keys = None
+    changed_keys = None
+    if delta == 'Y':
+        first_row = next(rows, None)
+        if first_row is not None:
+            rows = chain([first_row], rows)
+        delta_state = load_delta_state(delta_state_file)
+        columns = None if first_row is None else [key for key in first_row if key is not None]
+        if columns is None and delta_state is not None:
+            columns = delta_state['columns']
+        if key_fields is None:
+            key_fields = columns
+        elif columns is not None and any(field not in columns for field in key_fields):
+            log_print('error', 'Key fields ' + ', '.join(field for field in key_fields if field not in columns) +
+                      ' are not columns in the csv file.')
+            sys.exit()
+        delta_keys = {}
+
+        if overwrite == 'Y':
+            log_print('info', 'Delta and overwrite set to "Y".  Uploading the whole file and rebuilding the delta state.')
+        elif delta_state is None:
+            log_print('info', 'No delta state found at ' + delta_state_file + '.  Uploading the whole file as an '
+                              'overwrite and building the delta state.')
+            overwrite = 'Y'
+        elif delta_state['columns'] != columns or delta_state['key_fields'] != key_fields:
+            log_print('info', 'Columns or key fields changed since the last delta upload.  Uploading the whole file as '
+                              'an overwrite and rebuilding the delta state.')
+            overwrite = 'Y'
+        elif any("'" in field for field in key_fields):
+            log_print('info', 'Key fields contain a single quote which can not be used in the delete search.  '
+                              'Uploading the whole file as an overwrite.')
+            overwrite = 'Y'
+        else:
+            for row in delta_scan(rows, columns, key_fields, delta_keys):
+                pass
+            old_keys = delta_state['keys']
+            changed_keys = set(key for (key, value) in delta_keys.items() if old_keys.get(key) != value)
+            added = len(set(delta_keys) - set(old_keys))
+            deleted = set(old_keys) - set(delta_keys)
+            changed_keys.update(deleted)
+            log_print('info', 'Delta since the last upload: ' + str(added) + ' key(s) added, ' +
+                      str(len(changed_keys) - added - len(deleted)) + ' key(s) changed, ' + str(len(deleted)) +
+                      ' key(s) deleted, ' + str(len(delta_keys) - len(changed_keys) + len(deleted)) +
+                      ' key(s) unchanged.')
+            if len(changed_keys) == 0:
+                save_delta_state(delta_state_file, columns, key_fields, delta_keys)
+                log_print('info', 'No rows changed since the last upload.  Nothing to send.')
+                return
+            # reading the file a second time and only keeping the rows of keys that changed.
+            rows = read_rows(csv_location, input_format) if stream == 'Y' else iter(table)
+            if transform is not None:
+                rows = transform.apply(rows)
+            rows = (row for row in rows if delta_key(row, key_fields) in changed_keys)
+
+        if changed_keys is None:
+            rows = delta_scan(rows, columns, key_fields, delta_keys)
+
+    checkpoint = Checkpoint(checkpoint_file)
+    checkpoint_header = {'source': file_fingerprint(csv_location), 'splunk_host': splunk_host,
+                         'splunk_csv_name': splunk_csv_name, 'target': target,
+                         'transform': None if transform is None else transform.spec}
+    if resume == 'Y':
+        checkpoint.resume(checkpoint_header)
+    else:
+        checkpoint.start(checkpoint_header)
+
+    batches = read_batches(rows, sizer, checkpoint.planned_batches())
+
+    if compress == 'Y' and target == 'hec':
+        # the event collector always accepts gzip request bodies.
+        compress = True
+    elif compress == 'Y':
+        compress = compression_supported(splunk_host, HTTPBasicAuth(splunk_user, splunk_pw), cert_info, session)
+    else:
+        compress = False
+
+    if target == 'hec':
+        hec = HecSender('https://' + split_host(splunk_host)[0] + ':' + str(hec_port), hec_token, cert_info, session,
+                        batch_bytes or HEC_BATCH_BYTES, compress, hec_ack == 'Y',
+                        {'source': splunk_csv_name, 'sourcetype': hec_sourcetype, 'index': hec_index})
+        batch_function = hec.send_batch
+        batch_args = ()
+    elif target == 'kvstore':
+        kv_url = splunkd_url(splunk_host) + '/servicesNS/nobody/' + urllib.parse.quote(kv_app) + \
+                 '/storage/collections/data/' + urllib.parse.quote(splunk_csv_name)
+        max_documents = kvstore_batch_limit(splunk_host, HTTPBasicAuth(splunk_user, splunk_pw), cert_info, session)
+        batch_function = kvstore_batch_processor
+        batch_args = (kv_url, splunk_user, splunk_pw, cert_info, max_documents, session, compress)
+    else:
+        batch_function = batch_processor
+        batch_args = (splunk_csv_name, splunk_host, splunk_user, splunk_pw, cert_info, session, sizer, batch_bytes,
+                      encoding, null_handling, compress, jobs)
+
+    if (overwrite == 'Y' or changed_keys is not None) and checkpoint.overwrite_done:
+        log_print('info', 'Overwrite already completed before the upload being resumed.  Skipping overwrite.')
+    elif changed_keys is not None:
+        # every key being sent is removed first, so rows of a failed earlier attempt are never left duplicated.
+        delta_delete(changed_keys, key_fields, splunk_csv_name, splunk_host, HTTPBasicAuth(splunk_user, splunk_pw),
+                     cert_info, session)
+        checkpoint.record_overwrite()
+    elif overwrite == 'Y' and target == 'kvstore':
+        log_print('info', 'Overwrite set to "Y".  Deleting all records in KV Store collection ' + splunk_csv_name +
+                          ' before running batch upload.')
+
+        kv_collection_delete = request(kv_url, HTTPBasicAuth(splunk_user, splunk_pw), None, cert_info, session,
+                                       method='delete')
+
+        checkpoint.record_overwrite()
+        log_print('info', 'Successfully deleted contents of collection ' + splunk_csv_name + '.')
+    elif overwrite == 'Y':
         log_print('info', 'Overwrite set to "Y".  Running outputlookup on csv table to delete contents before running '
                           'batch upload.')
 
-        query = '| outputlookup ' + splunk_csv_name
+        truncate_lookup(splunk_csv_name, splunk_host, HTTPBasicAuth(splunk_user, splunk_pw), cert_info, session)
 
-        spl_search_request = {'search': query,
-                              'exec_mode': 'oneshot',
-                              'output_mode': 'json',
-                              'count': 0}
+        checkpoint.record_overwrite()
 
-        spl_table_delete = request('https://' + splunk_host + ':8089/services/search/jobs',
-                                   HTTPBasicAuth(splunk_user, splunk_pw),
-                                   spl_search_request, cert_info)
+    in_flight = {}
 
-        log_print('info', 'Successfully deleted contents of lookup ' + splunk_csv_name + '.')
+    log_print('info', 'Beginning batch processing of CSV data import to splunk.')
+    # the overwrite above has already completed, so appends can safely run side by side from here on.
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for (batch_count, start_row, batch_table) in batches:
+            log_print('info', 'Processing batch count ' + str(batch_count) + ' which contains ' + str(len(batch_table))
+                      + ' row(s).')
+            checkpoint.record_batch(batch_count, start_row, start_row + len(batch_table))
+            if target == 'lookup':
+                # the parts of a batch that is split are journaled as they are appended, so a resume does not send
+                # them twice.
+                future = executor.submit(batch_function, batch_table, *batch_args,
+                                         journal=partial(checkpoint.record_sent, batch_count, start_row))
+            else:
+                future = executor.submit(batch_function, batch_table, *batch_args)
+            in_flight[future] = (batch_count, len(batch_table), time.time())
+            batch_table = None
+            # the next batch is read while the in flight batches are uploading.
+            if len(in_flight) >= workers:
+                collect_batches(in_flight, FIRST_COMPLETED, sizer, checkpoint)
+        collect_batches(in_flight, sizer=sizer, checkpoint=checkpoint)
 
-    batch_count = 0
+    checkpoint.finish()
 
-    log_print('info', 'Beginning batch processing of CSV data import to splunk.')
-    for i in range(0, len(table), batch_size):
-        batch_table = table[i:i + batch_size]
-        batch_count += 1
-        log_print('info', 'Processing batch count ' + str(batch_count) + ' which contains ' + str(len(batch_table))
-                  + ' row(s).')
-        batch_processor(batch_table, splunk_csv_name, splunk_host, splunk_user, splunk_pw, cert_info)
+    if transform is not None:
+        transform.log_summary()
+
+    if target == 'hec':
+        hec.log_summary()
+
+    if delta_keys is not None:
+        save_delta_state(delta_state_file, columns, key_fields, delta_keys)
 
     log_print('info',
               'Batch processing of csv file is complete.  Please check splunk to confirm your file is accurately'
               ' uploaded.')
 
 
-def batch_processor(table, splunk_csv_name, splunk_host, splunk_user, splunk_pw, cert_info):
-    # creating splunk query that will convert the table to a json string for a search and then back into a csv.
+def create_session(workers, hosts=1):
+    # one keep-alive session shared by every batch so each request does not pay for a new connection and tls handshake.
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=hosts, pool_maxsize=workers))
+    return session
 
-    query = '| makeresults | fields - _time | eval data=' + json.dumps(json.dumps(table)) + \
-            ' | eval data=spath(data, "{}") | mvexpand data | spath input=data ' \
-            '| fields - data | foreach * [eval "<<FIELD>>"=if(\'<<FIELD>>\'="", null(), \'<<FIELD>>\')] ' \
-            '| outputlookup append=true ' + splunk_csv_name
 
-    # clearing memory
-    table = None
+def split_host(splunk_host):
+    # splunk_host may name the port of splunkd after a colon, as in sh1.example.com:8090.  Otherwise it is 8089.
+    (host, port) = re.fullmatch('(.*?)(?::([0-9]+))?', splunk_host).groups()
+    return host, int(port or 8089)
+
+
+def splunkd_url(splunk_host):
+    (host, port) = split_host(splunk_host)
+    return 'https://' + host + ':' + str(port)
+
+
+def truncate_lookup(splunk_csv_name, splunk_host, auths, cert_info, session=None):
+    query = '| outputlookup ' + splunk_csv_name
 
     spl_search_request = {'search': query,
                           'exec_mode': 'oneshot',
                           'output_mode': 'json',
                           'count': 0}
 
-    log_print('info', 'Sending CSV batch upload to Splunk.')
+    spl_table_delete = request(splunkd_url(splunk_host) + '/services/search/jobs', auths,
+                               spl_search_request, cert_info, session)
+
+    log_print('info', 'Successfully deleted contents of lookup ' + splunk_csv_name + '.')
+
+
+def load_manifest(manifest_location, splunk_host, overwrite):
+    try:
+        with open(manifest_location, encoding='utf-8') as m:
+            if manifest_location.lower().endswith(('.yml', '.yaml')):
+                if yaml is None:
+                    log_print('error', 'Add the pyyaml repository to your PYTHONPATH to read yaml manifests:\n'
+                                       'python -m pip install pyyaml')
+                    sys.exit()
+                manifest = yaml.safe_load(m)
+            else:
+                manifest = json.load(m)
+    except Exception as e:
+        log_print('error', 'Manifest read failed with exception:\n' + str(e))
+        sys.exit()
+
+    if not isinstance(manifest, list) or len(manifest) == 0:
+        log_print('error', 'Manifest must be a non empty list of entries.')
+        sys.exit()
+
+    entries = []
+    for (i, entry) in enumerate(manifest):
+        if not isinstance(entry, dict) or 'source_file' not in entry or 'splunk_csv_name' not in entry:
+            log_print('error', 'Manifest entry ' + str(i + 1) + ' must have a source_file and a splunk_csv_name.')
+            sys.exit()
+        entry_overwrite = entry.get('overwrite', overwrite)
+        if isinstance(entry_overwrite, bool):
+            entry_overwrite = 'Y' if entry_overwrite else 'N'
+        entries.append({'source_file': str(entry['source_file']).strip(),
+                        'splunk_csv_name': str(entry['splunk_csv_name']).strip(),
+                        'overwrite': str(entry_overwrite).strip().upper(),
+                        'splunk_host': str(entry.get('splunk_host', splunk_host)).strip()})
+    log_print('info', 'Manifest read successfully with ' + str(len(entries)) + ' csv file(s).')
+    return entries
+
+
+def set_manifest_queue(batch_queue):
+    # runs once in every parse process so the queue is inherited instead of pickled with each task.
+    global manifest_queue
+    manifest_queue = batch_queue
+
+
+def read_manifest_file(index, source_file, batch_size):
+    # Runs in a parse process.  Every outcome ends with a done or error message so the uploader knows the file is
+    # finished, and the queue is bounded so a fast reader waits for the uploads to catch up.
+    batch_count = 0
+    try:
+        for (batch_count, start_row, batch_table) in read_batches(read_rows(source_file), BatchSizer(batch_size)):
+            manifest_queue.put(('batch', index, batch_count, batch_table))
+        manifest_queue.put(('done', index, batch_count, None))
+    except SystemExit:
+        # read_rows has already logged why.
+        manifest_queue.put(('error', index, batch_count, 'Reading ' + source_file + ' failed.'))
+    except BaseException as e:
+        manifest_queue.put(('error', index, batch_count, 'Reading ' + source_file + ' failed: ' + repr(e)))
+
+
+def manifest_upload(lookup, batch_table, semaphore, splunk_user, splunk_pw, cert_info, session, batch_bytes, encoding,
+                    null_handling, compress):
+    try:
+        # the first batch of a lookup runs its overwrite, and the other batches of that lookup wait for it.
+        with lookup['lock']:
+            if lookup['failed']:
+                return
+            if not lookup['prepared']:
+                if lookup['overwrite'] == 'Y':
+                    truncate_lookup(lookup['splunk_csv_name'], lookup['splunk_host'],
+                                    HTTPBasicAuth(splunk_user, splunk_pw), cert_info, session)
+                lookup['prepared'] = True
+        if batch_table is not None:
+            batch_processor(batch_table, lookup['splunk_csv_name'], lookup['splunk_host'], splunk_user, splunk_pw,
+                            cert_info, session, None, batch_bytes, encoding, null_handling, compress)
+            with lookup['lock']:
+                lookup['rows'] += len(batch_table)
+                lookup['batches'] += 1
+    except BaseException as e:
+        if not isinstance(e, SystemExit):
+            log_print('error', 'Upload to ' + lookup['splunk_csv_name'] + ' failed with exception:\n' + str(e))
+        lookup['failed'] = True
+    finally:
+        lookup['end'] = time.time()
+        semaphore.release()
+
+
+def run_manifest(entries, splunk_user, splunk_pw, cert_info, batch_size, workers, parse_workers, batch_bytes, encoding,
+                 null_handling, compress):
+    # csv files are read in a process pool and their batches handed to a thread pool that uploads them over one
+    # session.  Each search head has its own semaphore so no more than workers batches are in flight against it.
+    hosts = sorted(set(entry['splunk_host'] for entry in entries))
+    lookups = [dict(entry, lock=threading.Lock(), prepared=False, failed=False, rows=0, batches=0, start=None,
+                    end=None) for entry in entries]
+    semaphores = {host: threading.BoundedSemaphore(workers) for host in hosts}
+    run_start = time.time()
+
+    batch_queue = multiprocessing.Queue(maxsize=workers * len(hosts) * 2)
+    parse_pool = ProcessPoolExecutor(max_workers=min(parse_workers, len(entries)), initializer=set_manifest_queue,
+                                     initargs=(batch_queue,))
+    parse_futures = {parse_pool.submit(read_manifest_file, index, lookup['source_file'], batch_size): index
+                     for (index, lookup) in enumerate(lookups)}
+
+    session = create_session(workers, len(hosts))
+    if compress == 'Y':
+        compress = all(compression_supported(host, HTTPBasicAuth(splunk_user, splunk_pw), cert_info, session)
+                       for host in hosts)
+    else:
+        compress = False
+
+    log_print('info', 'Beginning batch processing of ' + str(len(lookups)) + ' csv file(s) with ' +
+              str(min(parse_workers, len(entries))) + ' parse process(es) and up to ' + str(workers) +
+              ' batch(es) in flight per search head.')
+    open_files = set(range(len(lookups)))
+    with ThreadPoolExecutor(max_workers=workers * len(hosts)) as executor:
+        while len(open_files) > 0:
+            try:
+                (kind, index, batch_count, payload) = batch_queue.get(timeout=1)
+            except queue.Empty:
+                # a parse process that died without reporting would otherwise leave its file open forever.
+                for (future, index) in parse_futures.items():
+                    if index in open_files and future.done() and future.exception() is not None:
+                        log_print('error', 'Reading ' + lookups[index]['source_file'] + ' failed: ' +
+                                  str(future.exception()))
+                        lookups[index]['failed'] = True
+                        open_files.discard(index)
+                continue
+
+            lookup = lookups[index]
+            if lookup['start'] is None:
+                lookup['start'] = time.time()
+            if kind == 'error':
+                log_print('error', payload)
+                lookup['failed'] = True
+            if kind != 'batch':
+                open_files.discard(index)
+                # an empty file still has to run its overwrite.
+                if kind == 'done' and batch_count == 0 and not lookup['failed']:
+                    semaphores[lookup['splunk_host']].acquire()
+                    executor.submit(manifest_upload, lookup, None, semaphores[lookup['splunk_host']], splunk_user,
+                                    splunk_pw, cert_info, session, batch_bytes, encoding, null_handling, compress)
+                continue
+            if lookup['failed']:
+                continue
+
+            log_print('info', 'Processing batch count ' + str(batch_count) + ' of ' + lookup['splunk_csv_name'] +
+                      ' which contains ' + str(len(payload)) + ' row(s).')
+            semaphores[lookup['splunk_host']].acquire()
+            executor.submit(manifest_upload, lookup, payload, semaphores[lookup['splunk_host']], splunk_user,
+                            splunk_pw, cert_info, session, batch_bytes, encoding, null_handling, compress)
+            payload = None
+
+    parse_pool.shutdown()
+
+    log_print('info', 'Manifest upload summary:')
+    for lookup in lookups:
+        elapsed = 0 if lookup['start'] is None or lookup['end'] is None else lookup['end'] - lookup['start']
+        log_print('info', '  ' + lookup['splunk_csv_name'] + ' from ' + lookup['source_file'] + ': ' +
+                  ('FAILED' if lookup['failed'] else 'completed') + ', ' + str(lookup['rows']) + ' row(s) in ' +
+                  str(lookup['batches']) + ' batch(es), ' + '{:.2f}'.format(elapsed) + ' seconds.')
+    failed = [lookup['splunk_csv_name'] for lookup in lookups if lookup['failed']]
+    log_print('info', 'Manifest processed ' + str(len(lookups)) + ' csv file(s) in ' +
+              '{:.2f}'.format(time.time() - run_start) + ' seconds.')
+    if len(failed) > 0:
+        log_print('error', str(len(failed)) + ' csv file(s) failed to upload: ' + ', '.join(failed) + '.  Please '
+                           'check the log above and upload them again.')
+        sys.exit()
+
+
+def collect_batches(in_flight, return_when=ALL_COMPLETED, sizer=None, checkpoint=None):
+    done, not_done = wait(in_flight, return_when=return_when)
+    failed = None
+    for future in done:
+        batch_count, row_count, batch_start = in_flight.pop(future)
+        try:
+            future.result()
+        except BaseException as e:
+            # request() exits on a failed post.  Stop sending new batches and let the other batches finish first.
+            if not isinstance(e, SystemExit):
+                log_print('error', 'Batch ' + str(batch_count) + ' failed with exception:\n' + str(e))
+            failed = batch_count
+            continue
+        elapsed = time.time() - batch_start
+        if checkpoint is not None:
+            checkpoint.record_done(batch_count)
+        log_batch_stats(batch_count, row_count, elapsed)
+        if sizer is not None:
+            sizer.record(row_count, elapsed)
+    if failed is not None:
+        log_print('error', 'Batch ' + str(failed) + ' failed.  Waiting for ' + str(len(in_flight)) + ' in flight '
+                           'batch(es) to finish before stopping.')
+        collect_batches(in_flight, checkpoint=checkpoint)
+        if checkpoint is not None:
+            log_print('info', 'Run again with -resume Y to continue from the first unfinished batch.')
+        sys.exit()
+
+
+class BatchSizer:
+    # Number of rows read into each batch.  It is lowered when a batch is over batch_bytes or rejected by splunk and
+    # never grows back past that point.  When adaptive it also moves toward the size that takes target_latency seconds.
+    def __init__(self, size, adaptive=False, target_latency=30):
+        self.size = size
+        self.ceiling = None
+        self.adaptive = adaptive
+        self.target_latency = target_latency
+        self.lock = threading.Lock()
+
+    def shrink(self, size):
+        with self.lock:
+            size = max(1, size)
+            self.ceiling = size if self.ceiling is None else min(self.ceiling, size)
+            if size < self.size:
+                self.size = size
+                log_print('info', 'Batch size lowered to ' + str(size) + ' row(s).')
+
+    def record(self, row_count, elapsed):
+        if not self.adaptive or elapsed <= 0:
+            return
+        with self.lock:
+            ideal = int(row_count * self.target_latency / elapsed)
+            # only grow from full batches, and at most double at a time since latency is not linear in rows.
+            if ideal > self.size * 1.2 and row_count >= self.size:
+                size = min(ideal, self.size * 2)
+            elif ideal < self.size * 0.8:
+                size = ideal
+            else:
+                return
+            if self.ceiling is not None:
+                size = min(size, self.ceiling)
+            size = max(1, size)
+            if size != self.size:
+                log_print('info', 'Batch of ' + str(row_count) + ' row(s) took ' + '{:.2f}'.format(elapsed) +
+                          ' seconds.  Adjusting batch size from ' + str(self.size) + ' to ' + str(size) + ' row(s).')
+                self.size = size
+
+
+def read_rows(csv_location, input_format=None):
+    # Lazily read the csv so only the rows of the current batch are held in memory.  Compressed files are
+    # decompressed as they are read, so no temporary file is written.
+    try:
+        with open_source(csv_location) as c:
+            if (input_format or source_format(csv_location)) == 'jsonl':
+                for (line_number, line) in enumerate(c, 1):
+                    if line.strip() == '':
+                        continue
+                    yield jsonl_row(json.loads(line), line_number)
+            else:
+                # tab separated files have no quoting, so a quote character is kept as part of the field.
+                if (input_format or source_format(csv_location)) == 'tsv':
+                    r = csv.DictReader(c, delimiter='\t', quoting=csv.QUOTE_NONE)
+                else:
+                    r = csv.DictReader(c, delimiter=',')
+                for row in r:
+                    yield row
+    except Exception as e:
+        log_print('error', 'CSV read failed with exception:\n' + str(e))
+        sys.exit()
+
+
+def open_source(csv_location):
+    with open(csv_location, 'rb') as f:
+        magic = f.read(6)
+    for (prefix, opener) in COMPRESSION_MAGIC:
+        if magic.startswith(prefix):
+            return opener(csv_location, 'rt', encoding='utf-8', newline='')
+    return open(csv_location, encoding='utf-8', newline='')
+
+
+def source_format(csv_location):
+    name = csv_location.lower()
+    for extension in COMPRESSION_EXTENSIONS:
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+            break
+    return INPUT_FORMAT_EXTENSIONS.get(os.path.splitext(name)[1], 'csv')
+
+
+def jsonl_row(record, line_number):
+    # values are turned into strings like the cells of a csv, with nested objects and arrays kept as json text.
+    if not isinstance(record, dict):
+        raise ValueError('Line ' + str(line_number) + ' is not a json object.')
+    return {str(key): '' if value is None else value if isinstance(value, str) else json.dumps(value)
+            for (key, value) in record.items()}
+
+
+def read_batches(rows, sizer, journal_batches=()):
+    # Batches already in the checkpoint journal are read with the same row boundaries they had before, and the ones
+    # that completed are skipped.  A batch that was partly appended starts after its last appended row.  The rest of
+    # the file is batched as normal.
+    row_number = 0
+    batch_count = 0
+    for (batch_count, start_row, end_row, done) in journal_batches:
+        for row in islice(rows, start_row - row_number):
+            pass
+        if done or end_row <= start_row:
+            for row in islice(rows, end_row - start_row):
+                pass
+        else:
+            yield batch_count, start_row, list(islice(rows, end_row - start_row))
+        row_number = max(start_row, end_row)
+
+    # the batch size is looked up for every batch so changes made by the sizer apply to the next batch read.
+    while True:
+        batch_table = list(islice(rows, sizer.size))
+        if len(batch_table) == 0:
+            break
+        batch_count += 1
+        yield batch_count, row_number, batch_table
+        row_number += len(batch_table)
+
+
+class RowTransform:
+    # Streaming stage between the csv reader and the batches.  Rows that do not match every filter are dropped, then
+    # rows whose dedup key was already seen, then the kept rows are cut down to the listed columns.  Filters and dedup
+    # look at the full row, so they can use columns that are not uploaded.
+    def __init__(self, columns=None, filters=(), dedup_fields=None):
+        self.columns = columns
+        self.filters = filters
+        self.dedup_fields = dedup_fields
+        self.spec = {'columns': columns, 'dedup_fields': dedup_fields,
+                     'filter': [[field, op, value if op != '~' else value.pattern] for (field, op, value) in filters]}
+        self.spill = None
+        self.reset()
+
+    def reset(self):
+        self.rows_in = 0
+        self.rows_out = 0
+        self.filtered = 0
+        self.duplicates = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seen = set()
+        self.close_spill()
+
+    def apply(self, rows):
+        # every pass over the file starts with empty counts and an empty set of seen keys.
+        self.reset()
+        checked = False
+        for row in rows:
+            if not checked:
+                self.check_columns(row)
+                checked = True
+            self.rows_in += 1
+            self.bytes_in += row_bytes(row)
+            if not self.matches(row):
+                self.filtered += 1
+                continue
+            if self.dedup_fields is not None and self.is_duplicate(row):
+                self.duplicates += 1
+                continue
+            if self.columns is not None:
+                row = {column: row.get(column) for column in self.columns}
+            self.rows_out += 1
+            self.bytes_out += row_bytes(row)
+            yield row
+        self.seen = None
+        self.close_spill()
+
+    def check_columns(self, row):
+        fields = (self.columns or []) + (self.dedup_fields or []) + [field for (field, op, value) in self.filters]
+        missing = [field for field in dict.fromkeys(fields) if field not in row]
+        if len(missing) > 0:
+            log_print('error', 'Columns ' + ', '.join(missing) + ' given in columns, filter or dedup_fields are not '
+                               'columns in the csv file.')
+            sys.exit()
+
+    def matches(self, row):
+        for (field, op, value) in self.filters:
+            cell = row.get(field) or ''
+            if op == '=' and cell != value:
+                return False
+            if op == '!=' and cell == value:
+                return False
+            if op == '~' and value.search(cell) is None:
+                return False
+        return True
+
+    def is_duplicate(self, row):
+        # an 8 byte hash of the key is kept instead of the key itself.
+        key = int.from_bytes(hashlib.blake2b(DELTA_KEY_SEPARATOR.join(row.get(field) or '' for field in
+                                                                      self.dedup_fields).encode('utf-8'),
+                                             digest_size=8).digest(), 'big', signed=True)
+        if self.spill is not None:
+            return self.spill.execute('INSERT OR IGNORE INTO seen VALUES (?)', (key,)).rowcount == 0
+        if key in self.seen:
+            return True
+        self.seen.add(key)
+        if len(self.seen) >= DEDUP_MEMORY_KEYS:
+            spill_file = tempfile.NamedTemporaryFile(prefix='CSV2Splunk_dedup_', suffix='.db', delete=False)
+            spill_file.close()
+            log_print('info', 'More than ' + str(DEDUP_MEMORY_KEYS) + ' dedup keys seen.  Spilling them to ' +
+                      spill_file.name + '.')
+            self.spill = sqlite3.connect(spill_file.name, isolation_level=None)
+            self.spill_path = spill_file.name
+            self.spill.execute('PRAGMA journal_mode=OFF')
+            self.spill.execute('PRAGMA synchronous=OFF')
+            self.spill.execute('CREATE TABLE seen (key INTEGER PRIMARY KEY)')
+            self.spill.execute('BEGIN')
+            self.spill.executemany('INSERT INTO seen VALUES (?)', ((k,) for k in self.seen))
+            self.seen = set()
+        return False
+
+    def close_spill(self):
+        if self.spill is not None:
+            self.spill.close()
+            os.remove(self.spill_path)
+            self.spill = None
 
-    spl_search_post = request('https://' + splunk_host + ':8089/services/search/jobs',
-                              HTTPBasicAuth(splunk_user, splunk_pw),
-                              spl_search_request, cert_info)
+    def log_summary(self):
+        saved = self.bytes_in - self.bytes_out
+        log_print('info', 'Transform read ' + str(self.rows_in) + ' row(s) and kept ' + str(self.rows_out) + ' (' +
+                  str(self.filtered) + ' filtered out, ' + str(self.duplicates) + ' duplicate(s)).  Cell data went '
+                  'from ' + str(self.bytes_in) + ' to ' + str(self.bytes_out) + ' bytes, saving ' + str(saved) +
+                  ' bytes (' + ('{:.1f}'.format(100 * saved / self.bytes_in) if self.bytes_in > 0 else '0.0') + '%).')
 
+
+def row_bytes(row):
+    return sum(len(value.encode('utf-8')) for value in row.values() if isinstance(value, str))
+
+
+def delta_key(row, key_fields):
+    # Same value as the md5 eval built by delta_delete, so keys can be matched against the rows in the lookup.
+    return hashlib.md5(DELTA_KEY_SEPARATOR.join('' if row.get(field) is None else str(row.get(field))
+                                                for field in key_fields).encode('utf-8')).hexdigest()
+
+
+def delta_scan(rows, columns, key_fields, delta_keys):
+    # The hashes of all rows with the same key are summed, so duplicate keys and their order do not matter.
+    for row in rows:
+        key = delta_key(row, key_fields)
+        row_hash = hashlib.blake2b('\x1f'.join('' if row.get(column) is None else str(row.get(column))
+                                               for column in columns).encode('utf-8'), digest_size=8).digest()
+        delta_keys[key] = (delta_keys.get(key, 0) + int.from_bytes(row_hash, 'big')) % DELTA_HASH_MODULUS
+        yield row
+
+
+def delta_delete(changed_keys, key_fields, splunk_csv_name, splunk_host, auths, cert_info, session):
+    # Rewrites the lookup on the search head without the rows of the changed keys.
+    key_eval = 'md5(' + ('."' + DELTA_KEY_SEPARATOR + '".').join('coalesce(\'' + field + '\', "")'
+                                                                 for field in key_fields) + ')'
+    changed_keys = sorted(changed_keys)
+    for i in range(0, len(changed_keys), DELTA_DELETE_BATCH):
+        chunk = changed_keys[i:i + DELTA_DELETE_BATCH]
+        log_print('info', 'Removing ' + str(len(chunk)) + ' changed or deleted key(s) from lookup ' + splunk_csv_name +
+                  '.')
+        query = '| inputlookup ' + splunk_csv_name + ' | eval _delta_key=' + key_eval + \
+                ' | where NOT in(_delta_key, "' + '", "'.join(chunk) + '") | fields - _delta_key | outputlookup ' + \
+                splunk_csv_name
+
+        spl_search_request = {'search': query,
+                              'exec_mode': 'oneshot',
+                              'output_mode': 'json',
+                              'count': 0}
+
+        spl_delta_delete = request(splunkd_url(splunk_host) + '/services/search/jobs', auths,
+                                   spl_search_request, cert_info, session)
+
+
+def load_delta_state(delta_state_file):
+    if not os.path.isfile(delta_state_file):
+        return None
+    try:
+        with open(delta_state_file, encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        log_print('warn', 'Unable to read delta state ' + delta_state_file + '.  It will be rebuilt. ' + str(e))
+        return None
+
+
+def save_delta_state(delta_state_file, columns, key_fields, delta_keys):
+    # written to a temporary file first so a failed write never leaves a partial state behind.
+    try:
+        with open(delta_state_file + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'columns': columns, 'key_fields': key_fields, 'keys': delta_keys}, f)
+        os.replace(delta_state_file + '.tmp', delta_state_file)
+    except Exception as e:
+        log_print('error', 'Unable to save delta state ' + delta_state_file + ':\n' + str(e))
+        sys.exit()
+    log_print('info', 'Saved delta state for ' + str(len(delta_keys)) + ' key(s) to ' + delta_state_file + '.')
+
+
+def file_fingerprint(csv_location):
+    # hashing the start and end of the file notices most changes without reading a multi gigabyte file, and the inode
+    # and modification time notice a file that was written again with only its middle changed.
+    try:
+        stat = os.stat(csv_location)
+        digest = hashlib.sha256()
+        with open(csv_location, 'rb') as f:
+            digest.update(f.read(FINGERPRINT_BYTES))
+            if stat.st_size > FINGERPRINT_BYTES:
+                f.seek(max(FINGERPRINT_BYTES, stat.st_size - FINGERPRINT_BYTES))
+                digest.update(f.read(FINGERPRINT_BYTES))
+    except Exception as e:
+        log_print('error', 'CSV read failed with exception:\n' + str(e))
+        sys.exit()
+    return {'path': os.path.abspath(csv_location), 'size': stat.st_size, 'inode': stat.st_ino,
+            'mtime_ns': stat.st_mtime_ns, 'sha256': digest.hexdigest()}
+
+
+class Checkpoint:
+    # Append only journal of an upload.  The first line identifies the source file and the target, then a line is
+    # written when the overwrite finishes, when each batch is read with its row boundaries, when each part of a split
+    # batch is appended, and when each batch completes.  Every line is flushed to disk before the run moves on.
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.overwrite_done = False
+        self.batches = {}
+        self.lock = threading.Lock()
+
+    def start(self, header):
+        try:
+            self.file = open(self.path, 'w', encoding='utf-8')
+        except Exception as e:
+            log_print('error', 'Unable to create checkpoint file ' + self.path + ':\n' + str(e))
+            sys.exit()
+        self.write(header)
+
+    def resume(self, header):
+        if not os.path.isfile(self.path):
+            log_print('error', 'Resume set to "Y" but no checkpoint file was found at ' + self.path + '.')
+            sys.exit()
+        journal_header = None
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last line may be cut short if the previous run was killed while writing it.
+                    continue
+                if journal_header is None:
+                    journal_header = record
+                elif 'overwrite' in record:
+                    self.overwrite_done = True
+                elif record.get('done'):
+                    self.batches[record['batch']][2] = True
+                elif 'sent' in record:
+                    # the parts of a split batch are sent in order, so the rows before this one were all appended.
+                    self.batches[record['batch']][0] = record['sent']
+                else:
+                    self.batches[record['batch']] = [record['start'], record['end'], False]
+
+        for key in ('splunk_host', 'splunk_csv_name', 'target', 'transform'):
+            if journal_header is None or journal_header.get(key) != header[key]:
+                log_print('error', 'Checkpoint file ' + self.path + ' is for a different upload.  Expected ' + key +
+                          ' ' + str(header[key]) + '.')
+                sys.exit()
+        source = journal_header['source']
+        if any(source.get(key) != header['source'][key] for key in ('size', 'inode', 'mtime_ns', 'sha256')):
+            log_print('error', 'Source file ' + header['source']['path'] + ' has changed since the checkpoint was '
+                               'written.  It can not be resumed.')
+            sys.exit()
+
+        pending = [batch for (batch, boundaries) in sorted(self.batches.items()) if not boundaries[2]]
+        log_print('info', 'Resuming upload from checkpoint.  ' + str(len(self.batches) - len(pending)) + ' of ' +
+                  str(len(self.batches)) + ' recorded batch(es) completed.' +
+                  (' Restarting from batch ' + str(pending[0]) + '.' if len(pending) > 0 else ''))
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def planned_batches(self):
+        return [(batch, start_row, end_row, done) for (batch, (start_row, end_row, done))
+                in sorted(self.batches.items(), key=lambda item: item[1][0])]
+
+    def write(self, record):
+        with self.lock:
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def record_overwrite(self):
+        self.overwrite_done = True
+        self.write({'overwrite': 'done'})
+
+    def record_batch(self, batch_count, start_row, end_row):
+        self.write({'batch': batch_count, 'start': start_row, 'end': end_row})
+
+    def record_sent(self, batch_count, start_row, end_offset):
+        self.write({'batch': batch_count, 'sent': start_row + end_offset})
+
+    def record_done(self, batch_count):
+        self.write({'batch': batch_count, 'done': True})
+
+    def finish(self):
+        self.file.close()
+        os.remove(self.path)
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on linux.
+    if sys.platform == 'darwin':
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def log_batch_stats(batch_count, row_count, elapsed):
+    # reporting throughput and memory per batch so hosts can be sized for a given file and batch size.
+    rate = row_count / elapsed if elapsed > 0 else float(row_count)
+    message = 'Batch ' + str(batch_count) + ' processed ' + str(row_count) + ' row(s) in ' + \
+              '{:.2f}'.format(elapsed) + ' seconds (' + '{:.0f}'.format(rate) + ' rows/sec).'
+    peak = peak_rss_mb()
+    if peak is not None:
+        message += ' Peak RSS: ' + '{:.1f}'.format(peak) + ' MB.'
+    log_print('info', message)
+
+
+def query_parts(table, encoding='json', null_handling='foreach'):
+    # creating splunk query that will convert the table to a string for a search and then back into a table.  The
+    # search is yielded in pieces, one per row for the data, so it never has to be held in memory as a single string.
+    if encoding == 'columnar':
+        columns = columnar_columns(table)
+        if columns is not None:
+            yield from columnar_query_parts(table, columns)
+            return
+        log_print('debug', 'Batch can not be sent as columnar.  Falling back to json encoding.')
+
+    # same search as json.dumps(json.dumps(table)), escaping one row at a time.
+    yield '| makeresults | fields - _time | eval data="['
+    for (i, row) in enumerate(table):
+        if null_handling == 'client':
+            # a field that is not in the json is never created by spath, which is the same as setting it to null.
+            row = {key: value for (key, value) in row.items() if value is not None and value != ''}
+        yield json.dumps(json.dumps(row))[1:-1] if i == 0 else ', ' + json.dumps(json.dumps(row))[1:-1]
+    yield ']" | eval data=spath(data, "{}") | mvexpand data | spath input=data | fields - data'
+    if null_handling != 'client':
+        yield ' | foreach * [eval "<<FIELD>>"=if(\'<<FIELD>>\'="", null(), \'<<FIELD>>\')]'
+
+
+def build_query(table, encoding='json', null_handling='foreach'):
+    return ''.join(query_parts(table, encoding, null_handling))
+
+
+def columnar_columns(table):
+    # Returns the columns of the table, or None when a value or column name can not be passed through an spl string
+    # literal unchanged, in which case the batch is sent with the json encoding instead.
+    columns = []
+    for row in table:
+        for key in row:
+            if key is not None and key not in columns:
+                if any(character in key for character in COLUMNAR_UNSAFE_CHARACTERS):
+                    return None
+                columns.append(key)
+        for value in row.values():
+            if isinstance(value, str) and any(character in value for character in COLUMNAR_UNSAFE_VALUE_CHARACTERS):
+                return None
+    return columns
+
+
+def columnar_query_parts(table, columns):
+    # The column names are sent once in the eval that rebuilds the fields, and each row is sent as its values joined by
+    # a unit separator.  Every row starts with a separator so a row of empty values is never an empty string.
+    fields = ', '.join('"' + column + '"=nullif(mvindex(data, ' + str(i + 1) + '), "")'
+                       for (i, column) in enumerate(columns))
+
+    yield '| makeresults | fields - _time | eval data=split("'
+    for (i, row) in enumerate(table):
+        values = ['' if row.get(column) is None else str(row.get(column)) for column in columns]
+        yield ('' if i == 0 else COLUMNAR_RECORD_SEPARATOR) + \
+            spl_escape(COLUMNAR_UNIT_SEPARATOR + COLUMNAR_UNIT_SEPARATOR.join(values))
+    yield '", "' + COLUMNAR_RECORD_SEPARATOR + '") | mvexpand data | eval data=split(data, "' + \
+          COLUMNAR_UNIT_SEPARATOR + '") | eval ' + fields + ' | fields - data'
+
+
+def spl_escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def form_body_parts(search_parts, params):
+    # form encodes the search one piece at a time.  quote_plus encodes each character on its own, so this is the same
+    # body requests would build from the whole search.
+    yield b'search='
+    for part in search_parts:
+        yield urllib.parse.quote_plus(part).encode('ascii')
+    yield b'&' + urllib.parse.urlencode(params).encode('ascii')
+
+
+class StreamedBody:
+    # Request body that is encoded again each time it is read, so no full copy of the body is held in memory.
+    # requests takes the length from __len__ and sends a Content-Length header instead of a chunked body.
+    def __init__(self, parts, length):
+        self.parts = parts
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return iter(self.parts())
+
+
+def request_body(parts, length, content_type, compress=False):
+    # parts is called to get a fresh iterator of the body in bytes.  A compressed body has to be built in full to know
+    # its length, but it is only a fraction of the size of the uncompressed body.
+    headers = {'Content-Type': content_type}
+    if compress:
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, GZIP_WBITS)
+        body = b''.join(compressor.compress(part) for part in parts()) + compressor.flush()
+        headers['Content-Encoding'] = 'gzip'
+        return body, headers
+    return StreamedBody(parts, length), headers
+
+
+def compression_supported(splunk_host, auths, cert_info, session):
+    # splunkd versions differ on whether they accept gzip request bodies, so a tiny compressed search is sent first.
+    query = urllib.parse.urlencode({'search': '| makeresults | eval probe="gzip" | table probe',
+                                    'exec_mode': 'oneshot', 'output_mode': 'json'}).encode('ascii')
+    body, headers = request_body(lambda: [query], len(query), 'application/x-www-form-urlencoded', compress=True)
+    try:
+        r = session.post(splunkd_url(splunk_host) + '/services/search/jobs', data=body, headers=headers,
+                         auth=auths, verify=cert_info)
+        if r.status_code < 300 and r.json()['results'][0]['probe'] == 'gzip':
+            log_print('info', 'Search head accepts gzip compressed requests.  Compressing request bodies.')
+            return True
+    except Exception as e:
+        log_print('debug', 'Compressed probe search failed with ' + str(e))
+    log_print('warn', 'Search head does not accept gzip compressed requests.  Sending request bodies uncompressed.')
+    return False
+
+
+def measure_body(table, encoding, null_handling):
+    # Peak python memory used to build the request body the old way, as one search and one form encoded string, against
+    # streaming it and compressing it.  The body is only built, nothing is sent.
+    tail = ' | outputlookup append=true benchmark.csv'
+    params = {'exec_mode': 'oneshot', 'output_mode': 'json', 'count': 0}
+    parts = lambda: form_body_parts(chain(query_parts(table, encoding, null_handling), [tail]), params)
+    tracemalloc.start()
+    try:
+        buffered = urllib.parse.urlencode(dict(search=build_query(table, encoding, null_handling) + tail, **params))
+        body_bytes = len(buffered)
+        buffered = None
+        buffered_peak = tracemalloc.get_traced_memory()[1]
+
+        tracemalloc.reset_peak()
+        for part in StreamedBody(parts, body_bytes):
+            pass
+        streamed_peak = tracemalloc.get_traced_memory()[1]
+
+        tracemalloc.reset_peak()
+        compressed = request_body(parts, body_bytes, 'application/x-www-form-urlencoded', compress=True)[0]
+        compressed_bytes = len(compressed)
+        compressed = None
+        compressed_peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'body_bytes': body_bytes, 'compressed_bytes': compressed_bytes, 'buffered_peak': buffered_peak,
+            'streamed_peak': streamed_peak, 'compressed_peak': compressed_peak}
+
+
+def benchmark_encodings(table, splunk_host, auths, cert_info, session, benchmark_runs=3):
+    # The rebuilt rows are counted instead of written to the lookup, so the benchmark does not change any data.  Each
+    # search runs as a blocking job, which is the same search a oneshot runs, so its runDuration can be read back.
+    url = splunkd_url(splunk_host) + '/services/search/jobs'
+    log_print('info', 'Benchmarking encodings on a batch of ' + str(len(table)) + ' row(s).')
+    for (encoding, null_handling) in BENCHMARK_VARIANTS:
+        variant = encoding if encoding != 'json' else encoding + ' with ' + null_handling + ' null handling'
+        query = build_query(table, encoding, null_handling) + ' | stats count'
+        query_bytes = len(query.encode('utf-8'))
+        # the search is form encoded in the request body, so that is the size that goes over the network.
+        wire_bytes = len(urllib.parse.urlencode({'search': query}))
+        run_durations = []
+        for run in range(benchmark_runs):
+            job = request(url, auths, {'search': query, 'exec_mode': 'blocking', 'output_mode': 'json'}, cert_info,
+                          session)
+            job_url = url + '/' + urllib.parse.quote(job['sid'])
+            status = request(job_url + '?output_mode=json', auths, None, cert_info, session, method='get')
+            run_durations.append(float(status['entry'][0]['content']['runDuration']))
+            request(job_url, auths, None, cert_info, session, method='delete')
+        log_print('info', 'Encoding ' + variant + ': ' + str(query_bytes) + ' search bytes (' +
+                  '{:.1f}'.format(query_bytes / len(table)) + ' bytes/row), ' + str(wire_bytes) + ' request bytes (' +
+                  '{:.1f}'.format(wire_bytes / len(table)) + ' bytes/row), best run duration of ' +
+                  '{:.3f}'.format(min(run_durations)) + ' seconds, mean of ' +
+                  '{:.3f}'.format(sum(run_durations) / len(run_durations)) + ' seconds over ' + str(benchmark_runs) +
+                  ' run(s).')
+        body = measure_body(table, encoding, null_handling)
+        log_print('info', 'Encoding ' + variant + ' request body: ' + str(body['body_bytes']) + ' bytes uncompressed, ' +
+                  str(body['compressed_bytes']) + ' bytes gzip compressed.  Client memory to build it: ' +
+                  str(body['buffered_peak']) + ' bytes buffered, ' + str(body['streamed_peak']) + ' bytes streamed, ' +
+                  str(body['compressed_peak']) + ' bytes compressed.')
+
+
+def batch_processor(table, splunk_csv_name, splunk_host, splunk_user, splunk_pw, cert_info, session=None, sizer=None,
+                    batch_bytes=None, encoding='json', null_handling='foreach', compress=False, jobs=None,
+                    journal=None, row_offset=None):
+    # journal is called with the end of each part of a split batch once it is appended, as an offset into the batch.
+    # row_offset is where this part starts in the batch, and is None for a batch that has not been split.
+    tail = ' | outputlookup append=true ' + splunk_csv_name
+    params = {'exec_mode': 'oneshot' if jobs is None else 'normal',
+              'output_mode': 'json',
+              'count': 0}
+
+    # measuring the search and the form encoded body in one pass without building either of them.  quote_plus writes
+    # every byte of the search as one character or as a three character %XX escape, so the search length is the
+    # encoded length less two for each escape.  The body is the encoded search between search= and the params, the same
+    # as form_body_parts.
+    query_bytes = 0
+    body_bytes = len('search=&' + urllib.parse.urlencode(params))
+    for part in chain(query_parts(table, encoding, null_handling), [tail]):
+        part = urllib.parse.quote_plus(part)
+        body_bytes += len(part)
+        query_bytes += len(part) - 2 * part.count('%')
+
+    if batch_bytes is not None and query_bytes > batch_bytes:
+        if len(table) > 1:
+            parts = math.ceil(query_bytes / batch_bytes)
+            log_print('info', 'Batch of ' + str(len(table)) + ' row(s) encodes to ' + str(query_bytes) + ' bytes which '
+                              'is over batch_bytes of ' + str(batch_bytes) + '.  Splitting it into ' + str(parts) +
+                              ' parts.')
+            split_batch(table, parts, splunk_csv_name, splunk_host, splunk_user, splunk_pw, cert_info, session, sizer,
+                        batch_bytes, encoding, null_handling, compress, jobs, journal, row_offset)
+            return
+        log_print('warn', 'A single row encodes to ' + str(query_bytes) + ' bytes which is over batch_bytes of ' +
+                          str(batch_bytes) + '.  Sending it anyway.')
+
+    spl_search_request, headers = request_body(
+        lambda: form_body_parts(chain(query_parts(table, encoding, null_handling), [tail]), params), body_bytes,
+        'application/x-www-form-urlencoded', compress)
+
+    log_print('info', 'Sending CSV batch upload to Splunk (' + str(body_bytes) + ' bytes, ' +
+              str(len(spl_search_request)) + ' bytes on the wire).')
+
+    # a batch that splunk rejects is split in two and retried instead of stopping the upload.
+    if jobs is None:
+        spl_search_post = request(splunkd_url(splunk_host) + '/services/search/jobs',
+                                  HTTPBasicAuth(splunk_user, splunk_pw),
+                                  spl_search_request, cert_info, session, headers=headers, allow_split=len(table) > 1)
+    else:
+        spl_search_post = jobs.run(splunk_host, HTTPBasicAuth(splunk_user, splunk_pw), spl_search_request, cert_info,
+                                   session, headers, allow_split=len(table) > 1)
+
+    if spl_search_post is None:
+        split_batch(table, 2, splunk_csv_name, splunk_host, splunk_user, splunk_pw, cert_info, session, sizer,
+                    batch_bytes, encoding, null_handling, compress, jobs, journal, row_offset)
+        return
+
+    if journal is not None and row_offset is not None:
+        journal(row_offset + len(table))
     log_print('info', 'CSV batch upload completed successfully.')
 
 
-def request(url, auths, payload, cert_info):
+def split_batch(table, parts, splunk_csv_name, splunk_host, splunk_user, splunk_pw, cert_info, session, sizer,
+                batch_bytes, encoding, null_handling, compress, jobs=None, journal=None, row_offset=None):
+    part_size = math.ceil(len(table) / parts)
+    if sizer is not None:
+        sizer.shrink(part_size)
+    for i in range(0, len(table), part_size):
+        batch_processor(table[i:i + part_size], splunk_csv_name, splunk_host, splunk_user, splunk_pw, cert_info,
+                        session, sizer, batch_bytes, encoding, null_handling, compress, jobs, journal,
+                        (row_offset or 0) + i)
+
+
+class SearchJobs:
+    # Runs batch searches as normal search jobs.  The post returns as soon as the job is dispatched and the job is then
+    # polled until it is done, which frees the connection while splunk runs it.  No more than max_jobs jobs are
+    # dispatched and not yet finished at any time, so the upload stays inside the user's search quota.
+    def __init__(self, max_jobs):
+        self.slots = threading.BoundedSemaphore(max_jobs)
+
+    def run(self, splunk_host, auths, payload, cert_info, session, headers=None, allow_split=False):
+        url = splunkd_url(splunk_host) + '/services/search/jobs'
+        with self.slots:
+            job = request(url, auths, payload, cert_info, session, headers=headers, allow_split=allow_split)
+            if job is None:
+                return None
+            job_url = url + '/' + urllib.parse.quote(job['sid'])
+            interval = JOB_POLL_INTERVALS[0]
+            while True:
+                status = request(job_url + '?output_mode=json', auths, None, cert_info, session, method='get')
+                content = status['entry'][0]['content']
+                if content.get('isFailed') or content.get('dispatchState') == 'FAILED':
+                    log_print('error', 'Search job ' + job['sid'] + ' failed! Messages: ' +
+                              str(content.get('messages')))
+                    sys.exit()
+                if content.get('isDone') or content.get('dispatchState') == 'DONE':
+                    break
+                time.sleep(interval)
+                interval = min(interval * 2, JOB_POLL_INTERVALS[1])
+            # the job results are not needed, so the job is removed instead of holding disk quota until it expires.
+            request(job_url, auths, None, cert_info, session, method='delete')
+            return content
+
+
+def kvstore_batch_limit(splunk_host, auths, cert_info, session):
+    # batch_save rejects requests with more documents than max_documents_per_batch_save in limits.conf.
+    try:
+        r = session.get(splunkd_url(splunk_host) + '/services/configs/conf-limits/kvstore',
+                        params={'output_mode': 'json'}, auth=auths, verify=cert_info)
+        if r.status_code < 300:
+            return int(r.json()['entry'][0]['content']['max_documents_per_batch_save'])
+        log_print('warn', 'Unable to read max_documents_per_batch_save from limits.conf. Result: '
+                  + str(r.status_code) + ' ' + str(r.reason) + '.  Using the default of 1000.')
+    except Exception as e:
+        log_print('warn', 'Unable to read max_documents_per_batch_save from limits.conf.  Using the default of 1000. '
+                  + str(e))
+    return 1000
+
+
+def kvstore_batch_processor(table, kv_url, splunk_user, splunk_pw, cert_info, max_documents, session=None,
+                            compress=False):
+    # empty csv cells are left out of the document so they are stored as nulls, same as the lookup upload.
+    documents = [{key: value for (key, value) in row.items() if value != ''} for row in table]
+
+    # clearing memory
+    table = None
+
+    for i in range(0, len(documents), max_documents):
+        chunk = documents[i:i + max_documents]
+        parts = lambda: chain([b'['], ((b'' if j == 0 else b', ') + json.dumps(document).encode('utf-8')
+                                       for (j, document) in enumerate(chunk)), [b']'])
+        body_bytes = sum(len(part) for part in parts())
+        payload, headers = request_body(parts, body_bytes, 'application/json', compress)
+        log_print('info', 'Sending ' + str(len(chunk)) + ' record(s) to KV Store batch_save (' + str(body_bytes) +
+                  ' bytes, ' + str(len(payload)) + ' bytes on the wire).')
+        kv_batch_save = request(kv_url + '/batch_save', HTTPBasicAuth(splunk_user, splunk_pw), payload,
+                                cert_info, session, headers=headers)
+
+    log_print('info', 'KV Store batch upload completed successfully.')
+
+
+class HecSender:
+    # Sends csv rows as json events to the HTTP Event Collector.  Each batch is cut into requests of at most
+    # batch_bytes of newline separated events.  With ack turned on every request of a batch is sent before any is
+    # waited on, and then their ack ids are polled together on the ack endpoint of the run's channel until they are
+    # indexed.  Requests that are not are sent again, so an event may be indexed twice but never lost.
+    def __init__(self, hec_url, hec_token, cert_info, session, batch_bytes, compress=False, ack=False, metadata=None):
+        self.hec_url = hec_url
+        self.cert_info = cert_info
+        self.session = session
+        self.batch_bytes = batch_bytes
+        self.compress = compress
+        self.ack = ack
+        self.metadata = {key: value for (key, value) in (metadata or {}).items() if value}
+        self.headers = {'Authorization': 'Splunk ' + hec_token,
+                        'X-Splunk-Request-Channel': str(uuid.uuid4())}
+        self.lock = threading.Lock()
+        self.events = 0
+        self.body_bytes = 0
+        self.wire_bytes = 0
+        self.retries = 0
+        self.start = time.time()
+
+    def send_batch(self, table):
+        # empty csv cells are left out of the event, same as the KV Store upload.
+        pending = []
+        chunk = []
+        chunk_bytes = 0
+        for row in table:
+            event = dict(self.metadata, event={key: value for (key, value) in row.items() if value != ''})
+            line = json.dumps(event).encode('utf-8') + b'\n'
+            if len(chunk) > 0 and chunk_bytes + len(line) > self.batch_bytes:
+                pending.extend(self.send(chunk))
+                chunk = []
+                chunk_bytes = 0
+            chunk.append(line)
+            chunk_bytes += len(line)
+        if len(chunk) > 0:
+            pending.extend(self.send(chunk))
+
+        # clearing memory
+        table = None
+
+        # the batch only counts as done once every event in it is indexed, so a resume never skips lost events.
+        if len(pending) > 0:
+            self.wait_for_acks(pending)
+
+        log_print('info', 'HTTP Event Collector batch upload completed successfully.')
+
+    def send(self, lines):
+        # Returns the ack id, lines and sizes of each request that is waiting to be acknowledged.
+        body_bytes = sum(len(line) for line in lines)
+        for attempt in range(HEC_RETRIES + 1):
+            if attempt > 0:
+                with self.lock:
+                    self.retries += 1
+                time.sleep(min(2 ** attempt, 30))
+            payload, headers = request_body(lambda: iter(lines), body_bytes, 'application/json', self.compress)
+            headers.update(self.headers)
+            log_print('info', 'Sending ' + str(len(lines)) + ' event(s) to the HTTP Event Collector (' +
+                      str(body_bytes) + ' bytes, ' + str(len(payload)) + ' bytes on the wire).')
+            try:
+                r = self.session.post(self.hec_url + '/services/collector/event', data=payload, headers=headers,
+                                      verify=self.cert_info)
+            except requests.exceptions.ConnectionError as e:
+                log_print('warn', 'HTTP Event Collector request failed with ' + str(e) + '  Retrying.')
+                continue
+            if r.status_code == 413 and len(lines) > 1:
+                log_print('warn', 'HTTP Event Collector rejected ' + str(body_bytes) + ' bytes as too large.  '
+                                  'Splitting batch.')
+                return self.send(lines[:len(lines) // 2]) + self.send(lines[len(lines) // 2:])
+            if r.status_code in HEC_RETRY_STATUS_CODES:
+                log_print('warn', 'HTTP Event Collector is busy. Result: ' + str(r.status_code) + ' ' + str(r.reason) +
+                          ' ' + str(r.text)[:500] + '  Retrying.')
+                continue
+            if r.status_code >= 300:
+                log_print('error', 'POST Request to ' + self.hec_url + '/services/collector/event failed! Result: ' +
+                          str(r.status_code) + ' ' + str(r.reason) + ' ' + str(r.text))
+                sys.exit()
+            if self.ack:
+                return [(r.json()['ackId'], lines, body_bytes, len(payload))]
+            self.count(len(lines), body_bytes, len(payload))
+            return []
+        log_print('error', 'Unable to send events to the HTTP Event Collector after ' + str(HEC_RETRIES) +
+                  ' retries.')
+        sys.exit()
+
+    def wait_for_acks(self, pending):
+        for attempt in range(HEC_RETRIES + 1):
+            if attempt > 0:
+                log_print('warn', str(len(pending)) + ' request(s) were not acknowledged within ' +
+                          str(HEC_ACK_TIMEOUT) + ' seconds.  Sending them again.')
+                with self.lock:
+                    self.retries += len(pending)
+                pending = [request for (ack_id, lines, body_bytes, wire_bytes) in pending
+                           for request in self.send(lines)]
+            deadline = time.time() + HEC_ACK_TIMEOUT
+            interval = JOB_POLL_INTERVALS[0]
+            while time.time() < deadline:
+                time.sleep(interval)
+                interval = min(interval * 2, JOB_POLL_INTERVALS[1])
+                acks = self.acknowledged([ack_id for (ack_id, lines, body_bytes, wire_bytes) in pending])
+                for (ack_id, lines, body_bytes, wire_bytes) in pending:
+                    if acks.get(str(ack_id)):
+                        self.count(len(lines), body_bytes, wire_bytes)
+                pending = [request for request in pending if not acks.get(str(request[0]))]
+                if len(pending) == 0:
+                    return
+        log_print('error', 'Events were not acknowledged by the HTTP Event Collector after ' + str(HEC_RETRIES) +
+                  ' retries.')
+        sys.exit()
+
+    def acknowledged(self, ack_ids):
+        # Returns the status of every ack id, checked in one request.
+        try:
+            r = self.session.post(self.hec_url + '/services/collector/ack', json={'acks': ack_ids},
+                                  headers=self.headers, verify=self.cert_info)
+            if r.status_code < 300:
+                return r.json()['acks']
+            log_print('debug', 'Acknowledgment check failed. Result: ' + str(r.status_code) + ' ' + str(r.reason))
+        except Exception as e:
+            log_print('debug', 'Acknowledgment check failed with ' + str(e))
+        return {}
+
+    def count(self, events, body_bytes, wire_bytes):
+        with self.lock:
+            self.events += events
+            self.body_bytes += body_bytes
+            self.wire_bytes += wire_bytes
+
+    def log_summary(self):
+        elapsed = time.time() - self.start
+        log_print('info', 'Sent ' + str(self.events) + ' event(s) to the HTTP Event Collector in ' +
+                  '{:.2f}'.format(elapsed) + ' seconds (' + str(int(self.events / elapsed) if elapsed > 0 else 0) +
+                  ' events/sec, ' + str(self.body_bytes) + ' bytes, ' + str(self.wire_bytes) + ' bytes on the wire, ' +
+                  str(self.retries) + ' retries).')
+
+
+def request(url, auths, payload, cert_info, session=None, method='post', headers=None, allow_split=False):
     try:
-        r = requests.post(url, data=payload, auth=auths, verify=cert_info)
-        if r.status_code >= 300:
-            log_print('error', 'POST Request to ' + url + ' failed! Result: ' + str(r.status_code)
+        r = (session or requests).request(method, url, data=payload, headers=headers, auth=auths, verify=cert_info)
+        if allow_split and (r.status_code in SPLIT_STATUS_CODES or
+                            (r.status_code == 400 and SPLIT_MESSAGE_PATTERN.search(r.text))):
+            log_print('warn', method.upper() + ' Request to ' + url + ' was rejected as too large. Result: '
+                      + str(r.status_code) + ' ' + str(r.reason) + ' ' + str(r.text)[:500] + '  Splitting batch.')
+            return None
+        elif r.status_code >= 300:
+            log_print('error', method.upper() + ' Request to ' + url + ' failed! Result: ' + str(r.status_code)
                       + ' ' + str(r.reason) + ' ' + str(r.text))
             sys.exit()
+        elif len(r.content) == 0:
+            return {}
         else:
             response_body = r.json()
             return response_body
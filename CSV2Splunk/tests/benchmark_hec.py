@@ -0,0 +1,73 @@
+# Copyright 2021 Paychex, Inc.
+# Licensed pursuant to the terms of the Apache License, Version 2.0 (the "License");
+# your use of the Work is subject to the terms and conditions of the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Disclaimer of Warranty. Unless required by applicable law or agreed to in writing, Licensor
+# provides the Work (and each Contributor provides its Contributions) on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied, including,
+# without limitation, any warranties or conditions of TITLE, NON-INFRINGEMENT,
+# MERCHANTABILITY, OR FITNESS FOR A PARTICULAR PURPOSE. You are solely responsible
+# for determining the appropriateness of using or redistributing the Work and assume
+# any risks associated with your exercise of permissions under this License.
+
+# Throughput of -target hec in events/sec against the fake HTTP Event Collector, with and without indexer
+# acknowledgment.  The rows are generated, so only the client and the loopback connection are measured.
+#
+# python CSV2Splunk/tests/benchmark_hec.py -rows 200000 -workers 4 -ack_delay 0.5
+import argparse, csv, os, subprocess, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_hec import FakeHec
+from fake_splunkd import make_certificate
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'CSV2Splunk.py')
+TOKEN = '11111111-2222-3333-4444-555555555555'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark CSV2Splunk -target hec against the fake collector.')
+    parser.add_argument('-rows', type=int, default=200000)
+    parser.add_argument('-workers', type=int, default=4)
+    parser.add_argument('-batch_size', type=int, default=10000)
+    parser.add_argument('-batch_bytes', type=int, default=1000000)
+    parser.add_argument('-ack_delay', type=float, default=0.5,
+                        help='Seconds the fake collector takes to acknowledge a request.')
+    parser.add_argument('-compress', choices=['Y', 'N'], default='N')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        csv_file = os.path.join(directory, 'benchmark.csv')
+        with open(csv_file, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(['id', 'host', 'status', 'bytes', 'message'])
+            for i in range(args.rows):
+                writer.writerow([str(i), 'web' + str(i % 50), str(200 + i % 5), str(i * 7 % 100000),
+                                 'request ' + str(i) + ' served'])
+
+        for ack in ('N', 'Y'):
+            server = FakeHec(make_certificate(directory), port=0, token=TOKEN, ack_delay=args.ack_delay).start()
+            start = time.time()
+            result = subprocess.run([sys.executable, SCRIPT, '-splunk_host', '127.0.0.1', '-splunk_user', 'admin',
+                                     '-splunk_pw', 'changeme', '-cert_location', 'False', '-source_csv_file', csv_file,
+                                     '-splunk_csv_name', 'benchmark.csv', '-target', 'hec', '-hec_token', TOKEN,
+                                     '-hec_port', str(server.server_address[1]), '-hec_ack', ack,
+                                     '-workers', str(args.workers), '-batch_size', str(args.batch_size),
+                                     '-batch_bytes', str(args.batch_bytes), '-compress', args.compress],
+                                    cwd=directory, capture_output=True, text=True)
+            elapsed = time.time() - start
+            server.stop()
+            if result.returncode != 0 or server.events != args.rows:
+                print(result.stdout[-2000:] + result.stderr[-2000:])
+                sys.exit('Upload with hec_ack ' + ack + ' failed.')
+            requests = [path for (path, length) in server.requests]
+            print('hec_ack ' + ack + ': ' + str(args.rows) + ' events in ' + '{:.2f}'.format(elapsed) + ' seconds, ' +
+                  str(int(args.rows / elapsed)) + ' events/sec, ' +
+                  str(requests.count('/services/collector/event')) + ' event request(s), ' +
+                  str(requests.count('/services/collector/ack')) + ' ack request(s).')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+# Copyright 2021 Paychex, Inc.
+# Licensed pursuant to the terms of the Apache License, Version 2.0 (the "License");
+# your use of the Work is subject to the terms and conditions of the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Disclaimer of Warranty. Unless required by applicable law or agreed to in writing, Licensor
+# provides the Work (and each Contributor provides its Contributions) on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied, including,
+# without limitation, any warranties or conditions of TITLE, NON-INFRINGEMENT,
+# MERCHANTABILITY, OR FITNESS FOR A PARTICULAR PURPOSE. You are solely responsible
+# for determining the appropriateness of using or redistributing the Work and assume
+# any risks associated with your exercise of permissions under this License.
+
+# Stand-in for the HTTP Event Collector, so -target hec can be checked and benchmarked without an indexer.  It serves
+# /services/collector/event and /services/collector/ack, counts the events it is sent and records every request.  An
+# event request is only acknowledged ack_delay seconds after it arrived, like an indexer that is still writing it.
+# Run it on its own to point CSV2Splunk at it by hand:
+#
+# python fake_hec.py -port 8088 -token 00000000-0000-0000-0000-000000000000 -ack_delay 1
+# python ../CSV2Splunk.py -splunk_host 127.0.0.1 -cert_location False -target hec -hec_port 8088 ...
+import argparse, gzip, json, ssl, tempfile, threading, time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from fake_splunkd import make_certificate
+
+
+class FakeHecHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self, status, content):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        if self.headers.get('Authorization') != 'Splunk ' + self.server.token:
+            self.reply(403, {'text': 'Invalid token', 'code': 4})
+            return
+        with self.server.lock:
+            self.server.requests.append((self.path, len(body)))
+
+        if self.path == '/services/collector/ack':
+            now = time.monotonic()
+            with self.server.lock:
+                acks = {str(ack_id): ack_id in self.server.acks and now >= self.server.acks[ack_id]
+                        for ack_id in json.loads(body)['acks']}
+            self.reply(200, {'acks': acks})
+        elif self.path == '/services/collector/event':
+            if len(body) > self.server.max_content_length:
+                self.reply(413, {'text': 'Content too large', 'code': 27})
+                return
+            events = len([line for line in body.splitlines() if line.strip()])
+            with self.server.lock:
+                self.server.events += events
+                self.server.ack_id += 1
+                ack_id = self.server.ack_id
+                self.server.acks[ack_id] = time.monotonic() + self.server.ack_delay
+            self.reply(200, {'text': 'Success', 'code': 0, 'ackId': ack_id})
+        else:
+            self.reply(404, {'text': 'The requested URL was not found on this server.', 'code': 404})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeHec(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, certificate, port=8088, token='00000000-0000-0000-0000-000000000000', ack_delay=0,
+                 max_content_length=1000000):
+        super().__init__(('127.0.0.1', port), FakeHecHandler)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certificate)
+        self.socket = context.wrap_socket(self.socket, server_side=True)
+        self.token = token
+        self.ack_delay = ack_delay
+        self.max_content_length = max_content_length
+        self.lock = threading.Lock()
+        self.requests = []
+        self.events = 0
+        self.ack_id = 0
+        self.acks = {}
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stand-in for the HTTP Event Collector used by CSV2Splunk.')
+    parser.add_argument('-port', type=int, default=8088)
+    parser.add_argument('-token', default='00000000-0000-0000-0000-000000000000')
+    parser.add_argument('-ack_delay', type=float, default=0)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        server = FakeHec(make_certificate(directory), args.port, args.token, args.ack_delay)
+        print('Listening on https://127.0.0.1:' + str(args.port) + '.')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
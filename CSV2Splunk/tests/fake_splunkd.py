@@ -0,0 +1,224 @@
+# Copyright 2021 Paychex, Inc.
+# Licensed pursuant to the terms of the Apache License, Version 2.0 (the "License");
+# your use of the Work is subject to the terms and conditions of the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Disclaimer of Warranty. Unless required by applicable law or agreed to in writing, Licensor
+# provides the Work (and each Contributor provides its Contributions) on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied, including,
+# without limitation, any warranties or conditions of TITLE, NON-INFRINGEMENT,
+# MERCHANTABILITY, OR FITNESS FOR A PARTICULAR PURPOSE. You are solely responsible
+# for determining the appropriateness of using or redistributing the Work and assume
+# any risks associated with your exercise of permissions under this License.
+
+# Stand-in for the splunkd REST endpoints CSV2Splunk uses, so uploads can be checked without a search head.  It serves
+# the search jobs endpoint, the kvstore stanza of limits.conf and the KV Store data endpoints, and records every request
+# it is sent.  The searches CSV2Splunk builds to append to, truncate and delete from a lookup are run against lookups
+# kept in memory.  Run it on its own to point CSV2Splunk at it by hand:
+#
+# python fake_splunkd.py -port 8089 -max_documents 1000
+# python ../CSV2Splunk.py -splunk_host 127.0.0.1:8089 -cert_location False -target kvstore ...
+import argparse, gzip, hashlib, json, os, re, ssl, subprocess, tempfile, threading, time, urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+APPEND_PATTERN = re.compile(r'(.*) \| outputlookup append=true (\S+)', re.S)
+TRUNCATE_PATTERN = re.compile(r'\| outputlookup (\S+)')
+DELETE_PATTERN = re.compile(r'\| inputlookup (\S+) \| eval _delta_key=md5\((.*)\) \| where NOT in\(_delta_key, (.*)\) '
+                            r'\| fields - _delta_key \| outputlookup \1', re.S)
+JSON_PATTERN = re.compile(r'\| makeresults \| fields - _time \| eval data="(.*)" \| eval data=spath\(data, "\{\}"\) '
+                          r'\| mvexpand data \| spath input=data \| fields - data( \| foreach .*)?', re.S)
+COLUMNAR_PATTERN = re.compile(r'\| makeresults \| fields - _time \| eval data=split\("(.*)", "\u241e"\) '
+                              r'\| mvexpand data \| eval data=split\(data, "\u241f"\) \| eval (.*) '
+                              r'\| fields - data', re.S)
+
+
+def makeresults_rows(search):
+    # Rows made by the makeresults search of a batch, with empty and null fields left out the way outputlookup writes
+    # them as empty cells.
+    match = JSON_PATTERN.fullmatch(search)
+    if match is not None:
+        rows = json.loads(json.loads('"' + match.group(1) + '"'))
+    else:
+        match = COLUMNAR_PATTERN.fullmatch(search)
+        if match is None:
+            raise ValueError('Not a batch search: ' + search[:200])
+        columns = [(column, int(index)) for (column, index)
+                   in re.findall(r'"([^"]*)"=nullif\(mvindex\(data, (\d+)\), ""\)', match.group(2))]
+        records = re.sub(r'\\(.)', r'\1', match.group(1), flags=re.S).split('\u241e')
+        rows = [dict((column, values[index]) for (column, index) in columns)
+                for values in (record.split('\u241f') for record in records)]
+    return [dict((key, value) for (key, value) in row.items() if value is not None and value != '') for row in rows]
+
+
+def make_certificate(directory):
+    # Writes a self signed certificate and key for 127.0.0.1 and returns the path of the pem holding both.
+    path = os.path.join(directory, 'fake_splunkd.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=127.0.0.1',
+                    '-keyout', path, '-out', path], check=True, capture_output=True)
+    return path
+
+
+class FakeSplunkdHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def read_body(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return body
+
+    def reply(self, status, content=None):
+        body = b'' if content is None else json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def record(self, body=b''):
+        with self.server.lock:
+            self.server.requests.append((self.command, urllib.parse.urlparse(self.path).path, body))
+
+    def collection(self, path):
+        # /servicesNS/<owner>/<app>/storage/collections/data/<collection>[/batch_save]
+        parts = path.split('/')
+        if len(parts) >= 8 and parts[4:7] == ['storage', 'collections', 'data']:
+            return urllib.parse.unquote(parts[7]), parts[8:]
+        return None, None
+
+    def do_GET(self):
+        path = urllib.parse.urlparse(self.path).path
+        self.record()
+        if path == '/services/configs/conf-limits/kvstore':
+            self.reply(200, {'entry': [{'content': {'max_documents_per_batch_save': self.server.max_documents}}]})
+        elif path.startswith('/services/search/jobs/'):
+            self.reply(200, {'entry': [{'content': {'dispatchState': 'DONE', 'isDone': True, 'isFailed': False,
+                                                    'runDuration': 0.1, 'messages': []}}]})
+        else:
+            self.reply(404, {'messages': [{'type': 'ERROR', 'text': 'Not found.'}]})
+
+    def do_POST(self):
+        path = urllib.parse.urlparse(self.path).path
+        body = self.read_body()
+        self.record(body)
+        (name, rest) = self.collection(path)
+        if name is not None and rest == ['batch_save']:
+            documents = json.loads(body)
+            if len(documents) > self.server.max_documents:
+                self.reply(400, {'messages': [{'type': 'ERROR', 'text': 'Request exceeds the maximum number of '
+                                               'documents per batch save.'}]})
+                return
+            with self.server.lock:
+                self.server.collections.setdefault(name, []).extend(documents)
+            self.reply(200, [str(i) for i in range(len(documents))])
+        elif path == '/services/search/jobs':
+            form = urllib.parse.parse_qs(body.decode('ascii'))
+            search = form.get('search', [''])[0]
+            if self.server.max_search_bytes is not None and len(search.encode('utf-8')) > self.server.max_search_bytes:
+                if self.server.too_large_status == 400:
+                    self.reply(400, {'messages': [{'type': 'FATAL', 'text': 'Search string exceeds the maximum '
+                                                   'length.'}]})
+                else:
+                    self.reply(self.server.too_large_status, {'messages': [{'type': 'FATAL',
+                                                                            'text': 'Request entity too large.'}]})
+                return
+            if 'probe=' in search:
+                self.reply(200, {'results': [{'probe': 'gzip'}]})
+                return
+            failure = self.run_search(search)
+            if failure is not None:
+                self.reply(failure[0], {'messages': [{'type': 'FATAL', 'text': failure[1]}]})
+            elif form.get('exec_mode', [''])[0] in ('blocking', 'normal'):
+                self.reply(201, {'sid': 'fake_' + str(time.time_ns())})
+            else:
+                self.reply(200, {'results': []})
+        else:
+            self.reply(404, {'messages': [{'type': 'ERROR', 'text': 'Not found.'}]})
+
+    def run_search(self, search):
+        # Applies an append, truncate or delete search to the lookups.  Returns the (status, message) of an append
+        # that fail_appends says to fail, which leaves the lookup as it was.
+        with self.server.lock:
+            match = APPEND_PATTERN.fullmatch(search)
+            if match is not None:
+                self.server.appends += 1
+                if self.server.appends in self.server.fail_appends:
+                    return self.server.fail_appends[self.server.appends]
+                self.server.lookups.setdefault(match.group(2), []).extend(makeresults_rows(match.group(1)))
+                return None
+            match = TRUNCATE_PATTERN.fullmatch(search)
+            if match is not None:
+                self.server.lookups[match.group(1)] = []
+                return None
+            match = DELETE_PATTERN.fullmatch(search)
+            if match is not None:
+                fields = re.findall(r"coalesce\('([^']*)', \"\"\)", match.group(2))
+                keys = set(re.findall(r'"([0-9a-f]{32})"', match.group(3)))
+                self.server.lookups[match.group(1)] = [
+                    row for row in self.server.lookups.get(match.group(1), [])
+                    if hashlib.md5('\u241f'.join(row.get(field, '') for field in fields).encode('utf-8')).hexdigest()
+                    not in keys]
+        return None
+
+    def do_DELETE(self):
+        path = urllib.parse.urlparse(self.path).path
+        self.record()
+        (name, rest) = self.collection(path)
+        if name is not None and rest == []:
+            with self.server.lock:
+                self.server.collections[name] = []
+        self.reply(200)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeSplunkd(ThreadingHTTPServer):
+    # splunkd on https://127.0.0.1, on a free port unless one is given.  host is the -splunk_host that reaches it.
+    # max_documents is returned as max_documents_per_batch_save and a batch_save with more documents is refused the way
+    # splunkd refuses it.  A search over max_search_bytes is refused with too_large_status, and fail_appends maps the
+    # number of an append search, counting from 1, to the (status, message) it is refused with.  lookups holds the rows
+    # of each lookup by name.
+    daemon_threads = True
+
+    def __init__(self, certificate, port=0, max_documents=1000, max_search_bytes=None, too_large_status=413,
+                 fail_appends=None):
+        super().__init__(('127.0.0.1', port), FakeSplunkdHandler)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certificate)
+        self.socket = context.wrap_socket(self.socket, server_side=True)
+        self.max_documents = max_documents
+        self.max_search_bytes = max_search_bytes
+        self.too_large_status = too_large_status
+        self.fail_appends = fail_appends or {}
+        self.appends = 0
+        self.lookups = {}
+        self.lock = threading.Lock()
+        self.requests = []
+        self.collections = {}
+        self.host = '127.0.0.1:' + str(self.server_address[1])
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stand-in for the splunkd endpoints used by CSV2Splunk.')
+    parser.add_argument('-port', type=int, default=8089)
+    parser.add_argument('-max_documents', type=int, default=1000)
+    parser.add_argument('-max_search_bytes', type=int, default=None)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        server = FakeSplunkd(make_certificate(directory), args.port, args.max_documents, args.max_search_bytes)
+        print('Listening on https://' + server.host + '.')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,97 @@
+# Copyright 2021 Paychex, Inc.
+# Licensed pursuant to the terms of the Apache License, Version 2.0 (the "License");
+# your use of the Work is subject to the terms and conditions of the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Disclaimer of Warranty. Unless required by applicable law or agreed to in writing, Licensor
+# provides the Work (and each Contributor provides its Contributions) on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied, including,
+# without limitation, any warranties or conditions of TITLE, NON-INFRINGEMENT,
+# MERCHANTABILITY, OR FITNESS FOR A PARTICULAR PURPOSE. You are solely responsible
+# for determining the appropriateness of using or redistributing the Work and assume
+# any risks associated with your exercise of permissions under this License.
+
+# Runs CSV2Splunk with -target lookup against the fake splunkd and checks that a batch splunk refuses as too large is
+# split and every row still reaches the lookup once, that any other refusal stops the upload, and that the parts of a
+# split batch are journaled so a resume does not append them twice.
+import csv, json, os, shutil, subprocess, sys, tempfile, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_splunkd import FakeSplunkd, make_certificate
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'CSV2Splunk.py')
+ROWS = [{'id': str(i), 'name': 'row ' + str(i), 'note': '' if i % 2 else 'even'} for i in range(60)]
+# only about a dozen rows fit in a search this size, so the batch of 60 rows is split more than once.
+MAX_SEARCH_BYTES = 1500
+
+
+def lookup_rows(rows):
+    return [dict((key, value) for (key, value) in row.items() if value != '') for row in rows]
+
+
+@unittest.skipIf(shutil.which('openssl') is None, 'openssl is needed to make the certificate of the fake splunkd.')
+class BatchSplitTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.certificate = make_certificate(self.directory)
+        self.csv_file = os.path.join(self.directory, 'test.csv')
+        with open(self.csv_file, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, ['id', 'name', 'note'])
+            writer.writeheader()
+            writer.writerows(ROWS)
+
+    def start(self, **kwargs):
+        self.server = FakeSplunkd(self.certificate, **kwargs).start()
+        self.addCleanup(self.server.stop)
+
+    def upload(self, *args):
+        result = subprocess.run([sys.executable, SCRIPT, '-splunk_host', self.server.host, '-splunk_user', 'admin',
+                                 '-splunk_pw', 'changeme', '-cert_location', 'False', '-source_csv_file', self.csv_file,
+                                 '-splunk_csv_name', 'test.csv', '-target', 'lookup', '-overwrite', 'N',
+                                 '-batch_size', '60', '-workers', '1'] + list(args),
+                                cwd=self.directory, capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+        return result.stdout
+
+    def test_413_splits_the_batch(self):
+        self.start(max_search_bytes=MAX_SEARCH_BYTES)
+        output = self.upload()
+        self.assertIn('rejected as too large', output)
+        self.assertGreater(self.server.appends, 2)
+        self.assertEqual(self.server.lookups['test.csv'], lookup_rows(ROWS))
+
+    def test_400_too_large_splits_the_batch(self):
+        self.start(max_search_bytes=MAX_SEARCH_BYTES, too_large_status=400)
+        output = self.upload()
+        self.assertIn('rejected as too large', output)
+        self.assertEqual(self.server.lookups['test.csv'], lookup_rows(ROWS))
+
+    def test_other_400_stops_the_upload(self):
+        self.start(fail_appends={1: (400, 'Error in \'outputlookup\' command: The lookup table is read only.')})
+        output = self.upload()
+        self.assertIn('failed!', output)
+        self.assertNotIn('Splitting batch', output)
+        self.assertEqual(self.server.appends, 1)
+        self.assertNotIn('test.csv', self.server.lookups)
+
+    def test_split_parts_are_journaled(self):
+        self.start(max_search_bytes=MAX_SEARCH_BYTES, fail_appends={3: (500, 'Internal error.')})
+        output = self.upload()
+        self.assertIn('Run again with -resume Y', output)
+        appended = len(self.server.lookups['test.csv'])
+        self.assertGreater(appended, 0)
+        with open(os.path.join(self.directory, 'CSV2Splunk_test.csv.checkpoint'), encoding='utf-8') as f:
+            journal = [json.loads(line) for line in f]
+        self.assertEqual(journal[-1], {'batch': 1, 'sent': appended})
+
+        self.server.fail_appends = {}
+        self.upload('-resume', 'Y')
+        # the parts appended before the failure are not sent again.
+        self.assertEqual(self.server.lookups['test.csv'], lookup_rows(ROWS))
+
+
+if __name__ == '__main__':
+    unittest.main()
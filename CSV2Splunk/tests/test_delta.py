@@ -0,0 +1,94 @@
+# Copyright 2021 Paychex, Inc.
+# Licensed pursuant to the terms of the Apache License, Version 2.0 (the "License");
+# your use of the Work is subject to the terms and conditions of the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Disclaimer of Warranty. Unless required by applicable law or agreed to in writing, Licensor
+# provides the Work (and each Contributor provides its Contributions) on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied, including,
+# without limitation, any warranties or conditions of TITLE, NON-INFRINGEMENT,
+# MERCHANTABILITY, OR FITNESS FOR A PARTICULAR PURPOSE. You are solely responsible
+# for determining the appropriateness of using or redistributing the Work and assume
+# any risks associated with your exercise of permissions under this License.
+
+# Runs -delta Y uploads to a lookup on the fake splunkd and checks that the first run uploads the whole file, that a
+# later run removes the rows of every added, changed and deleted key with one NOT in() search and appends only the
+# rows of the added and changed keys, and that a run with nothing changed sends no search.
+import csv, hashlib, os, re, shutil, subprocess, sys, tempfile, unittest, urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_splunkd import FakeSplunkd, makeresults_rows, make_certificate
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'CSV2Splunk.py')
+ROWS = [{'id': str(i), 'name': 'row ' + str(i), 'note': '' if i % 2 else 'even'} for i in range(20)]
+
+
+def lookup_rows(rows):
+    return sorted((dict((key, value) for (key, value) in row.items() if value != '') for row in rows),
+                  key=lambda row: int(row['id']))
+
+
+def key(value):
+    return hashlib.md5(value.encode('utf-8')).hexdigest()
+
+
+@unittest.skipIf(shutil.which('openssl') is None, 'openssl is needed to make the certificate of the fake splunkd.')
+class DeltaTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.server = FakeSplunkd(make_certificate(self.directory)).start()
+        self.addCleanup(self.server.stop)
+        self.csv_file = os.path.join(self.directory, 'test.csv')
+
+    def upload(self, rows):
+        with open(self.csv_file, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, ['id', 'name', 'note'])
+            writer.writeheader()
+            writer.writerows(rows)
+        sent = len(self.server.requests)
+        result = subprocess.run([sys.executable, SCRIPT, '-splunk_host', self.server.host, '-splunk_user', 'admin',
+                                 '-splunk_pw', 'changeme', '-cert_location', 'False', '-source_csv_file', self.csv_file,
+                                 '-splunk_csv_name', 'test.csv', '-target', 'lookup', '-overwrite', 'N',
+                                 '-delta', 'Y', '-key_fields', 'id', '-batch_size', '5'],
+                                cwd=self.directory, capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+        self.assertNotIn('ERROR', result.stdout)
+        return [urllib.parse.parse_qs(body.decode('ascii'))['search'][0]
+                for (method, path, body) in self.server.requests[sent:] if path == '/services/search/jobs']
+
+    def test_first_run_uploads_the_whole_file(self):
+        self.server.lookups['test.csv'] = [{'id': 'old'}]
+        searches = self.upload(ROWS)
+        self.assertEqual(searches[0], '| outputlookup test.csv')
+        self.assertEqual(lookup_rows(self.server.lookups['test.csv']), lookup_rows(ROWS))
+        self.assertTrue(os.path.isfile(os.path.join(self.directory, 'CSV2Splunk_test.csv.delta')))
+
+    def test_insert_update_delete(self):
+        self.upload(ROWS)
+        rows = [dict(row) for row in ROWS if row['id'] != '5']
+        rows[3]['name'] = 'changed'
+        rows.append({'id': '100', 'name': 'added', 'note': ''})
+        # a row of a changed key left behind by an earlier run that failed part way.
+        self.server.lookups['test.csv'].append({'id': '3', 'name': 'stale'})
+
+        searches = self.upload(rows)
+        deletes = [search for search in searches if 'NOT in(' in search]
+        self.assertEqual(len(deletes), 1)
+        self.assertEqual(set(re.findall(r'"([0-9a-f]{32})"', deletes[0])), {key('3'), key('5'), key('100')})
+        appended = [row for search in searches if 'outputlookup append=true' in search
+                    for row in makeresults_rows(search.split(' | outputlookup append=true')[0])]
+        self.assertEqual(lookup_rows(appended), lookup_rows([rows[3], rows[-1]]))
+        self.assertEqual(lookup_rows(self.server.lookups['test.csv']), lookup_rows(rows))
+
+    def test_nothing_changed_sends_nothing(self):
+        self.upload(ROWS)
+        lookup = list(self.server.lookups['test.csv'])
+        self.assertEqual(self.upload(ROWS), [])
+        self.assertEqual(self.server.lookups['test.csv'], lookup)
+
+
+if __name__ == '__main__':
+    unittest.main()
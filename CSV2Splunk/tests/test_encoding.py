@@ -0,0 +1,86 @@
+# Copyright 2021 Paychex, Inc.
+# Licensed pursuant to the terms of the Apache License, Version 2.0 (the "License");
+# your use of the Work is subject to the terms and conditions of the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Disclaimer of Warranty. Unless required by applicable law or agreed to in writing, Licensor
+# provides the Work (and each Contributor provides its Contributions) on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied, including,
+# without limitation, any warranties or conditions of TITLE, NON-INFRINGEMENT,
+# MERCHANTABILITY, OR FITNESS FOR A PARTICULAR PURPOSE. You are solely responsible
+# for determining the appropriateness of using or redistributing the Work and assume
+# any risks associated with your exercise of permissions under this License.
+
+# Uploads rows with -encoding columnar and -encoding json to a lookup on the fake splunkd and checks the lookup is the
+# same cell for cell, including quotes, backslashes, separators and empty cells, and that a batch that can not be
+# packed as columnar is sent as json.
+import csv, os, shutil, subprocess, sys, tempfile, unittest, urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_splunkd import FakeSplunkd, make_certificate
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'CSV2Splunk.py')
+ROWS = [{'id': '1', 'name': '"quoted"', 'note': 'back\\slash'},
+        {'id': '2', 'name': 'ends with \\', 'note': ''},
+        {'id': '3', 'name': '', 'note': ''},
+        {'id': '4', 'name': 'a, b; c|d', 'note': 'it\'s \\"both\\"'},
+        {'id': '5', 'name': 'ünïcode ✓', 'note': '[{"json": "like"}]'},
+        {'id': '6', 'name': '$var$ <<FIELD>>', 'note': 'tab\there'}]
+
+
+def lookup_rows(rows):
+    return [dict((key, value) for (key, value) in row.items() if value != '') for row in rows]
+
+
+@unittest.skipIf(shutil.which('openssl') is None, 'openssl is needed to make the certificate of the fake splunkd.')
+class EncodingTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.server = FakeSplunkd(make_certificate(self.directory)).start()
+        self.addCleanup(self.server.stop)
+        self.csv_file = os.path.join(self.directory, 'test.csv')
+
+    def upload(self, rows, *args):
+        with open(self.csv_file, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, ['id', 'name', 'note'])
+            writer.writeheader()
+            writer.writerows(rows)
+        result = subprocess.run([sys.executable, SCRIPT, '-splunk_host', self.server.host, '-splunk_user', 'admin',
+                                 '-splunk_pw', 'changeme', '-cert_location', 'False', '-source_csv_file', self.csv_file,
+                                 '-splunk_csv_name', 'test.csv', '-target', 'lookup', '-overwrite', 'Y',
+                                 '-workers', '1'] + list(args), cwd=self.directory, capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+        return self.server.lookups['test.csv']
+
+    def append_searches(self):
+        searches = [urllib.parse.parse_qs(body.decode('ascii')).get('search', [''])[0]
+                    for (method, path, body) in self.server.requests if path == '/services/search/jobs']
+        return [search for search in searches if 'outputlookup append=true' in search]
+
+    def test_columnar_round_trip(self):
+        self.assertEqual(self.upload(ROWS, '-encoding', 'columnar'), lookup_rows(ROWS))
+        searches = self.append_searches()
+        self.assertEqual(len(searches), 1)
+        self.assertIn('\u241e', searches[0])
+        self.assertNotIn('spath', searches[0])
+
+    def test_columnar_matches_json(self):
+        columnar = list(self.upload(ROWS, '-encoding', 'columnar'))
+        for null_handling in ('foreach', 'client'):
+            self.assertEqual(self.upload(ROWS, '-encoding', 'json', '-null_handling', null_handling), columnar)
+
+    def test_multiline_batch_falls_back_to_json(self):
+        rows = ROWS + [{'id': '7', 'name': 'two\nlines', 'note': 'x'}]
+        self.assertEqual(self.upload(rows, '-encoding', 'columnar', '-batch_size', '4'), lookup_rows(rows))
+        searches = self.append_searches()
+        # the first batch has no line breaks and stays columnar, the second has one and is sent as json.
+        self.assertEqual(len(searches), 2)
+        self.assertIn('\u241e', searches[0])
+        self.assertIn('spath', searches[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+# Copyright 2021 Paychex, Inc.
+# Licensed pursuant to the terms of the Apache License, Version 2.0 (the "License");
+# your use of the Work is subject to the terms and conditions of the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Disclaimer of Warranty. Unless required by applicable law or agreed to in writing, Licensor
+# provides the Work (and each Contributor provides its Contributions) on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied, including,
+# without limitation, any warranties or conditions of TITLE, NON-INFRINGEMENT,
+# MERCHANTABILITY, OR FITNESS FOR A PARTICULAR PURPOSE. You are solely responsible
+# for determining the appropriateness of using or redistributing the Work and assume
+# any risks associated with your exercise of permissions under this License.
+
+# Uploads tab separated and json lines files to a KV Store collection on the fake splunkd and checks the documents
+# were read cell for cell.
+import gzip, json, os, shutil, subprocess, sys, tempfile, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_splunkd import FakeSplunkd, make_certificate
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'CSV2Splunk.py')
+ROWS = [['1', '"quoted" start', 'plain'],
+        ['2', 'ends with "quote"', '"'],
+        ['3', '"unterminated', 'next'],
+        ['4', 'after', 'the quote'],
+        ['5', 'it\'s', 'a,b']]
+
+
+@unittest.skipIf(shutil.which('openssl') is None, 'openssl is needed to make the certificate of the fake splunkd.')
+class FormatTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.server = FakeSplunkd(make_certificate(self.directory)).start()
+        self.addCleanup(self.server.stop)
+
+    def upload(self, source_file):
+        result = subprocess.run([sys.executable, SCRIPT, '-splunk_host', self.server.host, '-splunk_user', 'admin',
+                                 '-splunk_pw', 'changeme', '-cert_location', 'False', '-source_csv_file', source_file,
+                                 '-splunk_csv_name', 'test_collection', '-target', 'kvstore', '-overwrite', 'N'],
+                                cwd=self.directory, capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+        return [[document['id'], document['name'], document['note']]
+                for document in self.server.collections['test_collection']]
+
+    def test_tsv_keeps_quote_characters(self):
+        source_file = os.path.join(self.directory, 'test.tsv')
+        with open(source_file, 'w', newline='', encoding='utf-8') as f:
+            f.write('id\tname\tnote\n' + ''.join('\t'.join(row) + '\n' for row in ROWS))
+        self.assertEqual(self.upload(source_file), ROWS)
+
+    def test_compressed_tsv(self):
+        source_file = os.path.join(self.directory, 'test.tsv.gz')
+        with gzip.open(source_file, 'wt', newline='', encoding='utf-8') as f:
+            f.write('id\tname\tnote\n' + ''.join('\t'.join(row) + '\n' for row in ROWS))
+        self.assertEqual(self.upload(source_file), ROWS)
+
+    def test_jsonl(self):
+        source_file = os.path.join(self.directory, 'test.jsonl')
+        with open(source_file, 'w', encoding='utf-8') as f:
+            for row in ROWS:
+                f.write(json.dumps(dict(zip(['id', 'name', 'note'], row))) + '\n')
+        self.assertEqual(self.upload(source_file), ROWS)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+# Copyright 2021 Paychex, Inc.
+# Licensed pursuant to the terms of the Apache License, Version 2.0 (the "License");
+# your use of the Work is subject to the terms and conditions of the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Disclaimer of Warranty. Unless required by applicable law or agreed to in writing, Licensor
+# provides the Work (and each Contributor provides its Contributions) on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied, including,
+# without limitation, any warranties or conditions of TITLE, NON-INFRINGEMENT,
+# MERCHANTABILITY, OR FITNESS FOR A PARTICULAR PURPOSE. You are solely responsible
+# for determining the appropriateness of using or redistributing the Work and assume
+# any risks associated with your exercise of permissions under this License.
+
+# Runs CSV2Splunk with -target hec against the fake HTTP Event Collector.
+import csv, os, shutil, subprocess, sys, tempfile, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_hec import FakeHec
+from fake_splunkd import make_certificate
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'CSV2Splunk.py')
+TOKEN = '11111111-2222-3333-4444-555555555555'
+
+
+@unittest.skipIf(shutil.which('openssl') is None, 'openssl is needed to make the certificate of the fake collector.')
+class HecTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.server = FakeHec(make_certificate(self.directory), port=0, token=TOKEN, ack_delay=0.5).start()
+        self.addCleanup(self.server.stop)
+        self.csv_file = os.path.join(self.directory, 'test.csv')
+        with open(self.csv_file, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(['id', 'name'])
+            for i in range(1000):
+                writer.writerow([str(i), 'row ' + str(i)])
+
+    def upload(self, *args):
+        result = subprocess.run([sys.executable, SCRIPT, '-splunk_host', '127.0.0.1', '-splunk_user', 'admin',
+                                 '-splunk_pw', 'changeme', '-cert_location', 'False', '-source_csv_file', self.csv_file,
+                                 '-splunk_csv_name', 'test.csv', '-target', 'hec', '-hec_token', TOKEN,
+                                 '-hec_port', str(self.server.server_address[1]), '-batch_size', '500',
+                                 '-batch_bytes', '2000'] + list(args),
+                                cwd=self.directory, capture_output=True, text=True, timeout=120)
+        self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+        return result.stdout
+
+    def test_every_event_is_sent(self):
+        output = self.upload('-hec_ack', 'N')
+        self.assertEqual(self.server.events, 1000)
+        self.assertNotIn('/services/collector/ack', [path for (path, length) in self.server.requests])
+        self.assertIn('Sent 1000 event(s) to the HTTP Event Collector', output)
+
+    def test_acks_are_checked_together(self):
+        output = self.upload('-hec_ack', 'Y', '-workers', '1')
+        paths = [path for (path, length) in self.server.requests]
+        self.assertEqual(self.server.events, 1000)
+        self.assertIn('Sent 1000 event(s) to the HTTP Event Collector', output)
+        # each batch is cut into many requests, but its acks are polled in a few requests for the whole batch.
+        self.assertGreater(paths.count('/services/collector/event'), 20)
+        self.assertLess(paths.count('/services/collector/ack'), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
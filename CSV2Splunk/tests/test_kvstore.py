@@ -0,0 +1,72 @@
+# Copyright 2021 Paychex, Inc.
+# Licensed pursuant to the terms of the Apache License, Version 2.0 (the "License");
+# your use of the Work is subject to the terms and conditions of the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Disclaimer of Warranty. Unless required by applicable law or agreed to in writing, Licensor
+# provides the Work (and each Contributor provides its Contributions) on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied, including,
+# without limitation, any warranties or conditions of TITLE, NON-INFRINGEMENT,
+# MERCHANTABILITY, OR FITNESS FOR A PARTICULAR PURPOSE. You are solely responsible
+# for determining the appropriateness of using or redistributing the Work and assume
+# any risks associated with your exercise of permissions under this License.
+
+# Runs CSV2Splunk with -target kvstore against the fake splunkd and checks the requests it sent.
+import csv, json, os, shutil, subprocess, sys, tempfile, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_splunkd import FakeSplunkd, make_certificate
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'CSV2Splunk.py')
+COLLECTION_PATH = '/servicesNS/nobody/search/storage/collections/data/test_collection'
+
+
+@unittest.skipIf(shutil.which('openssl') is None, 'openssl is needed to make the certificate of the fake splunkd.')
+class KvstoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.server = FakeSplunkd(make_certificate(self.directory), max_documents=40).start()
+        self.addCleanup(self.server.stop)
+        self.csv_file = os.path.join(self.directory, 'test.csv')
+        with open(self.csv_file, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(['id', 'name', 'note'])
+            for i in range(100):
+                writer.writerow([str(i), 'row ' + str(i), '' if i % 2 else 'even'])
+
+    def upload(self, *args):
+        result = subprocess.run([sys.executable, SCRIPT, '-splunk_host', self.server.host, '-splunk_user', 'admin',
+                                 '-splunk_pw', 'changeme', '-cert_location', 'False', '-source_csv_file', self.csv_file,
+                                 '-splunk_csv_name', 'test_collection', '-target', 'kvstore', '-batch_size', '1000']
+                                + list(args), cwd=self.directory, capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+        return [(method, path, body) for (method, path, body) in self.server.requests
+                if path.startswith(COLLECTION_PATH)]
+
+    def test_batch_save_follows_max_documents(self):
+        requests = self.upload('-overwrite', 'N')
+        sizes = [len(json.loads(body)) for (method, path, body) in requests if path == COLLECTION_PATH + '/batch_save']
+        self.assertEqual(sizes, [40, 40, 20])
+        documents = self.server.collections['test_collection']
+        self.assertEqual([document['id'] for document in documents], [str(i) for i in range(100)])
+        # empty cells are left out of the document.
+        self.assertNotIn('note', documents[1])
+        self.assertEqual(documents[0]['note'], 'even')
+
+    def test_overwrite_deletes_collection_first(self):
+        self.server.collections['test_collection'] = [{'id': 'old'}]
+        requests = self.upload('-overwrite', 'Y')
+        self.assertEqual(requests[0][:2], ('DELETE', COLLECTION_PATH))
+        self.assertEqual(len(self.server.collections['test_collection']), 100)
+        self.assertNotIn({'id': 'old'}, self.server.collections['test_collection'])
+
+    def test_no_delete_without_overwrite(self):
+        requests = self.upload('-overwrite', 'N')
+        self.assertNotIn('DELETE', [method for (method, path, body) in requests])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+# Copyright 2021 Paychex, Inc.
+# Licensed pursuant to the terms of the Apache License, Version 2.0 (the "License");
+# your use of the Work is subject to the terms and conditions of the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Disclaimer of Warranty. Unless required by applicable law or agreed to in writing, Licensor
+# provides the Work (and each Contributor provides its Contributions) on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied, including,
+# without limitation, any warranties or conditions of TITLE, NON-INFRINGEMENT,
+# MERCHANTABILITY, OR FITNESS FOR A PARTICULAR PURPOSE. You are solely responsible
+# for determining the appropriateness of using or redistributing the Work and assume
+# any risks associated with your exercise of permissions under this License.
+
+# Stops an upload to a lookup on the fake splunkd part way through and checks that -resume Y appends only the rows
+# that were not appended, runs the overwrite once, and refuses a source file that changed since the checkpoint.
+import csv, os, shutil, subprocess, sys, tempfile, unittest, urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_splunkd import FakeSplunkd, make_certificate
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'CSV2Splunk.py')
+ROWS = [{'id': str(i), 'name': 'row ' + str(i), 'note': '' if i % 2 else 'even'} for i in range(50)]
+
+
+def lookup_rows(rows):
+    return [dict((key, value) for (key, value) in row.items() if value != '') for row in rows]
+
+
+@unittest.skipIf(shutil.which('openssl') is None, 'openssl is needed to make the certificate of the fake splunkd.')
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        # the third batch fails, after the first two were appended.
+        self.server = FakeSplunkd(make_certificate(self.directory), fail_appends={3: (500, 'Internal error.')}).start()
+        self.addCleanup(self.server.stop)
+        self.csv_file = os.path.join(self.directory, 'test.csv')
+        self.checkpoint_file = os.path.join(self.directory, 'CSV2Splunk_test.csv.checkpoint')
+        self.write_csv(ROWS)
+
+    def write_csv(self, rows):
+        with open(self.csv_file, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, ['id', 'name', 'note'])
+            writer.writeheader()
+            writer.writerows(rows)
+
+    def upload(self, *args):
+        result = subprocess.run([sys.executable, SCRIPT, '-splunk_host', self.server.host, '-splunk_user', 'admin',
+                                 '-splunk_pw', 'changeme', '-cert_location', 'False', '-source_csv_file', self.csv_file,
+                                 '-splunk_csv_name', 'test.csv', '-target', 'lookup', '-batch_size', '10',
+                                 '-workers', '1'] + list(args), cwd=self.directory, capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+        return result.stdout
+
+    def truncates(self):
+        return [body for (method, path, body) in self.server.requests if path == '/services/search/jobs' and
+                urllib.parse.parse_qs(body.decode('ascii')).get('search') == ['| outputlookup test.csv']]
+
+    def test_resume_appends_the_rest(self):
+        output = self.upload('-overwrite', 'N')
+        self.assertIn('Run again with -resume Y', output)
+        self.assertEqual(self.server.lookups['test.csv'], lookup_rows(ROWS[:20]))
+        self.assertTrue(os.path.isfile(self.checkpoint_file))
+
+        self.server.fail_appends = {}
+        output = self.upload('-overwrite', 'N', '-resume', 'Y')
+        self.assertIn('2 of 3 recorded batch(es) completed. Restarting from batch 3.', output)
+        self.assertEqual(self.server.lookups['test.csv'], lookup_rows(ROWS))
+        # the journal is removed once the upload completes.
+        self.assertFalse(os.path.isfile(self.checkpoint_file))
+
+    def test_overwrite_is_not_run_again(self):
+        self.server.lookups['test.csv'] = [{'id': 'old'}]
+        self.upload('-overwrite', 'Y')
+        self.assertEqual(len(self.truncates()), 1)
+
+        # rows appended by someone else after the overwrite are kept by the resume.
+        self.server.lookups['test.csv'].append({'id': 'other'})
+        self.server.fail_appends = {}
+        output = self.upload('-overwrite', 'Y', '-resume', 'Y')
+        self.assertIn('Skipping overwrite.', output)
+        self.assertEqual(len(self.truncates()), 1)
+        self.assertEqual(self.server.lookups['test.csv'],
+                         lookup_rows(ROWS[:20]) + [{'id': 'other'}] + lookup_rows(ROWS[20:]))
+
+    def test_changed_file_is_not_resumed(self):
+        # rows 10 to 39 are long enough that a change to row 25 is past the start and before the end of the file that
+        # are hashed, so only the inode and modification time tell the files apart.
+        rows = [dict(row, note='x' * 100 * 1024) if 10 <= int(row['id']) < 40 else row for row in ROWS]
+        self.write_csv(rows)
+        self.assertIn('Run again with -resume Y', self.upload('-overwrite', 'N'))
+        rows[25] = dict(rows[25], note='y' + rows[25]['note'][1:])
+        os.remove(self.csv_file)
+        self.write_csv(rows)
+
+        self.server.fail_appends = {}
+        appends = self.server.appends
+        output = self.upload('-overwrite', 'N', '-resume', 'Y')
+        self.assertIn('has changed since the checkpoint was written', output)
+        self.assertEqual(self.server.appends, appends)
+
+    def test_resume_without_checkpoint(self):
+        output = self.upload('-overwrite', 'N', '-resume', 'Y')
+        self.assertIn('no checkpoint file was found', output)
+        self.assertEqual(self.server.appends, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -12,8 +12,12 @@
 # MERCHANTABILITY, OR FITNESS FOR A PARTICULAR PURPOSE. You are solely responsible
 # for determining the appropriateness of using or redistributing the Work and assume 
 # any risks associated with your exercise of permissions under this License.
-import logging.handlers, json, sys, argparse, re, getpass
+import logging.handlers, json, sys, argparse, re, getpass, signal, sqlite3, threading, time, queue, ssl, os, hashlib, \
+    atexit, hmac
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, quote, unquote
 
 
 # Define logging
@@ -39,18 +43,56 @@ def log_print(log_type, message):
         logging.warning(message)
     elif log_type.lower() == 'debug':
         logging.debug(message)
-    print(log_type.upper() + ': ' + message)
+    # One write per line so messages from the sender threads do not run together.
+    sys.stdout.write(log_type.upper() + ': ' + message + '\n')
 
 
 # import requests error handling
 try:
     import requests
+    from requests.adapters import HTTPAdapter
     from requests.auth import HTTPBasicAuth
 except ImportError:
     log_print('error', 'Add the requests repository to your PYTHONPATH to run the these commands:\n'
                        'python -m pip install requests')
     sys.exit()
 
+# pyyaml is only needed for yaml route files, json route files work without it.
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+WEBEX_API = 'https://webexapis.com/v1'
+
+# Each poll searches from a host's watermark minus this many seconds, so scheduler events that are indexed late are
+# still found.  Alerts found twice in the overlap are only sent once.
+WATERMARK_OVERLAP = 120
+
+# Messages are sent to up to WEBEX_SEND_WORKERS rooms at once, paced by a token bucket that holds WEBEX_BURST
+# requests.  A throttled or failed request is tried again up to WEBEX_RETRIES times.
+WEBEX_SEND_WORKERS = 10
+WEBEX_BURST = 10
+WEBEX_RETRIES = 5
+
+# WebEx rejects a message over 7439 bytes, so alert lines are packed into messages of at most this many bytes.
+WEBEX_MESSAGE_BYTES = 7000
+
+# Largest webhook body the receiver reads.  Splunk only sends the first result row of the alert.
+WEBHOOK_MAX_BYTES = 1000000
+
+# Characters a splunk search id is made of.  A webhook with any other sid is refused before it reaches a link.
+SID_PATTERN = re.compile(r'[\w.:@-]+')
+
+# Histogram buckets in seconds for each stage that is measured.
+METRIC_BUCKETS = {'alert_delivery_seconds': (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600),
+                  'splunk_search_seconds': (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+                  'webex_request_seconds': (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)}
+METRIC_HELP = {'alert_delivery_seconds': 'Seconds from an alert triggering to its message first being delivered.',
+               'splunk_search_seconds': 'Seconds taken to find the triggered alerts on a search head.',
+               'webex_request_seconds': 'Seconds taken by each request to send a message to WebEx.'}
+
 
 def api(data):
     try:
@@ -70,7 +112,8 @@ def main():
     parser = argparse.ArgumentParser(
         description='Script to poll splunk alerts to see if they triggered, and then push triggered alerts to WebEx Teams.')
     parser.add_argument('-splunk_host',
-                        help='Splunk search head to poll for alerts.',
+                        help='Splunk search head to poll for alerts.  splunkd is reached on port 8089 unless another '
+                             'port is given after a colon, as in sh1.example.com:8090.',
                         required=True)
     parser.add_argument('-user',
                         help='User name to interact with splunk.',
@@ -80,11 +123,11 @@ def main():
                         required=False)
     parser.add_argument('-splunk_app',
                         help='Splunk app that you want to poll alerts for. If more than one separate by commas.',
-                        required=True)
+                        required=False)
     parser.add_argument('-owners',
                         help='Enter one or more alert owners in a comma separated list to limit the alerts that are '
                              'retrieved. You can enter an asterisk to pull all users in the chosen apps.',
-                        required=True)
+                        required=False)
     parser.add_argument('-webex_token',
                         help='Enter the WebEx Bot bearer token associated to your WebEx Bot.',
                         required=True)
@@ -98,7 +141,8 @@ def main():
                         required=False)
     parser.add_argument('-freq_filter',
                         help='Filter results that have not triggered in the last X minutes that you define here. '
-                             ' Defaults to last 5 minutes if not here. Input only accepts whole numbers.',
+                             ' Defaults to last 5 minutes if not here. Input only accepts whole numbers.  Once a search '
+                             'head has been polled, later polls search from where the last poll ended instead.',
                         required=False)
     parser.add_argument('-search_name',
                         help='Name of search that you want to monitor for triggered alerts. If you have multiple alerts '
@@ -107,7 +151,7 @@ def main():
                              'in double quotes. Example: "alert for errors,alert for warnings, alerts\, warnings\, '
                              'and fatal alerting"  That would produce a list of three alerts with names "alert for errors", '
                              '"alert for warnings", and "alerts, warnings, and fatal alerting".',
-                        required=True)
+                        required=False)
     parser.add_argument('-room_list',
                         help='Provide comma separated list of room names you want to send alerts to. If a comma is in '
                              'the room name, escape the comma with a backslash. If you want to send to all rooms the '
@@ -119,7 +163,112 @@ def main():
                              'go to https://developer.webex.com/docs/api/v1/rooms/list-rooms and test what rooms return '
                              'with the bearer token for your splunk bot.  This process is matching on the title field from'
                              ' that API response.',
-                        required=True)
+                        required=False)
+    parser.add_argument('-routes',
+                        help='Path to a json or yaml file listing routes, each with its own search_name, splunk_app, '
+                             'owners, room_list and custom_message.  One search finds the alerts of every route and '
+                             'each route is sent the ones that match it.  A field a route leaves out is taken from the '
+                             'argument of the same name.  splunk_app, owners, search_name and room_list are only '
+                             'required when this is not provided.',
+                        required=False)
+    parser.add_argument('-backend',
+                        help='How triggered alerts are found.  "search" runs a search of the scheduler logs in _internal.'
+                             '  "fired_alerts" reads the triggered alerts REST endpoint instead, which does not dispatch '
+                             'a search but only lists alerts that have the "Add to Triggered Alerts" action.  If the '
+                             'endpoint can not be read the _internal search is used instead.  Defaults to "search".',
+                        required=False, choices=['search', 'fired_alerts'])
+    parser.add_argument('-benchmark',
+                        help='Set to "Y" to time both backends against each search head and exit without sending any '
+                             'messages.  Defaults to "N".',
+                        required=False, choices=['Y', 'y', 'N', 'n'])
+    parser.add_argument('-benchmark_runs',
+                        help='Number of times each backend is run when benchmark is "Y".  Defaults to 5.  Input only '
+                             'accepts whole numbers.',
+                        required=False)
+    parser.add_argument('-state_file',
+                        help='Path of the sqlite file that records which alerts were sent and how far each search head '
+                             'has been polled, so every alert is sent once across runs.  Defaults to WebExBot.state in '
+                             'the current directory.',
+                        required=False)
+    parser.add_argument('-max_lookback',
+                        help='Most minutes back a poll searches a search head.  A search head whose watermark is older, '
+                             'because its alerts could not be delivered to WebEx for that long, is searched over this '
+                             'many minutes instead and older alerts are not sent.  Defaults to 60.  Input only accepts '
+                             'whole numbers.',
+                        required=False)
+    parser.add_argument('-search_timeout',
+                        help='Number of seconds to wait for each search head to answer.  All search heads are polled at '
+                             'the same time, and one that is slower than this is skipped.  Defaults to 60.  Input only '
+                             'accepts whole numbers.',
+                        required=False)
+    parser.add_argument('-webex_rate',
+                        help='Maximum number of messages sent to WebEx per second.  Rooms are sent to at the same time '
+                             'up to this rate, and sending slows down when WebEx asks it to.  Defaults to 5.  Input only '
+                             'accepts whole numbers.',
+                        required=False)
+    parser.add_argument('-daemon',
+                        help='Set to "Y" to keep running and poll splunk every poll_interval seconds instead of polling '
+                             'once and exiting.  Connections to splunk and WebEx are kept open between polls and an '
+                             'alert is only sent once.  Defaults to "N".',
+                        required=False, choices=['Y', 'y', 'N', 'n'])
+    parser.add_argument('-poll_interval',
+                        help='Number of seconds between polls when daemon is "Y".  Defaults to 30.  Input only accepts '
+                             'whole numbers.',
+                        required=False)
+    parser.add_argument('-room_refresh',
+                        help='Number of seconds between refreshes of the room list when daemon is "Y".  Defaults to '
+                             '900.  Input only accepts whole numbers.',
+                        required=False)
+
+    parser.add_argument('-digest_window',
+                        help='Number of seconds the alerts for each room are held and merged into one digest when '
+                             'daemon is "Y" or webhook_port is provided.  Defaults to 0, which sends on every poll.  '
+                             'Input only accepts whole numbers.',
+                        required=False)
+    parser.add_argument('-room_budget',
+                        help='Maximum number of digests sent to each room in an hour when daemon is "Y" or webhook_port '
+                             'is provided.  Alerts for a room that has used its budget are held for its next digest.  '
+                             'Defaults to 0, which has no limit.  Input only accepts whole numbers.',
+                        required=False)
+    parser.add_argument('-room_cache',
+                        help='Path of the file the rooms the WebEx Bot is in are cached in, so most runs do not look them '
+                             'up.  Defaults to WebExBot.rooms in the current directory.',
+                        required=False)
+    parser.add_argument('-room_cache_ttl',
+                        help='Number of seconds the cached rooms are used before they are checked with WebEx again.  '
+                             'Set to 0 to check on every run.  Defaults to 3600.  Input only accepts whole numbers.',
+                        required=False)
+    parser.add_argument('-metrics_file',
+                        help='Path of a file to write latency metrics to: the time from each alert triggering to its '
+                             'message being delivered, each splunk search and each WebEx request.  If not provided no '
+                             'metrics are written.',
+                        required=False)
+    parser.add_argument('-metrics_format',
+                        help='Format of metrics_file.  "prometheus" keeps histograms in a textfile for the node '
+                             'exporter textfile collector.  "json" appends a line for every measurement.  Defaults to '
+                             '"prometheus".',
+                        required=False, choices=['prometheus', 'json'])
+    parser.add_argument('-webhook_port',
+                        help='Port to listen on for the splunk webhook alert action.  When set, the script runs as a '
+                             'receiver that sends each alert to WebEx as soon as splunk posts it instead of polling.  '
+                             'Input only accepts whole numbers.',
+                        required=False)
+    parser.add_argument('-webhook_queue',
+                        help='Number of alerts the receiver holds while they wait to be sent to WebEx.  Alerts that '
+                             'arrive while it is full are refused.  Defaults to 1000.  Input only accepts whole numbers.',
+                        required=False)
+    parser.add_argument('-webhook_bind',
+                        help='Address the receiver listens on.  Defaults to all addresses.',
+                        required=False)
+    parser.add_argument('-webhook_token',
+                        help='Shared secret splunk must send with each webhook, either as the path of the webhook URL '
+                             '(https://receiver:port/<token>) or as its token query parameter (?token=<token>).  '
+                             'Required when webhook_port is provided.',
+                        required=False)
+    parser.add_argument('-webhook_cert',
+                        help='Path of a PEM file holding the certificate and private key the receiver uses for https.  '
+                             'If not provided the receiver listens on http.',
+                        required=False)
 
     args = parser.parse_args()
 
@@ -129,13 +278,16 @@ def main():
         splunk_pw = getpass.getpass('password: ')
     else:
         splunk_pw = str(args.pw)
-    splunk_app = [x.strip() for x in args.splunk_app.strip().split(',')]
-    owners = [x.strip() for x in args.owners.strip().split(',')]
-    search_name = [re.sub('[\\\],', ',', x.strip()) for x in re.sub('([^\\\]),', '\g<1>█',
-                                                                    args.search_name.strip()).split('█')]
+    if args.routes is None:
+        if args.splunk_app is None or args.owners is None or args.search_name is None or args.room_list is None:
+            log_print('error', 'The splunk_app, owners, search_name and room_list arguments are required unless routes '
+                               'is provided.')
+            sys.exit()
 
-    room_list = [re.sub('[\\\],', ',', x.strip().lower()) for x in re.sub('([^\\\]),', '\g<1>█',
-                                                                          args.room_list.strip()).split('█')]
+    splunk_app = None if args.splunk_app is None else [x.strip() for x in args.splunk_app.strip().split(',')]
+    owners = None if args.owners is None else [x.strip() for x in args.owners.strip().split(',')]
+    search_name = None if args.search_name is None else split_names(args.search_name)
+    room_list = None if args.room_list is None else [x.lower() for x in split_names(args.room_list)]
     webex_token = args.webex_token.strip()
 
     if args.custom_message is None:
@@ -143,6 +295,11 @@ def main():
     else:
         custom_message = args.custom_message.strip()
 
+    if args.routes is None:
+        routes = [Route(None, search_name, splunk_app, owners, room_list, custom_message)]
+    else:
+        routes = load_routes(args.routes.strip(), search_name, splunk_app, owners, room_list, custom_message)
+
     if args.cert_location.strip().lower() == 'false':
         cert_info = False
     else:
@@ -157,104 +314,1330 @@ def main():
             log_print('error', 'Invalid value provided for freq_filter argument.  This only accepts integers.')
             sys.exit()
 
+    if args.backend is None:
+        backend = 'search'
+    else:
+        backend = args.backend.strip().lower()
+
+    if args.benchmark is None:
+        benchmark = 'N'
+    else:
+        benchmark = args.benchmark.strip().upper()
+
+    if args.benchmark_runs is None:
+        benchmark_runs = 5
+    else:
+        try:
+            benchmark_runs = int(args.benchmark_runs.strip())
+        except Exception:
+            log_print('error', 'Invalid value provided for benchmark_runs argument.  This only accepts integers.')
+            sys.exit()
+
+    if args.state_file is None:
+        state_file = 'WebExBot.state'
+    else:
+        state_file = args.state_file.strip()
+
+    if args.max_lookback is None:
+        max_lookback = 60
+    else:
+        try:
+            max_lookback = int(args.max_lookback.strip())
+        except Exception:
+            log_print('error', 'Invalid value provided for max_lookback argument.  This only accepts integers.')
+            sys.exit()
+
+    if args.search_timeout is None:
+        search_timeout = 60
+    else:
+        try:
+            search_timeout = int(args.search_timeout.strip())
+        except Exception:
+            log_print('error', 'Invalid value provided for search_timeout argument.  This only accepts integers.')
+            sys.exit()
+
+    if args.webex_rate is None:
+        webex_rate = 5
+    else:
+        try:
+            webex_rate = int(args.webex_rate.strip())
+            if webex_rate < 1:
+                raise ValueError
+        except Exception:
+            log_print('error', 'Invalid value provided for webex_rate argument.  This only accepts positive integers.')
+            sys.exit()
+
+    if args.daemon is None:
+        daemon = 'N'
+    else:
+        daemon = args.daemon.strip().upper()
+
+    if args.poll_interval is None:
+        poll_interval = 30
+    else:
+        try:
+            poll_interval = int(args.poll_interval.strip())
+        except Exception:
+            log_print('error', 'Invalid value provided for poll_interval argument.  This only accepts integers.')
+            sys.exit()
+
+    if args.room_refresh is None:
+        room_refresh = 900
+    else:
+        try:
+            room_refresh = int(args.room_refresh.strip())
+        except Exception:
+            log_print('error', 'Invalid value provided for room_refresh argument.  This only accepts integers.')
+            sys.exit()
+
+    if args.digest_window is None:
+        digest_window = 0
+    else:
+        try:
+            digest_window = int(args.digest_window.strip())
+        except Exception:
+            log_print('error', 'Invalid value provided for digest_window argument.  This only accepts integers.')
+            sys.exit()
+
+    if args.room_budget is None:
+        room_budget = 0
+    else:
+        try:
+            room_budget = int(args.room_budget.strip())
+        except Exception:
+            log_print('error', 'Invalid value provided for room_budget argument.  This only accepts integers.')
+            sys.exit()
+
+    if args.room_cache is None:
+        room_cache = 'WebExBot.rooms'
+    else:
+        room_cache = args.room_cache.strip()
+
+    if args.room_cache_ttl is None:
+        room_cache_ttl = 3600
+    else:
+        try:
+            room_cache_ttl = int(args.room_cache_ttl.strip())
+        except Exception:
+            log_print('error', 'Invalid value provided for room_cache_ttl argument.  This only accepts integers.')
+            sys.exit()
+
+    if args.metrics_file is not None:
+        metrics.configure(args.metrics_file.strip(), 'prometheus' if args.metrics_format is None else
+                          args.metrics_format.strip())
+        # written however the script ends, including the sys.exit() calls of a run with nothing to send.
+        atexit.register(metrics.export)
+
+    if args.webhook_port is None:
+        webhook_port = None
+    else:
+        try:
+            webhook_port = int(args.webhook_port.strip())
+        except Exception:
+            log_print('error', 'Invalid value provided for webhook_port argument.  This only accepts integers.')
+            sys.exit()
+        if daemon == 'Y':
+            log_print('error', 'The daemon and webhook_port arguments can not be used together.')
+            sys.exit()
+
+    if args.webhook_queue is None:
+        webhook_queue = 1000
+    else:
+        try:
+            webhook_queue = int(args.webhook_queue.strip())
+        except Exception:
+            log_print('error', 'Invalid value provided for webhook_queue argument.  This only accepts integers.')
+            sys.exit()
+
+    if args.webhook_bind is None:
+        webhook_bind = ''
+    else:
+        webhook_bind = args.webhook_bind.strip()
+
+    if args.webhook_token is None or args.webhook_token.strip() == '':
+        webhook_token = None
+        if webhook_port is not None:
+            log_print('error', 'The webhook_token argument is required when webhook_port is provided.')
+            sys.exit()
+    else:
+        webhook_token = args.webhook_token.strip()
+
+    if args.webhook_cert is None:
+        webhook_cert = None
+    else:
+        webhook_cert = args.webhook_cert.strip()
+
+    if digest_window > 0 or room_budget > 0:
+        if daemon != 'Y' and webhook_port is None:
+            log_print('error', 'The digest_window and room_budget arguments only apply when daemon is "Y" or '
+                               'webhook_port is provided.')
+            sys.exit()
+        digest = AlertDigest(digest_window, room_budget)
+    else:
+        digest = None
+
+    # One session for each API so every request after the first reuses an open connection.
+    splunk = create_session(auth=HTTPBasicAuth(splunk_user, splunk_pw), hosts=len(splunk_host))
+    webex = create_session(headers={'Authorization': 'Bearer ' + webex_token})
+    bucket = TokenBucket(webex_rate, WEBEX_BURST)
+
+    # One search finds the alerts of every route.
+    search_name = combined(route.search_name for route in routes)
+    splunk_app = combined(route.splunk_app for route in routes)
+    owners = combined(route.owners for route in routes)
+    source = AlertSource(backend, search_name, splunk_app, owners)
+
+    if benchmark == 'Y':
+        benchmark_backends(splunk, cert_info, splunk_host, search_name, splunk_app, owners, freq_filter,
+                           search_timeout, benchmark_runs)
+        return
+
     # Lookup rooms associated to WebEx Bot and compare to list of rooms requested.
+    directory = RoomDirectory(room_cache, room_cache_ttl, webex_token)
+    room_list = combined(route.room_list for route in routes)
+    all_rooms = any(route.all_rooms for route in routes)
+    room_comm_list = lookup_rooms(webex, cert_info, room_list, all_rooms, directory)
+    if room_comm_list is None or not check_route_rooms(routes, room_comm_list):
+        sys.exit()
+
+    if webhook_port is not None:
+        rooms = RoomRefresher(webex, cert_info, room_list, all_rooms, directory, room_comm_list, room_refresh)
+        rooms.start()
+        run_webhook(webex, cert_info, splunk_host, routes, rooms, webhook_bind, webhook_port, webhook_token,
+                    webhook_queue, webhook_cert, bucket, digest)
+        return
+
+    # a second run started while this one is still polling waits for it, so the two never send the same alert.
+    state = AlertState(state_file, search_timeout + 60, max_lookback, state_scope(routes))
+
+    if daemon == 'Y':
+        rooms = RoomRefresher(webex, cert_info, room_list, all_rooms, directory, room_comm_list, room_refresh)
+        rooms.start()
+        run_daemon(splunk, webex, cert_info, splunk_host, source, freq_filter, routes, rooms, poll_interval,
+                   search_timeout, state, bucket, digest)
+        return
+
+    if not state.begin():
+        sys.exit()
+    poll_start = int(time.time())
+    time_filters = state.time_filters(splunk_host, int((datetime.now() - timedelta(minutes=freq_filter)).timestamp()),
+                                      poll_start)
+
+    log_print('info', 'Polling splunk to see if any alerts have triggered.')
+    host_results = poll_hosts(splunk, cert_info, splunk_host, source, time_filters, search_timeout)
+    if all(results is None for results in host_results.values()):
+        log_print('warn', 'Failed to pull data from splunk.')
+        sys.exit()
+
+    route_alerts = collect_alerts(host_results, state, poll_start, routes, room_comm_list)
+
+    if len(route_alerts) == 0:
+        state.commit()
+        log_print('info', 'None of the requested alerts have triggered since the last poll.')
+        sys.exit()
+
+    finish_poll(state, poll_start, *deliver_routes(webex, cert_info, room_comm_list, route_alerts, bucket))
+
+
+class Metrics:
+    # Latency histograms for each stage of getting an alert to WebEx.  With the prometheus format the histograms are
+    # read back from metrics_file when the script starts, so they keep counting across runs from cron.
+    def __init__(self):
+        self.metrics_file = None
+        self.metrics_format = None
+        self.samples = {}
+        self.trigger_times = {}
+        self.lock = threading.Lock()
+
+    def configure(self, metrics_file, metrics_format):
+        self.metrics_file = metrics_file
+        self.metrics_format = metrics_format
+        if metrics_format != 'prometheus':
+            return
+        try:
+            with open(metrics_file, encoding='utf-8') as f:
+                for line in f:
+                    if line.startswith('webexbot_'):
+                        (sample, value) = line.rsplit(' ', 1)
+                        self.samples[sample] = float(value)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log_print('warn', 'Starting metrics over.  Unable to read ' + metrics_file + ':\n' + str(e))
+            self.samples = {}
+
+    def observe(self, name, value, **labels):
+        if self.metrics_file is None:
+            return
+        with self.lock:
+            if self.metrics_format == 'json':
+                try:
+                    with open(self.metrics_file, 'a', encoding='utf-8') as f:
+                        f.write(json.dumps(dict({'time': datetime.now().astimezone().isoformat(), 'metric': name,
+                                                 'value': round(value, 3)}, **labels)) + '\n')
+                except Exception as e:
+                    log_print('warn', 'Unable to write metrics to ' + self.metrics_file + ':\n' + str(e))
+                return
+            label_text = ','.join(k + '="' + str(v).replace('\\', '\\\\').replace('"', '\\"') + '"'
+                                  for (k, v) in sorted(labels.items()))
+            for le in METRIC_BUCKETS[name] + ('+Inf',):
+                sample = 'webexbot_' + name + '_bucket{' + label_text + (',' if label_text else '') + 'le="' + \
+                         str(le) + '"}'
+                self.samples[sample] = self.samples.get(sample, 0) + (1 if le == '+Inf' or value <= le else 0)
+            for (suffix, amount) in (('_sum', value), ('_count', 1)):
+                sample = 'webexbot_' + name + suffix + ('{' + label_text + '}' if label_text else '')
+                self.samples[sample] = self.samples.get(sample, 0) + amount
+
+    def triggered(self, sid, trigger_time):
+        # The time the alert triggered, kept until its message is delivered.  The scheduler puts the time it ran the
+        # search in the sid, which is used when splunk does not say when the alert triggered.
+        if trigger_time is None:
+            scheduled = re.search('_at_([0-9]+)_', sid)
+            if scheduled is None:
+                return
+            trigger_time = int(scheduled.group(1))
+        with self.lock:
+            self.trigger_times.setdefault(sid, trigger_time)
+
+    def delivered(self, sids):
+        now = time.time()
+        for sid in sids:
+            with self.lock:
+                trigger_time = self.trigger_times.pop(sid, None)
+            if trigger_time is not None:
+                self.observe('alert_delivery_seconds', max(now - trigger_time, 0))
+
+    def export(self):
+        if self.metrics_file is None or self.metrics_format != 'prometheus':
+            return
+        with self.lock:
+            # alerts that were never delivered are not kept forever.
+            self.trigger_times = {sid: trigger_time for (sid, trigger_time) in self.trigger_times.items()
+                                  if time.time() - trigger_time < 86400}
+            lines = []
+            for name in METRIC_BUCKETS:
+                lines.append('# HELP webexbot_' + name + ' ' + METRIC_HELP[name])
+                lines.append('# TYPE webexbot_' + name + ' histogram')
+                lines.extend(sample + ' ' + ('%d' % value if value == int(value) else repr(value))
+                             for (sample, value) in self.samples.items()
+                             if sample.startswith('webexbot_' + name + '_'))
+            try:
+                # written to a temporary file first so the collector never reads half a file.
+                with open(self.metrics_file + '.tmp', 'w', encoding='utf-8') as f:
+                    f.write('\n'.join(lines) + '\n')
+                os.replace(self.metrics_file + '.tmp', self.metrics_file)
+            except Exception as e:
+                log_print('warn', 'Unable to write metrics to ' + self.metrics_file + ':\n' + str(e))
+
+
+metrics = Metrics()
 
-    room_comm_list = {}
-    room_missing_list = []
+
+def split_names(value):
+    # Splits a comma separated list of names.  A comma that is part of a name is escaped with a backslash.
+    return [re.sub('[\\\],', ',', x.strip()) for x in re.sub('([^\\\]),', '\g<1>█', value.strip()).split('█')]
+
+
+def combined(lists):
+    # Every value of every list once, in the order they are first seen.
+    return list(dict.fromkeys(x for values in lists for x in values))
+
+
+class Route:
+    # One group of alerts and the rooms they are sent to.  The alerts of every route are found by a single search on
+    # each host, and each route is sent the results that match its own filters.
+    def __init__(self, name, search_name, splunk_app, owners, room_list, custom_message):
+        self.name = name
+        self.search_name = search_name
+        self.splunk_app = splunk_app
+        self.owners = owners
+        self.room_list = room_list
+        self.all_rooms = '*' in room_list
+        self.custom_message = custom_message
+        self.source = AlertSource('search', search_name, splunk_app, owners)
+
+    def matches(self, result):
+        return self.source.matches(result)
+
+    def key(self, sid, room_id):
+        # a sid is recorded for each room and under the name of each route it was sent to, so sending it to one room or
+        # route does not stop it from being sent to another.  Without a routes file the sid is recorded with the room.
+        return (sid if self.name is None else self.name + '/' + sid) + ' ' + room_id
+
+    def rooms(self, room_comm_list):
+        if self.all_rooms:
+            return dict(room_comm_list)
+        return {title: room_id for (title, room_id) in room_comm_list.items() if title.lower() in self.room_list}
+
+
+def load_routes(routes_location, search_name, splunk_app, owners, room_list, custom_message):
+    try:
+        with open(routes_location, encoding='utf-8') as r:
+            if routes_location.lower().endswith(('.yml', '.yaml')):
+                if yaml is None:
+                    log_print('error', 'Add the pyyaml repository to your PYTHONPATH to read yaml route files:\n'
+                                       'python -m pip install pyyaml')
+                    sys.exit()
+                entries = yaml.safe_load(r)
+            else:
+                entries = json.load(r)
+    except Exception as e:
+        log_print('error', 'Routes file read failed with exception:\n' + str(e))
+        sys.exit()
+
+    if not isinstance(entries, list) or len(entries) == 0:
+        log_print('error', 'Routes file must be a non empty list of routes.')
+        sys.exit()
+
+    routes = []
+    for (i, entry) in enumerate(entries):
+        if not isinstance(entry, dict):
+            log_print('error', 'Route ' + str(i + 1) + ' must be a set of fields.')
+            sys.exit()
+        name = str(entry.get('name', 'route ' + str(i + 1))).strip()
+        if name in [route.name for route in routes]:
+            log_print('error', 'More than one route is named "' + name + '".  Route names must be unique.')
+            sys.exit()
+        fields = {}
+        for (field, default, split) in (('search_name', search_name, split_names),
+                                        ('splunk_app', splunk_app, lambda x: x.split(',')),
+                                        ('owners', owners, lambda x: x.split(',')),
+                                        ('room_list', room_list, split_names)):
+            value = entry.get(field)
+            if value is None:
+                value = default
+            elif isinstance(value, list):
+                value = [str(x).strip() for x in value]
+            else:
+                value = [x.strip() for x in split(str(value))]
+            if value is None or len(value) == 0:
+                log_print('error', 'Route "' + name + '" has no ' + field + ' and the ' + field + ' argument was not '
+                                   'provided.')
+                sys.exit()
+            fields[field] = value
+        routes.append(Route(name, fields['search_name'], fields['splunk_app'], fields['owners'],
+                            [x.lower() for x in fields['room_list']],
+                            str(entry.get('custom_message', custom_message)).strip()))
+    log_print('info', 'Routes file read successfully with ' + str(len(routes)) + ' route(s).')
+    return routes
+
+
+def check_route_rooms(routes, room_comm_list):
+    # Rooms were looked up for every route at once, so each named route is checked for its own rooms here.
+    for route in routes:
+        if route.name is None or route.all_rooms:
+            continue
+        found = [title.lower() for title in route.rooms(room_comm_list)]
+        missing = [room for room in route.room_list if room not in found]
+        if len(found) == 0:
+            log_print('error', 'None of the rooms of route "' + route.name + '" were located.')
+            return False
+        if len(missing) > 0:
+            log_print('warn', 'Route "' + route.name + '" will not send to the following rooms that could not be '
+                              'located: ' + ', '.join(missing))
+    return True
+
+
+def create_session(auth=None, headers=None, hosts=1):
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=hosts, pool_maxsize=10))
+    session.auth = auth
+    if headers is not None:
+        session.headers.update(headers)
+    return session
+
+
+class RoomDirectory:
+    # The rooms the WebEx Bot is in, read page by page by following the Link header and indexed by lower case title.
+    # The list is cached in cache_file and used for ttl seconds without calling WebEx.  After that a list that fit on
+    # one page is checked with its ETag, so an unchanged list is not downloaded again.
+    def __init__(self, cache_file, ttl, webex_token):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        # the cache is only used by the bot that wrote it.
+        self.token_hash = hashlib.sha256(webex_token.encode()).hexdigest()
+        self.cache = None
+        self.from_cache = False
+        try:
+            with open(cache_file, encoding='utf-8') as f:
+                cache = json.load(f)
+            if cache.get('token_hash') == self.token_hash:
+                self.cache = cache
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log_print('warn', 'Ignoring room cache ' + cache_file + ' that could not be read:\n' + str(e))
+
+    def load(self, webex, cert_info, revalidate=False):
+        # Returns a dict of lower case title to (title, id), or None if the rooms could not be looked up.
+        if self.cache is not None and not revalidate and time.time() - self.cache['fetched'] < self.ttl:
+            log_print('info', 'Using cached list of rooms from ' + self.cache_file + '.')
+            self.from_cache = True
+            return self.index()
+
+        headers = {}
+        if self.cache is not None and self.cache['pages'] == 1 and self.cache.get('etag') is not None:
+            headers['If-None-Match'] = self.cache['etag']
+        items = []
+        etag = None
+        pages = 0
+        url = WEBEX_API + '/rooms?max=1000&type=group&sortBy=lastactivity'
+        while url is not None:
+            try:
+                r = webex.get(url, headers=headers, verify=cert_info)
+            except requests.exceptions.RequestException as e:
+                log_print('error', 'Call failed with error:\n' + str(e))
+                return self.stale()
+            if r.status_code == 304:
+                log_print('info', 'Cached list of rooms is still current.')
+                self.cache['fetched'] = int(time.time())
+                self.save()
+                self.from_cache = False
+                return self.index()
+            page = api(r)
+            if page is None:
+                return self.stale()
+            if pages == 0:
+                etag = r.headers.get('ETag')
+            items.extend({'title': room['title'], 'id': room['id']} for room in page['items'])
+            pages += 1
+            headers = {}
+            url = r.links.get('next', {}).get('url')
+
+        self.cache = {'token_hash': self.token_hash, 'fetched': int(time.time()), 'etag': etag, 'pages': pages,
+                      'items': items}
+        self.save()
+        self.from_cache = False
+        log_print('info', 'Looked up ' + str(len(items)) + ' room(s) in ' + str(pages) + ' page(s).')
+        return self.index()
+
+    def stale(self):
+        if self.cache is None:
+            return None
+        log_print('warn', 'Unable to look up rooms.  Using the cached list of rooms from ' +
+                  datetime.fromtimestamp(self.cache['fetched']).strftime('%Y-%m-%d %H:%M:%S') + '.')
+        self.from_cache = True
+        return self.index()
+
+    def save(self):
+        # written to a temporary file first so a run that is stopped part way does not leave half a cache.
+        try:
+            with open(self.cache_file + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(self.cache, f)
+            os.replace(self.cache_file + '.tmp', self.cache_file)
+        except Exception as e:
+            log_print('warn', 'Unable to write room cache ' + self.cache_file + ':\n' + str(e))
+
+    def items(self):
+        return self.cache['items']
+
+    def index(self):
+        # rooms are listed by latest activity, so the most active room wins when two titles match.
+        index = {}
+        for room in self.cache['items']:
+            index.setdefault(room['title'].lower(), (room['title'], room['id']))
+        return index
+
+
+def lookup_rooms(webex, cert_info, room_list, all_rooms, directory, revalidate=False):
+    # Returns the rooms to send to by title, or None if they could not be looked up.
     log_print('info', 'Looking up list of rooms associated to WebEx Bot.')
-    room_check = api(requests.get('https://webexapis.com/v1/rooms?max=1000&type=group&sortBy=lastactivity',
-                                  headers={'Authorization': 'Bearer ' + webex_token}, verify=cert_info))
-    if room_check is None or len(room_check['items']) == 0:
+    rooms = directory.load(webex, cert_info, revalidate)
+    if rooms is not None and not all_rooms and not revalidate and directory.from_cache and \
+            any(room not in rooms for room in room_list):
+        # a room the bot was just added to is not in the cache yet.
+        log_print('info', 'Not every room is in the cached list of rooms.  Looking them up again.')
+        rooms = directory.load(webex, cert_info, True)
+    if rooms is None or len(rooms) == 0:
         log_print('warn', 'No data retrieved from WebEx API. Please confirm you have the WebEx Bot in at least 1 group room.')
-        sys.exit()
+        return None
     log_print('info', 'List pulled successfully for WebEx Bot.')
 
-    if args.room_list.strip() == '*':
+    if all_rooms:
         log_print('info', 'Asterisk entered for room list.  Sending to all rooms attached to the WebEx Bot.')
-        for room in room_check['items']:
-            room_comm_list[room['title']] = room['id']
+        return {room['title']: room['id'] for room in directory.items()}
+
+    # Compare room list to provided list
+    log_print('info', 'Comparing provided room names to room names pulled from WebEx API.')
+    room_comm_list = dict(rooms[room] for room in room_list if room in rooms)
+    room_missing_list = [room for room in room_list if room not in rooms]
+
+    if len(room_missing_list) == 0:
+        log_print('info', 'All rooms provided were found.  Proceeding to pull list of searches')
+    elif len(room_comm_list) > 0:
+        log_print('warn', 'Only some of the rooms provided were found.  Sending to rooms that were identified. The '
+                          'following rooms could not be located: ' + ', '.join(room_missing_list))
     else:
-        # Compare room list to provided list
-        log_print('info', 'Comparing provided room names to room names pulled from WebEx API.')
-
-        for room in room_check['items']:
-            if room['title'].lower() in room_list:
-                room_comm_list[room['title']] = room['id']
-            if room['title'].lower() not in room_list:
-                room_missing_list.append(room['title'])
-
-        if len(room_list) == len(room_comm_list) and len(room_comm_list) > 0:
-            log_print('info', 'All rooms provided were found.  Proceeding to pull list of searches')
-        elif 0 < len(room_comm_list) != len(room_list):
-            log_print('warn', 'Only some of the rooms provided were found.  Sending to rooms that were identified. The '
-                              'following rooms could not be located: ' + ', '.join(room_missing_list))
-        elif len(room_comm_list) == 0:
-            log_print('error', 'None of the provided rooms were located.  Please double check that the full name of each '
-                               'room is provided.')
-            sys.exit()
+        log_print('error', 'None of the provided rooms were located.  Please double check that the full name of each '
+                           'room is provided.')
+        return None
+    return room_comm_list
 
-    time_filter = int((datetime.now() - timedelta(minutes=freq_filter)).timestamp())
 
-    # Poll splunk to see if the requested alerts have triggered
-    log_print('info', 'Polling splunk to see if any alerts have triggered.')
-    search = 'search index=_internal sourcetype=scheduler alert_actions!="" savedsearch_name IN ("' + '","'.join(search_name) + '") app IN ("' + '","'.join(splunk_app) + \
-             '") user IN ("' + '","'.join(owners) + \
-             '") | stats max(_time) as _time latest(sid) as sid latest(alert_actions) as alert_actions ' \
-             'by app savedsearch_name user'
-    alerts = {}
+class RoomRefresher(threading.Thread):
+    # Looks the rooms up again every room_refresh seconds in the background.  If a refresh fails the last room list
+    # is kept, so a WebEx outage does not stop alerts from being sent to the rooms that were already known.
+    def __init__(self, webex, cert_info, room_list, all_rooms, directory, room_comm_list, room_refresh):
+        super().__init__(daemon=True)
+        self.webex = webex
+        self.cert_info = cert_info
+        self.room_list = room_list
+        self.all_rooms = all_rooms
+        self.directory = directory
+        self.room_comm_list = room_comm_list
+        self.room_refresh = room_refresh
+        self.lock = threading.Lock()
+
+    def rooms(self):
+        with self.lock:
+            return dict(self.room_comm_list)
+
+    def run(self):
+        while True:
+            time.sleep(self.room_refresh)
+            room_comm_list = lookup_rooms(self.webex, self.cert_info, self.room_list, self.all_rooms, self.directory,
+                                          True)
+            if room_comm_list is None:
+                log_print('warn', 'Room list refresh failed.  Keeping the previous list of rooms.')
+                continue
+            with self.lock:
+                self.room_comm_list = room_comm_list
+
+
+class AlertSource:
+    # Finds the requested alerts that triggered on a search head, as a list of results with the app, savedsearch_name,
+    # user, sid and _time of the latest time each alert triggered.
+    def __init__(self, backend, search_name, splunk_app, owners):
+        self.backend = backend
+        self.search_name = [splunk_pattern(x) for x in search_name]
+        self.splunk_app = [splunk_pattern(x) for x in splunk_app]
+        self.owners = [splunk_pattern(x) for x in owners]
+        self.search = 'search index=_internal sourcetype=scheduler alert_actions!="" savedsearch_name IN ("' + '","'.join(search_name) + '") app IN ("' + '","'.join(splunk_app) + \
+                      '") user IN ("' + '","'.join(owners) + \
+                      '") | stats max(_time) as _time latest(sid) as sid latest(alert_actions) as alert_actions ' \
+                      'by app savedsearch_name user'
+
+    def triggered(self, splunk, cert_info, host, time_filter, search_timeout=None):
+        # Returns None if the alerts could not be looked up.
+        if self.backend == 'fired_alerts':
+            try:
+                results = self.fired_alerts(splunk, cert_info, host, time_filter, search_timeout)
+            except Exception as e:
+                log_print('error', 'Reading fired alerts on ' + host + ' failed with error:\n' + str(e))
+                results = None
+            if results is not None:
+                return results
+            log_print('warn', 'Unable to read fired alerts on ' + host + '.  Searching _internal instead.')
+        return self.scheduler_search(splunk, cert_info, host, time_filter, search_timeout)
+
+    def scheduler_search(self, splunk, cert_info, host, time_filter, search_timeout=None):
+        splunk_results = api(splunk.post(splunkd_url(host) + '/services/search/jobs',
+                                         data={'search': self.search,
+                                               'output_mode': 'json',
+                                               'adhoc_search_level': 'fast',
+                                               'earliest_time': time_filter,
+                                               'latest_time': 'now',
+                                               'exec_mode': 'oneshot'}, verify=cert_info, timeout=search_timeout))
+        if splunk_results is None:
+            return None
+        return splunk_results['results']
+
+    def fired_alerts(self, splunk, cert_info, host, time_filter, search_timeout=None):
+        # Lists every triggered alert instance in every app and filters them the same way the search does: names, apps
+        # and owners match case insensitive with * wildcards, and only the latest trigger of each alert is kept.
+        fired = api(splunk.get(splunkd_url(host) + '/servicesNS/-/-/alerts/fired_alerts/-',
+                               params={'output_mode': 'json', 'count': 0}, verify=cert_info, timeout=search_timeout))
+        if fired is None:
+            return None
+        latest = {}
+        for entry in fired['entry']:
+            content = entry['content']
+            result = {'app': entry['acl']['app'],
+                      'savedsearch_name': content['savedsearch_name'],
+                      'user': entry['acl']['owner'],
+                      'sid': content['sid'],
+                      '_time': int(content['trigger_time'])}
+            if result['_time'] < time_filter or not self.matches(result):
+                continue
+            key = (result['app'], result['savedsearch_name'], result['user'])
+            if key not in latest or latest[key]['_time'] < result['_time']:
+                latest[key] = result
+        return list(latest.values())
+
+    def matches(self, result):
+        return (any(x.fullmatch(result['savedsearch_name'].lower()) for x in self.search_name) and
+                any(x.fullmatch(result['app'].lower()) for x in self.splunk_app) and
+                any(x.fullmatch(result['user'].lower()) for x in self.owners))
+
+
+def split_host(splunk_host):
+    # A search head may name the port of splunkd after a colon, as in sh1.example.com:8090.  Otherwise it is 8089.
+    (host, port) = re.fullmatch('(.*?)(?::([0-9]+))?', splunk_host).groups()
+    return host, int(port or 8089)
+
+
+def splunkd_url(splunk_host):
+    (host, port) = split_host(splunk_host)
+    return 'https://' + host + ':' + str(port)
+
+
+def splunk_pattern(value):
+    # Splunk IN (...) only treats * as a wildcard and ignores case, so [ ] ? and every other character match themselves.
+    return re.compile(re.escape(value.lower()).replace('\\*', '.*'), re.DOTALL)
+
+
+def benchmark_backends(splunk, cert_info, splunk_host, search_name, splunk_app, owners, freq_filter, search_timeout,
+                       benchmark_runs):
+    # Times each backend on its own, so a failed fired alerts read is reported instead of falling back to the search.
+    time_filter = int((datetime.now() - timedelta(minutes=freq_filter)).timestamp())
+    source = AlertSource('search', search_name, splunk_app, owners)
     for host in splunk_host:
-        splunk = api(requests.post('https://' + host + ':8089/services/search/jobs',
-                                   auth=HTTPBasicAuth(splunk_user, splunk_pw),
-                                   data={'search': search,
-                                         'output_mode': 'json',
-                                         'adhoc_search_level': 'fast',
-                                         'earliest_time': time_filter,
-                                         'latest_time': 'now',
-                                         'exec_mode': 'oneshot'}, verify=cert_info))
-
-        if splunk is None:
-            log_print('warn', 'Failed to pull data from splunk.')
-            sys.exit()
-        elif len(splunk['results']) == 0:
-            log_print('info', f'None of the requested alerts have triggered in the past {str(freq_filter)} minutes.')
+        for (backend, lookup) in (('search', source.scheduler_search), ('fired_alerts', source.fired_alerts)):
+            durations = []
+            results = None
+            for run in range(benchmark_runs):
+                start = time.perf_counter()
+                try:
+                    results = lookup(splunk, cert_info, host, time_filter, search_timeout)
+                except Exception as e:
+                    log_print('error', 'Backend ' + backend + ' on ' + host + ' failed with error:\n' + str(e))
+                    results = None
+                if results is None:
+                    break
+                durations.append(time.perf_counter() - start)
+            if results is None:
+                log_print('warn', 'Backend ' + backend + ' on ' + host + ' failed.')
+                continue
+            log_print('info', 'Backend ' + backend + ' on ' + host + ': ' + str(len(results)) + ' alert(s), best of ' +
+                      '{:.3f}'.format(min(durations)) + ' seconds, mean of ' +
+                      '{:.3f}'.format(sum(durations) / len(durations)) + ' seconds over ' + str(len(durations)) +
+                      ' run(s).')
+
+
+def state_scope(routes):
+    # Runs that look for different alerts or send them to different rooms keep their own watermarks and sent alerts,
+    # so cron entries that share a state file do not move each other's watermarks past alerts they have not seen.
+    filters = [[route.name, route.search_name, route.splunk_app, route.owners, route.room_list] for route in routes]
+    return hashlib.sha256(json.dumps(filters).encode('utf-8')).hexdigest()[:16]
+
+
+class AlertState:
+    # Sqlite store of the sids that were sent and, for each host, the time its last successful poll started.  A poll
+    # searches from that watermark instead of a fixed window, so runs that overlap do not send an alert twice and runs
+    # that are late do not miss one.  Every poll runs inside one write transaction, and every row belongs to the scope
+    # of the routes that wrote it.
+    def __init__(self, state_file, timeout, max_lookback, scope):
+        self.state_file = state_file
+        self.max_lookback = max_lookback
+        self.scope = scope
+        try:
+            self.db = sqlite3.connect(state_file, timeout=timeout, isolation_level=None)
+            self.db.execute('CREATE TABLE IF NOT EXISTS sent_alert (scope TEXT, sid TEXT, sent_time INTEGER, '
+                            'PRIMARY KEY (scope, sid))')
+            self.db.execute('CREATE TABLE IF NOT EXISTS host_watermark (scope TEXT, host TEXT, poll_time INTEGER, '
+                            'PRIMARY KEY (scope, host))')
+        except Exception as e:
+            log_print('error', 'Unable to open state file ' + state_file + ':\n' + str(e))
             sys.exit()
-        else:
-            log_print('info', f'Successfully retrieved {str(len(splunk["results"]))} alerts.')
 
-        alerts[host] = {}
+    def begin(self):
+        # Returns False when another run held the state file for longer than the timeout.  The savepoint lets a poll
+        # that failed to deliver put the watermarks back without giving up the file.
+        try:
+            self.db.execute('BEGIN IMMEDIATE')
+        except sqlite3.OperationalError as e:
+            log_print('error', 'State file ' + self.state_file + ' is still in use by another run:\n' + str(e))
+            return False
+        self.db.execute('SAVEPOINT poll')
+        return True
+
+    def commit(self):
+        # sids older than every watermark can not be found by any later poll.
+        self.db.execute('DELETE FROM sent_alert WHERE scope = ? AND sent_time < '
+                        '(SELECT MIN(poll_time) FROM host_watermark WHERE scope = ?) - ?',
+                        (self.scope, self.scope, WATERMARK_OVERLAP))
+        self.db.execute('COMMIT')
+
+    def keep_watermarks(self):
+        self.db.execute('ROLLBACK TO poll')
+
+    def time_filters(self, splunk_host, default, poll_start):
+        # hosts that have never been polled search the last freq_filter minutes, and no host searches further back than
+        # max_lookback minutes however long its alerts have failed to be delivered.
+        watermarks = dict(self.db.execute('SELECT host, poll_time FROM host_watermark WHERE scope = ?', (self.scope,)))
+        time_filters = {}
+        for host in splunk_host:
+            if host not in watermarks:
+                time_filters[host] = default
+            elif watermarks[host] - WATERMARK_OVERLAP < poll_start - self.max_lookback * 60:
+                log_print('warn', 'Watermark of ' + host + ' is older than max_lookback.  Searching the last ' +
+                          str(self.max_lookback) + ' minutes instead.')
+                time_filters[host] = poll_start - self.max_lookback * 60
+            else:
+                time_filters[host] = watermarks[host] - WATERMARK_OVERLAP
+        return time_filters
+
+    def advance(self, host, poll_time):
+        self.db.execute('INSERT INTO host_watermark (scope, host, poll_time) VALUES (?, ?, ?) '
+                        'ON CONFLICT(scope, host) DO UPDATE SET poll_time = excluded.poll_time',
+                        (self.scope, host, poll_time))
+
+    def delivered(self, sid):
+        return self.db.execute('SELECT 1 FROM sent_alert WHERE scope = ? AND sid = ?',
+                               (self.scope, sid)).fetchone() is not None
+
+    def record(self, sids, sent_time):
+        self.db.executemany('INSERT OR IGNORE INTO sent_alert (scope, sid, sent_time) VALUES (?, ?, ?)',
+                            ((self.scope, sid, sent_time) for sid in sids))
 
-        for searches in splunk['results']:
-            alerts[host][searches['savedsearch_name']] = searches['sid']
 
-    # Create messages that will be sent for each alert that triggered.
-    log_print('info', 'Creating messages and validating payload size is not too large.')
+def collect_alerts(host_results, state, poll_start, routes, room_comm_list):
+    # Moves the watermark of every host that answered and returns, for each route, the alerts that match it along with
+    # the sids each of its rooms has not been sent yet.
+    route_alerts = {}
+    for (host, results) in host_results.items():
+        if results is None:
+            continue
+        state.advance(host, poll_start)
+        for searches in results:
+            for route in routes:
+                if not route.matches(searches):
+                    continue
+                rooms = [room_id for room_id in route.rooms(room_comm_list).values()
+                         if not state.delivered(route.key(searches['sid'], room_id))]
+                if len(rooms) == 0:
+                    continue
+                (alerts, room_sids) = route_alerts.setdefault(route, ({}, {}))
+                alerts.setdefault(host, {})[searches['savedsearch_name']] = searches['sid']
+                for room_id in rooms:
+                    room_sids.setdefault(room_id, set()).add(searches['sid'])
+                metrics.triggered(searches['sid'], alert_time(searches.get('_time')))
+    return route_alerts
+
+
+def all_rooms_alerts(route_alerts, room_comm_list):
+    # The sids of every alert for every room of its route, for alerts that no room has been sent yet.
+    return {route: (alerts, {room_id: {sid for searches in alerts.values() for sid in searches.values()}
+                             for room_id in route.rooms(room_comm_list).values()})
+            for (route, alerts) in route_alerts.items()}
+
+
+def count_alerts(route_alerts):
+    return sum(len(searches) for (alerts, room_sids) in route_alerts.values() for searches in alerts.values())
+
+
+def route_keys(route_alerts):
+    return [route.key(sid, room_id) for (route, (alerts, room_sids)) in route_alerts.items()
+            for (room_id, sids) in room_sids.items() for sid in sids]
+
+
+def deliver_routes(webex, cert_info, room_comm_list, route_alerts, bucket):
+    # Sends each room of each route the alerts it has not been sent yet.  Returns the keys of the alerts that were
+    # delivered to each room and the number of routes with a room that could not be delivered to.
+    delivered_keys = []
+    failed = 0
+    for (route, (alerts, room_sids)) in route_alerts.items():
+        # rooms that are missing the same alerts are sent the same messages.
+        groups = {}
+        for (title, room_id) in route.rooms(room_comm_list).items():
+            if room_id in room_sids:
+                groups.setdefault(frozenset(room_sids[room_id]), {})[title] = room_id
+        route_failed = False
+        for (sids, rooms) in groups.items():
+            group_alerts = {host: {name: sid for (name, sid) in searches.items() if sid in sids}
+                            for (host, searches) in alerts.items()}
+            # Create messages that will be sent for each alert that triggered.
+            log_print('info', 'Creating messages for ' + str(sum(len(searches) for searches in group_alerts.values())) +
+                      ' alert(s)' + ('' if route.name is None else ' of route "' + route.name + '"') + '.')
+            messages = pack_messages(build_messages(group_alerts, route.custom_message))
+            delivered = send_messages(webex, cert_info, rooms, messages, bucket)
+            delivered_keys.extend(route.key(sid, room_id) for room_id in delivered.values() for sid in sids)
+            if len(delivered) > 0:
+                metrics.delivered(sids)
+            if len(delivered) < len(rooms):
+                route_failed = True
+        if route_failed:
+            failed += 1
+    return delivered_keys, failed
+
+
+def finish_poll(state, poll_start, delivered_keys, failed):
+    if failed > 0:
+        # the watermarks stay where they were so the rooms that failed find their alerts again, up to max_lookback,
+        # and the alerts that were delivered are recorded so they are not sent to their rooms twice.
+        state.keep_watermarks()
+    state.record(delivered_keys, poll_start)
+    state.commit()
+
+
+def alert_time(value):
+    # _time comes back as epoch seconds from the fired alerts backend and as an iso timestamp from a search.
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return int(datetime.fromisoformat(value).timestamp())
+    except (TypeError, ValueError):
+        return None
+
+
+def poll_hosts(splunk, cert_info, splunk_host, source, time_filters, search_timeout):
+    # Searches every host at once so a poll takes as long as the slowest host instead of all of them added together.
+    # Returns the results of each host, or None for a host that failed or did not answer within search_timeout.
+    def search(host):
+        start = time.monotonic()
+        try:
+            return source.triggered(splunk, cert_info, host, time_filters[host], search_timeout)
+        finally:
+            metrics.observe('splunk_search_seconds', time.monotonic() - start, host=host)
+
+    executor = ThreadPoolExecutor(max_workers=len(splunk_host))
+    futures = {executor.submit(search, host): host for host in splunk_host}
+    # the read timeout only covers the gaps between bytes, so the whole poll is bounded here as well.
+    done, not_done = wait(futures, timeout=search_timeout + 5)
+    executor.shutdown(wait=False)
+
+    host_results = {}
+    for (future, host) in futures.items():
+        if future in not_done:
+            log_print('warn', 'Splunk on ' + host + ' did not answer within ' + str(search_timeout) + ' seconds.  '
+                              'Skipping it.')
+            host_results[host] = None
+            continue
+        try:
+            host_results[host] = future.result()
+        except Exception as e:
+            log_print('error', 'Polling ' + host + ' failed with error:\n' + str(e))
+            host_results[host] = None
+        if host_results[host] is None:
+            log_print('warn', 'Failed to pull data from splunk on ' + host + '.')
+        elif len(host_results[host]) == 0:
+            log_print('info', 'No requested alerts have triggered on ' + host + '.')
+        else:
+            log_print('info', f'Successfully retrieved {str(len(host_results[host]))} alerts from {host}.')
+    return host_results
+
+
+def build_messages(alerts, custom_message):
     messages = []
 
     for (key,value) in alerts.items():
-        hosts = key
+        # the link is to the web interface of the search head, not the splunkd port.
+        hosts = split_host(key)[0]
         for (key,value) in value.items():
             messages.append(f'Alert "{key}" has triggered. Please click this '
-                            f'[link](https://{hosts}/en-US/app/search/search?sid={value}) to see the results. ' +
+                            f'[link](https://{hosts}/en-US/app/search/search?sid={quote(value, safe="")}) to see the results. ' +
                             custom_message)
+    return messages
 
-    if len('\n'.join(messages)) >= 1000:
-        log_print('error', 'Too many alerts are were going to be sent.  Please limit the amount of alerts you select.')
-        sys.exit()
 
-    log_print('info', 'Message payload completed successfully.  Payload is not too large.')
+def pack_messages(lines):
+    # Packs the alert lines, in order, into as few messages as fit under WEBEX_MESSAGE_BYTES.  A line that is too long
+    # on its own is cut short.
+    messages = []
+    message = []
+    message_bytes = 0
+    for line in lines:
+        line = shorten(line, WEBEX_MESSAGE_BYTES)
+        line_bytes = len(line.encode('utf-8'))
+        if len(message) > 0 and message_bytes + 1 + line_bytes > WEBEX_MESSAGE_BYTES:
+            messages.append('\n'.join(message))
+            message = []
+            message_bytes = 0
+        message_bytes += line_bytes + (1 if len(message) > 0 else 0)
+        message.append(line)
+    if len(message) > 0:
+        messages.append('\n'.join(message))
+    if len(messages) > 1:
+        log_print('info', str(len(lines)) + ' alert(s) are too long for one message and will be sent in ' +
+                  str(len(messages)) + ' messages.')
+    return messages
+
 
-    for (key,value) in room_comm_list.items():
-        log_print('info', 'Attempting to send message to room ' + str(key) + ".")
+def shorten(line, limit):
+    # Cuts a line that is longer than limit bytes short without splitting a character.
+    if len(line.encode('utf-8')) <= limit:
+        return line
+    return line.encode('utf-8')[:limit - 3].decode('utf-8', 'ignore') + '...'
 
-        payload = {"markdown": '\n'.join(messages), "roomId": value}
 
-        send_alert = api(requests.post('https://webexapis.com/v1/messages', data=payload,
-                                       headers={'Authorization': 'Bearer ' + webex_token},
-                                       verify=cert_info))
-        if send_alert is None:
-            log_print('warn', 'Attempt to send alert to room "' + str(key) + '" was unsuccessful.')
-        else:
-            log_print('info', 'Attempt was successful.')
+class TokenBucket:
+    # Shared by every thread that sends to WebEx.  A token is taken for each request, tokens come back at rate per
+    # second up to capacity, and a 429 from WebEx holds every request until its Retry-After has passed.
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def take(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait_time)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+def send_messages(webex, cert_info, room_comm_list, messages, bucket):
+    # Sends the messages in order to every room at once and returns the rooms all of them were delivered to.
+    if len(room_comm_list) == 0:
+        return {}
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=min(WEBEX_SEND_WORKERS, len(room_comm_list))) as executor:
+        room_results = list(executor.map(lambda room: send_room(webex, cert_info, room[0], room[1], messages, bucket),
+                                         room_comm_list.items()))
+    delivered = {title: room_id for ((title, room_id), room_metrics) in zip(room_comm_list.items(), room_results)
+                 if room_metrics['delivered']}
+    log_print('info', 'Delivered to ' + str(len(delivered)) + ' of ' + str(len(room_results)) + ' room(s) in ' +
+              '{:.2f}'.format(time.monotonic() - start) + ' seconds with ' +
+              str(sum(room_metrics['attempts'] for room_metrics in room_results)) + ' request(s) and ' +
+              str(sum(room_metrics['throttled'] for room_metrics in room_results)) + ' throttled.')
+    return delivered
+
+
+def send_room(webex, cert_info, key, value, messages, bucket):
+    log_print('info', 'Attempting to send message to room ' + str(key) + ".")
+
+    room_metrics = {'delivered': False, 'attempts': 0, 'throttled': 0}
+    start = time.monotonic()
+
+    for message in messages:
+        # A message that can not be delivered stops the rest, so a room never gets them out of order.
+        room_metrics['delivered'] = post_message(webex, cert_info, key, {"markdown": message, "roomId": value}, bucket,
+                                                 room_metrics)
+        if not room_metrics['delivered']:
+            break
+
+    if room_metrics['delivered']:
+        log_print('info', 'Attempt was successful for room "' + str(key) + '" after ' + str(room_metrics['attempts']) +
+                  ' request(s) in ' + '{:.2f}'.format(time.monotonic() - start) + ' seconds.')
+    else:
+        log_print('warn', 'Attempt to send alert to room "' + str(key) + '" was unsuccessful after ' +
+                  str(room_metrics['attempts']) + ' request(s).')
+    return room_metrics
+
+
+def post_message(webex, cert_info, key, payload, bucket, room_metrics):
+    for attempt in range(WEBEX_RETRIES + 1):
+        bucket.take()
+        room_metrics['attempts'] += 1
+        start = time.monotonic()
+        try:
+            r = webex.post(WEBEX_API + '/messages', data=payload, verify=cert_info)
+        except requests.exceptions.RequestException as e:
+            metrics.observe('webex_request_seconds', time.monotonic() - start)
+            log_print('warn', 'Sending to room "' + str(key) + '" failed with error: ' + str(e))
+            time.sleep(min(2 ** attempt, 30))
+            continue
+        metrics.observe('webex_request_seconds', time.monotonic() - start)
+        if r.status_code == 429:
+            # WebEx says how long to wait.  Every sender waits, not just this one.
+            room_metrics['throttled'] += 1
+            try:
+                retry_after = int(r.headers.get('Retry-After', 60))
+            except ValueError:
+                retry_after = 60
+            log_print('warn', 'WebEx is throttling messages.  Waiting ' + str(retry_after) + ' seconds before '
+                              'sending to room "' + str(key) + '" again.')
+            bucket.pause(retry_after)
+            continue
+        if r.status_code >= 500:
+            log_print('warn', 'Sending to room "' + str(key) + '" failed. Result: ' + str(r.status_code) + ' ' +
+                      str(r.reason) + '  Retrying.')
+            time.sleep(min(2 ** attempt, 30))
+            continue
+        return api(r) is not None
+    return False
+
+
+class AlertDigest:
+    # Holds the alerts for each room and sends them as one digest once the first has waited window seconds, with no
+    # more than budget digests to a room in any hour.  An alert that triggers again while it is held is merged into
+    # the one already held and counted as suppressed, and alerts that do not fit in one message stay held for the
+    # room's next digest.  Every counter counts an alert once for each room it is held for.
+    def __init__(self, window, budget):
+        self.window = window
+        self.budget = budget
+        self.pending = {}
+        self.sent = {}
+        self.counters = {'held': 0, 'suppressed': 0, 'carried': 0, 'over_budget': 0, 'digests': 0}
+
+    def add(self, route_alerts, room_comm_list):
+        now = time.monotonic()
+        for (route, (alerts, room_sids)) in route_alerts.items():
+            for (host, searches) in alerts.items():
+                for (name, sid) in searches.items():
+                    line = build_messages({host: {name: sid}}, route.custom_message)[0]
+                    for (title, room_id) in route.rooms(room_comm_list).items():
+                        if sid not in room_sids.get(room_id, ()):
+                            continue
+                        room = self.pending.setdefault(room_id, {'title': title, 'since': now, 'over_budget': False,
+                                                                 'alerts': {}})
+                        self.counters['held'] += 1
+                        if (host, name) in room['alerts']:
+                            # the link points at the latest run of the alert.
+                            (old_line, count, sids) = room['alerts'][(host, name)]
+                            room['alerts'][(host, name)] = [line, count + 1, sids + [sid]]
+                            self.counters['suppressed'] += 1
+                        else:
+                            room['alerts'][(host, name)] = [line, 1, [sid]]
+
+    def flush(self, webex, cert_info, bucket, force=False):
+        # Sends the digests that are due.  force sends every held alert, so none are lost when the script stops.
+        now = time.monotonic()
+        due = {}
+        removed = False
+        for (room_id, room) in self.pending.items():
+            if not force and now - room['since'] < self.window:
+                continue
+            self.sent[room_id] = [sent for sent in self.sent.get(room_id, []) if now - sent < 3600]
+            if not force and 0 < self.budget <= len(self.sent[room_id]):
+                if not room['over_budget']:
+                    log_print('warn', 'Room "' + room['title'] + '" has used its budget of ' + str(self.budget) +
+                              ' digests this hour.  Holding its alerts for its next digest.')
+                    room['over_budget'] = True
+                    self.counters['over_budget'] += 1
+                continue
+            due[room_id] = (room['title'],) + self.digest(room, now)
+        if len(due) == 0:
+            return
+
+        with ThreadPoolExecutor(max_workers=min(WEBEX_SEND_WORKERS, len(due))) as executor:
+            futures = {room_id: executor.submit(send_room, webex, cert_info, title, room_id, [message], bucket)
+                       for (room_id, (title, message, keys)) in due.items()}
+        for (room_id, future) in futures.items():
+            # a digest that could not be delivered stays held and is tried again with the next flush.
+            if not future.result()['delivered']:
+                continue
+            room = self.pending[room_id]
+            if len(due[room_id][2]) > 0:
+                removed = True
+            metrics.delivered(sid for key in due[room_id][2] for sid in room['alerts'].pop(key)[2])
+            self.sent[room_id].append(now)
+            self.counters['digests'] += 1
+            if len(room['alerts']) == 0:
+                del self.pending[room_id]
+            else:
+                # the alerts that did not fit are already due, so they go in the room's next digest as soon as its
+                # budget allows.
+                room['over_budget'] = False
+                self.counters['carried'] += len(room['alerts'])
+        log_print('info', 'Digest counters: ' + str(self.counters['held']) + ' alert(s) held, ' +
+                  str(self.counters['suppressed']) + ' suppressed as repeats, ' + str(self.counters['carried']) +
+                  ' carried to the next digest, ' + str(self.counters['over_budget']) + ' digest(s) over budget, ' +
+                  str(self.counters['digests']) + ' digest(s) sent.')
+        # a forced flush goes on while its digests still take alerts out, and stops once a digest fails.
+        if force and removed and len(self.pending) > 0:
+            self.flush(webex, cert_info, bucket, True)
+
+    def digest(self, room, now):
+        # Returns the message and the keys of the alerts in it.  A single alert is sent as it always was.
+        lines = [(key, line if count == 1 else line.rstrip() + ' (triggered ' + str(count) + ' times)')
+                 for (key, (line, count, sids)) in room['alerts'].items()]
+        if len(lines) == 1:
+            return pack_messages([lines[0][1]])[0], [lines[0][0]]
+        message = '**' + str(len(lines)) + ' alerts in the last ' + str(int(now - room['since'])) + ' seconds:**'
+        # room is left for the line that says how many follow, and a line too long to fit after the heading is cut
+        # short so every digest carries at least one alert.
+        limit = WEBEX_MESSAGE_BYTES - 100
+        line_limit = limit - len(message.encode('utf-8')) - 1
+        keys = []
+        for (key, line) in lines:
+            line = shorten(line, line_limit)
+            if len(keys) > 0 and len((message + '\n' + line).encode('utf-8')) > limit:
+                break
+            message += '\n' + line
+            keys.append(key)
+        if len(keys) < len(lines):
+            message += '\n' + str(len(lines) - len(keys)) + ' more alert(s) follow in the next digest.'
+        return message, keys
+
+
+def run_daemon(splunk, webex, cert_info, splunk_host, source, freq_filter, routes, rooms, poll_interval,
+               search_timeout, state, bucket, digest):
+    # Every poll searches each host from its watermark and sends the alerts that the state has not seen sent.
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    next_poll = time.monotonic()
+    log_print('info', 'Daemon mode started.  Polling splunk every ' + str(poll_interval) + ' seconds.')
+    try:
+        while not stop.is_set():
+            poll_start = int(time.time())
+            # a poll that can not get the state file from another run is skipped, and the next one searches from
+            # the same watermarks.
+            route_alerts = {}
+            if state.begin():
+                time_filters = state.time_filters(splunk_host, poll_start - freq_filter * 60, poll_start)
+                route_alerts = collect_alerts(poll_hosts(splunk, cert_info, splunk_host, source, time_filters,
+                                                         search_timeout), state, poll_start, routes, rooms.rooms())
+                if len(route_alerts) == 0:
+                    state.commit()
+
+            if len(route_alerts) > 0:
+                log_print('info', f'{str(count_alerts(route_alerts))} new alert(s) have triggered.')
+                if digest is None:
+                    finish_poll(state, poll_start, *deliver_routes(webex, cert_info, rooms.rooms(), route_alerts,
+                                                                    bucket))
+                else:
+                    # held alerts are recorded as sent, so they are not found again while they wait for their digest.
+                    digest.add(route_alerts, rooms.rooms())
+                    state.record(route_keys(route_alerts), poll_start)
+                    state.commit()
+            if digest is not None:
+                digest.flush(webex, cert_info, bucket)
+
+            metrics.export()
+            next_poll += poll_interval
+            if next_poll < time.monotonic():
+                log_print('warn', 'Poll took longer than poll_interval of ' + str(poll_interval) + ' seconds.')
+                next_poll = time.monotonic()
+            stop.wait(next_poll - time.monotonic())
+    except KeyboardInterrupt:
+        pass
+    if digest is not None:
+        digest.flush(webex, cert_info, bucket, True)
+    log_print('info', 'Daemon mode stopped.')
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    # Accepts the JSON body of the splunk webhook alert action, which has the search_name, sid, app, owner and
+    # results_link of the alert that triggered.  Alerts that pass the search_name, splunk_app and owners filters are
+    # queued for the sender, and a full queue is answered with 503.
+    def do_POST(self):
+        url = urlparse(self.path)
+        token = unquote(url.path.strip('/')) or parse_qs(url.query).get('token', [''])[0]
+        if not hmac.compare_digest(token.encode(), self.server.token.encode()):
+            log_print('warn', 'Refusing webhook from ' + self.client_address[0] + ' without the webhook_token.')
+            self.reply(403, 'Forbidden.')
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if length < 0 or length > WEBHOOK_MAX_BYTES:
+            self.reply(413, 'Payload too large.')
+            return
+        try:
+            payload = json.loads(self.rfile.read(length).decode())
+            alert = {'savedsearch_name': str(payload['search_name']), 'sid': str(payload['sid']),
+                     'app': str(payload.get('app', '')), 'user': str(payload.get('owner', ''))}
+            if not SID_PATTERN.fullmatch(alert['sid']):
+                raise ValueError(alert['sid'])
+        except Exception:
+            log_print('warn', 'Ignoring webhook from ' + self.client_address[0] + ' that is not a splunk alert.')
+            self.reply(400, 'Expected a splunk webhook alert action payload.')
+            return
+
+        if not any(route.matches(alert) for route in self.server.routes):
+            log_print('info', 'Ignoring alert "' + alert['savedsearch_name'] + '" that was not requested.')
+            self.reply(200, 'Ignored.')
+            return
+
+        # the link is built for the search head that ran the alert, which is in results_link, as long as it is one of
+        # the splunk_host search heads.
+        host = urlparse(str(payload.get('results_link', ''))).hostname
+        host = self.server.hosts.get(host, self.server.default_host)
+        metrics.triggered(alert['sid'], None)
+        try:
+            self.server.alerts_queue.put_nowait((host, alert, time.monotonic()))
+        except queue.Full:
+            log_print('warn', 'Webhook queue is full.  Refusing alert "' + alert['savedsearch_name'] + '".')
+            self.reply(503, 'Queue is full.')
+            return
+        self.reply(200, 'Queued.')
+
+    def reply(self, status, message):
+        body = message.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(self.client_address[0] + ' ' + format % args)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    # A burst of alerts opens many connections at once, more than the default backlog of 5 holds.
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def run_webhook(webex, cert_info, splunk_host, routes, rooms, webhook_bind, webhook_port, webhook_token, webhook_queue,
+                webhook_cert, bucket, digest):
+    # Alerts that arrive together are sent together, packed into as few messages as fit.
+    alerts_queue = queue.Queue(maxsize=webhook_queue)
+    try:
+        server = WebhookServer((webhook_bind, webhook_port), WebhookHandler)
+        if webhook_cert is not None:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(webhook_cert)
+            server.socket = context.wrap_socket(server.socket, server_side=True)
+    except Exception as e:
+        log_print('error', 'Unable to listen on port ' + str(webhook_port) + ' of ' + (webhook_bind or 'all addresses') +
+                  ':\n' + str(e))
+        sys.exit()
+    server.routes = routes
+    server.alerts_queue = alerts_queue
+    server.token = webhook_token
+    server.hosts = {split_host(host)[0].lower(): host for host in splunk_host}
+    server.default_host = splunk_host[0]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    log_print('info', 'Listening for splunk webhooks on port ' + str(webhook_port) + ' of ' +
+              (webhook_bind or 'all addresses') + '.')
+    try:
+        while not stop.is_set():
+            try:
+                batch = [alerts_queue.get(timeout=1)]
+            except queue.Empty:
+                if digest is not None:
+                    digest.flush(webex, cert_info, bucket)
+                    metrics.export()
+                continue
+            while True:
+                try:
+                    batch.append(alerts_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            route_alerts = {}
+            for (host, alert, received) in batch:
+                for route in routes:
+                    if route.matches(alert):
+                        route_alerts.setdefault(route, {}).setdefault(host, {})[alert['savedsearch_name']] = alert['sid']
+            route_alerts = all_rooms_alerts(route_alerts, rooms.rooms())
+            log_print('info', f'{str(len(batch))} alert(s) received.')
+            if digest is not None:
+                digest.add(route_alerts, rooms.rooms())
+                digest.flush(webex, cert_info, bucket)
+            elif len(deliver_routes(webex, cert_info, rooms.rooms(), route_alerts, bucket)[0]) > 0:
+                log_print('info', 'Alert(s) sent ' + '{:.3f}'.format(time.monotonic() - batch[0][2]) +
+                          ' seconds after the first was received.')
+            metrics.export()
+    except KeyboardInterrupt:
+        pass
+    server.shutdown()
+    if digest is not None:
+        digest.flush(webex, cert_info, bucket, True)
+    server.server_close()
+    log_print('info', 'Webhook receiver stopped.')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,143 @@
+# Copyright 2021 Paychex, Inc.
+# Licensed pursuant to the terms of the Apache License, Version 2.0 (the "License");
+# your use of the Work is subject to the terms and conditions of the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Disclaimer of Warranty. Unless required by applicable law or agreed to in writing, Licensor
+# provides the Work (and each Contributor provides its Contributions) on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied, including,
+# without limitation, any warranties or conditions of TITLE, NON-INFRINGEMENT,
+# MERCHANTABILITY, OR FITNESS FOR A PARTICULAR PURPOSE. You are solely responsible
+# for determining the appropriateness of using or redistributing the Work and assume
+# any risks associated with your exercise of permissions under this License.
+
+# Stand-in for a search head, serving the two ways Splunk2WebExTeams finds triggered alerts from the same list of
+# alert triggers: alerts/fired_alerts/- lists every trigger, and a oneshot search on search/jobs answers the scheduler
+# search with the latest trigger of each alert that matches its IN filters and earliest_time.  search_delay and
+# fired_delay hold each answer back to stand in for a busy search head.  Run it on its own to benchmark the backends:
+#
+# python fake_search_head.py -alerts alerts.json -port 8089 -search_delay 1.5
+# python ../Splunk2WebExTeams.py -splunk_host 127.0.0.1:8089 -cert_location False -benchmark Y ...
+#
+# alerts.json is a list of triggers, each with app, savedsearch_name, user, sid, trigger_time and alert_actions.
+import argparse, json, re, ssl, subprocess, os, tempfile, threading, time, urllib.parse
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+def make_certificate(directory):
+    # Writes a self signed certificate and key for 127.0.0.1 and returns the path of the pem holding both.
+    path = os.path.join(directory, 'fake_search_head.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=127.0.0.1',
+                    '-keyout', path, '-out', path], check=True, capture_output=True)
+    return path
+
+
+def in_filter(search, field):
+    # Splunk IN (...) matches case insensitive with * as the only wildcard.
+    match = re.search(field + r' IN \("(.*?)"\)', search)
+    return [re.compile(re.escape(value.lower()).replace('\\*', '.*'), re.DOTALL) for value in match.group(1).split('","')]
+
+
+class FakeSearchHeadHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self, status, content):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        with self.server.lock:
+            self.server.requests.append(('GET', url.path))
+        if url.path != '/servicesNS/-/-/alerts/fired_alerts/-':
+            self.reply(404, {'messages': [{'type': 'ERROR', 'text': 'Not Found'}]})
+            return
+        time.sleep(self.server.fired_delay)
+        self.reply(200, {'entry': [{'name': alert['savedsearch_name'],
+                                    'acl': {'app': alert['app'], 'owner': alert['user']},
+                                    'content': {'savedsearch_name': alert['savedsearch_name'], 'sid': alert['sid'],
+                                                'trigger_time': alert['trigger_time'], 'severity': 3}}
+                                   for alert in self.server.alerts]})
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        form = urllib.parse.parse_qs(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+        with self.server.lock:
+            self.server.requests.append(('POST', url.path))
+        if url.path != '/services/search/jobs':
+            self.reply(404, {'messages': [{'type': 'ERROR', 'text': 'Not Found'}]})
+            return
+        time.sleep(self.server.search_delay)
+        search = form['search'][0]
+        earliest = int(float(form.get('earliest_time', ['0'])[0]))
+        filters = {field: in_filter(search, field) for field in ('savedsearch_name', 'app', 'user')}
+        latest = {}
+        for alert in self.server.alerts:
+            if alert['trigger_time'] < earliest or alert.get('alert_actions', '') == '':
+                continue
+            if not all(any(x.fullmatch(alert[field].lower()) for x in patterns)
+                       for (field, patterns) in filters.items()):
+                continue
+            key = (alert['app'], alert['savedsearch_name'], alert['user'])
+            if key not in latest or latest[key]['trigger_time'] < alert['trigger_time']:
+                latest[key] = alert
+        # stats returns _time as an iso timestamp, the way splunk renders _time in json results.
+        self.reply(200, {'results': [{'app': alert['app'], 'savedsearch_name': alert['savedsearch_name'],
+                                      'user': alert['user'],
+                                      '_time': datetime.fromtimestamp(alert['trigger_time'], timezone.utc)
+                                      .isoformat(timespec='milliseconds'),
+                                      'sid': alert['sid'], 'alert_actions': alert['alert_actions']}
+                                     for alert in latest.values()]})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeSearchHead(ThreadingHTTPServer):
+    # A search head on https://127.0.0.1, on a free port unless one is given.  host is the -splunk_host that reaches it.
+    daemon_threads = True
+
+    def __init__(self, certificate, alerts, port=0, search_delay=0, fired_delay=0):
+        super().__init__(('127.0.0.1', port), FakeSearchHeadHandler)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certificate)
+        self.socket = context.wrap_socket(self.socket, server_side=True)
+        self.alerts = alerts
+        self.search_delay = search_delay
+        self.fired_delay = fired_delay
+        self.lock = threading.Lock()
+        self.requests = []
+        self.host = '127.0.0.1:' + str(self.server_address[1])
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stand-in for the search head endpoints used by Splunk2WebExTeams.')
+    parser.add_argument('-alerts', required=True, help='Path of a json list of alert triggers.')
+    parser.add_argument('-port', type=int, default=8089)
+    parser.add_argument('-search_delay', type=float, default=0)
+    parser.add_argument('-fired_delay', type=float, default=0)
+    args = parser.parse_args()
+    with open(args.alerts, encoding='utf-8') as f:
+        alerts = json.load(f)
+    with tempfile.TemporaryDirectory() as directory:
+        server = FakeSearchHead(make_certificate(directory), alerts, args.port, args.search_delay, args.fired_delay)
+        print('Listening on https://' + server.host + '.')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,56 @@
+# Copyright 2021 Paychex, Inc.
+# Licensed pursuant to the terms of the Apache License, Version 2.0 (the "License");
+# your use of the Work is subject to the terms and conditions of the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Disclaimer of Warranty. Unless required by applicable law or agreed to in writing, Licensor
+# provides the Work (and each Contributor provides its Contributions) on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied, including,
+# without limitation, any warranties or conditions of TITLE, NON-INFRINGEMENT,
+# MERCHANTABILITY, OR FITNESS FOR A PARTICULAR PURPOSE. You are solely responsible
+# for determining the appropriateness of using or redistributing the Work and assume
+# any risks associated with your exercise of permissions under this License.
+
+# Stand-in for the WebEx session Splunk2WebExTeams sends its messages with, so delivery can be checked without
+# WebEx, and the import of the script itself for tests that call it directly.
+import importlib, json, os, sys, tempfile, threading
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_script():
+    # The script writes its log to the current directory when it is imported, so it is imported from a temporary one.
+    cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp())
+    try:
+        sys.path.insert(0, os.path.dirname(TESTS))
+        return importlib.import_module('Splunk2WebExTeams')
+    finally:
+        os.chdir(cwd)
+
+
+class FakeResponse:
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.reason = 'OK' if status_code < 300 else 'Bad Request'
+        self.url = 'https://webexapis.com/v1/messages'
+        self.content = json.dumps(content).encode('utf-8')
+        self.text = self.content.decode('utf-8')
+
+
+class FakeWebex:
+    # Records each message as (room id, markdown).  A message to a room in failing is refused with a 400, which the
+    # script does not retry.
+    def __init__(self):
+        self.messages = []
+        self.failing = set()
+        self.lock = threading.Lock()
+
+    def post(self, url, data=None, verify=None):
+        if data['roomId'] in self.failing:
+            return FakeResponse(400, {'message': 'Refused by the fake.'})
+        with self.lock:
+            self.messages.append((data['roomId'], data['markdown']))
+        return FakeResponse(200, {'id': str(len(self.messages))})
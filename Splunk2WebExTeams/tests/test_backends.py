@@ -0,0 +1,107 @@
+# Copyright 2021 Paychex, Inc.
+# Licensed pursuant to the terms of the Apache License, Version 2.0 (the "License");
+# your use of the Work is subject to the terms and conditions of the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Disclaimer of Warranty. Unless required by applicable law or agreed to in writing, Licensor
+# provides the Work (and each Contributor provides its Contributions) on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied, including,
+# without limitation, any warranties or conditions of TITLE, NON-INFRINGEMENT,
+# MERCHANTABILITY, OR FITNESS FOR A PARTICULAR PURPOSE. You are solely responsible
+# for determining the appropriateness of using or redistributing the Work and assume
+# any risks associated with your exercise of permissions under this License.
+
+# Checks that the search and fired_alerts backends find the same alerts in the same shape, against the fake search
+# head, and that -benchmark Y times both of them.
+import importlib, os, shutil, subprocess, sys, tempfile, time, unittest
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(os.path.dirname(TESTS), 'Splunk2WebExTeams.py')
+sys.path.insert(0, TESTS)
+from fake_search_head import FakeSearchHead, make_certificate
+
+NOW = int(time.time())
+ALERTS = [
+    {'app': 'search', 'savedsearch_name': 'Disk full', 'user': 'admin', 'sid': 'scheduler__admin__search__RMD5_at_1',
+     'trigger_time': NOW - 240, 'alert_actions': 'webhook'},
+    {'app': 'search', 'savedsearch_name': 'Disk full', 'user': 'admin', 'sid': 'scheduler__admin__search__RMD5_at_2',
+     'trigger_time': NOW - 60, 'alert_actions': 'webhook'},
+    {'app': 'ops', 'savedsearch_name': 'Disk errors [prod]', 'user': 'svc_ops', 'sid': 'scheduler__svc_ops__ops__at_3',
+     'trigger_time': NOW - 120, 'alert_actions': 'email'},
+    {'app': 'ops', 'savedsearch_name': 'Login failures', 'user': 'svc_ops', 'sid': 'scheduler__svc_ops__ops__at_4',
+     'trigger_time': NOW - 30, 'alert_actions': 'email'},
+    {'app': 'ops', 'savedsearch_name': 'Login failures', 'user': 'svc_ops', 'sid': 'scheduler__svc_ops__ops__at_5',
+     'trigger_time': NOW - 7200, 'alert_actions': 'email'},
+    {'app': 'search', 'savedsearch_name': 'a?b', 'user': 'admin', 'sid': 'scheduler__admin__search__at_6',
+     'trigger_time': NOW - 90, 'alert_actions': 'email'},
+]
+
+
+@unittest.skipIf(shutil.which('openssl') is None, 'openssl is needed to make the certificate of the fake search head.')
+class BackendTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.server = FakeSearchHead(make_certificate(cls.directory), ALERTS).start()
+        # the script writes its log to the current directory when it is imported.
+        cwd = os.getcwd()
+        os.chdir(cls.directory)
+        try:
+            sys.path.insert(0, os.path.dirname(SCRIPT))
+            cls.script = importlib.import_module('Splunk2WebExTeams')
+        finally:
+            os.chdir(cwd)
+        cls.splunk = cls.script.create_session()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        shutil.rmtree(cls.directory)
+
+    def backends(self, search_name, splunk_app, owners, time_filter):
+        source = self.script.AlertSource('search', search_name, splunk_app, owners)
+        found = {}
+        for (backend, lookup) in (('search', source.scheduler_search), ('fired_alerts', source.fired_alerts)):
+            results = lookup(self.splunk, False, self.server.host, time_filter, 10)
+            for result in results:
+                self.assertTrue({'app', 'savedsearch_name', 'user', 'sid', '_time'} <= set(result), result)
+            found[backend] = sorted((result['app'], result['savedsearch_name'], result['user'], result['sid'],
+                                     self.script.alert_time(result['_time'])) for result in results)
+        return found
+
+    def test_same_alerts_with_wildcards(self):
+        found = self.backends(['*'], ['*'], ['*'], NOW - 3600)
+        self.assertEqual(found['search'], found['fired_alerts'])
+        # only the latest trigger of each alert inside the time filter is returned.
+        self.assertEqual([sid for (app, name, user, sid, trigger_time) in found['search']],
+                         ['scheduler__svc_ops__ops__at_3', 'scheduler__svc_ops__ops__at_4',
+                          'scheduler__admin__search__RMD5_at_2', 'scheduler__admin__search__at_6'])
+        self.assertIn(('search', 'Disk full', 'admin', 'scheduler__admin__search__RMD5_at_2', NOW - 60),
+                      found['fired_alerts'])
+
+    def test_same_alerts_with_filters(self):
+        found = self.backends(['disk*', 'A?B'], ['SEARCH', 'ops'], ['admin', 'svc_*'], NOW - 3600)
+        self.assertEqual(found['search'], found['fired_alerts'])
+        self.assertEqual([name for (app, name, user, sid, trigger_time) in found['search']],
+                         ['Disk errors [prod]', 'Disk full', 'a?b'])
+
+    def test_same_alerts_with_time_filter(self):
+        found = self.backends(['*'], ['*'], ['*'], NOW - 100)
+        self.assertEqual(found['search'], found['fired_alerts'])
+        self.assertEqual(len(found['search']), 3)
+
+    def test_benchmark_times_both_backends(self):
+        result = subprocess.run([sys.executable, SCRIPT, '-splunk_host', self.server.host, '-user', 'admin', '-pw', 'x',
+                                 '-splunk_app', '*', '-owners', '*', '-search_name', '*', '-room_list', '*',
+                                 '-webex_token', 'x', '-cert_location', 'False', '-freq_filter', '60',
+                                 '-benchmark', 'Y', '-benchmark_runs', '2'],
+                                cwd=self.directory, capture_output=True, text=True, timeout=60)
+        self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+        self.assertIn('Backend search on ' + self.server.host + ': 4 alert(s)', result.stdout)
+        self.assertIn('Backend fired_alerts on ' + self.server.host + ': 4 alert(s)', result.stdout)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+# Copyright 2021 Paychex, Inc.
+# Licensed pursuant to the terms of the Apache License, Version 2.0 (the "License");
+# your use of the Work is subject to the terms and conditions of the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Disclaimer of Warranty. Unless required by applicable law or agreed to in writing, Licensor
+# provides the Work (and each Contributor provides its Contributions) on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied, including,
+# without limitation, any warranties or conditions of TITLE, NON-INFRINGEMENT,
+# MERCHANTABILITY, OR FITNESS FOR A PARTICULAR PURPOSE. You are solely responsible
+# for determining the appropriateness of using or redistributing the Work and assume
+# any risks associated with your exercise of permissions under this License.
+
+# Checks that an alert is recorded as sent for each room it reached, so a room that could not be sent to gets it on
+# the next poll and the rooms that did are not sent it twice.
+import os, shutil, sys, tempfile, time, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_webex import FakeWebex, load_script
+
+script = load_script()
+NOW = int(time.time())
+ROOMS = {'Ops': 'room-ops', 'Db': 'room-db'}
+RESULTS = {'sh1': [{'app': 'search', 'savedsearch_name': 'Disk full', 'user': 'admin', 'sid': 'sid_1', '_time': NOW}]}
+
+
+class DeliveryTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.routes = [script.Route(None, ['*'], ['*'], ['*'], ['*'], '')]
+        self.state = script.AlertState(os.path.join(directory, 'WebExBot.state'), 1, 60,
+                                       script.state_scope(self.routes))
+        self.addCleanup(self.state.db.close)
+        self.webex = FakeWebex()
+        self.bucket = script.TokenBucket(1000, 1000)
+
+    def poll(self, poll_start):
+        self.assertTrue(self.state.begin())
+        route_alerts = script.collect_alerts(RESULTS, self.state, poll_start, self.routes, ROOMS)
+        if len(route_alerts) == 0:
+            self.state.commit()
+            return 0
+        (delivered_keys, failed) = script.deliver_routes(self.webex, False, ROOMS, route_alerts, self.bucket)
+        script.finish_poll(self.state, poll_start, delivered_keys, failed)
+        return failed
+
+    def test_failed_room_is_sent_the_alert_next_poll(self):
+        self.webex.failing.add('room-db')
+        self.assertEqual(self.poll(NOW), 1)
+        self.assertEqual([room for (room, message) in self.webex.messages], ['room-ops'])
+
+        self.webex.failing.clear()
+        self.assertEqual(self.poll(NOW + 60), 0)
+        self.assertEqual([room for (room, message) in self.webex.messages], ['room-ops', 'room-db'])
+
+        # every room has it now.
+        self.assertEqual(self.poll(NOW + 120), 0)
+        self.assertEqual(len(self.webex.messages), 2)
+
+    def test_rooms_missing_the_same_alerts_share_messages(self):
+        self.assertEqual(self.poll(NOW), 0)
+        self.assertEqual(sorted(room for (room, message) in self.webex.messages), ['room-db', 'room-ops'])
+        self.assertEqual(len(set(message for (room, message) in self.webex.messages)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
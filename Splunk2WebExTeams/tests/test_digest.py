@@ -0,0 +1,110 @@
+# Copyright 2021 Paychex, Inc.
+# Licensed pursuant to the terms of the Apache License, Version 2.0 (the "License");
+# your use of the Work is subject to the terms and conditions of the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Disclaimer of Warranty. Unless required by applicable law or agreed to in writing, Licensor
+# provides the Work (and each Contributor provides its Contributions) on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied, including,
+# without limitation, any warranties or conditions of TITLE, NON-INFRINGEMENT,
+# MERCHANTABILITY, OR FITNESS FOR A PARTICULAR PURPOSE. You are solely responsible
+# for determining the appropriateness of using or redistributing the Work and assume
+# any risks associated with your exercise of permissions under this License.
+
+# Checks the digest window, the budget of each room and how alerts that do not fit in one digest are carried, with
+# the messages sent to a fake WebEx session.
+import os, sys, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_webex import FakeWebex, load_script
+
+script = load_script()
+ROOMS = {'Ops': 'room-ops', 'Db': 'room-db'}
+OPS = {'Ops': 'room-ops'}
+
+
+def route_alerts(route, names, rooms, host='sh1'):
+    sids = ['scheduler__admin__search__at_' + str(i) for i in range(len(names))]
+    return script.all_rooms_alerts({route: {host: dict(zip(names, sids))}}, rooms)
+
+
+class DigestTest(unittest.TestCase):
+    def setUp(self):
+        self.webex = FakeWebex()
+        self.bucket = script.TokenBucket(1000, 1000)
+        self.route = script.Route(None, ['*'], ['*'], ['*'], ['*'], 'Check it.')
+
+    def flush(self, digest, force=False):
+        digest.flush(self.webex, False, self.bucket, force)
+        return self.webex.messages
+
+    def test_nothing_is_sent_inside_the_window(self):
+        digest = script.AlertDigest(3600, 0)
+        digest.add(route_alerts(self.route, ['Disk full', 'Login failures'], ROOMS), ROOMS)
+        self.assertEqual(self.flush(digest), [])
+        self.assertEqual(len(self.flush(digest, force=True)), 2)
+
+    def test_alerts_are_sent_as_one_digest_per_room(self):
+        digest = script.AlertDigest(0, 0)
+        digest.add(route_alerts(self.route, ['Disk full', 'Login failures'], ROOMS), ROOMS)
+        digest.add(route_alerts(self.route, ['Disk full'], ROOMS), ROOMS)
+        messages = self.flush(digest)
+        self.assertEqual(sorted(room for (room, message) in messages), ['room-db', 'room-ops'])
+        for (room, message) in messages:
+            self.assertTrue(message.startswith('**2 alerts in the last '), message)
+            self.assertIn('Alert "Disk full" has triggered.', message)
+            self.assertIn('(triggered 2 times)', message)
+        self.assertEqual(digest.pending, {})
+        self.assertEqual(digest.counters['held'], 6)
+        self.assertEqual(digest.counters['suppressed'], 2)
+        self.assertEqual(digest.counters['digests'], 2)
+
+    def test_budget_holds_alerts_for_the_next_digest(self):
+        digest = script.AlertDigest(0, 1)
+        digest.add(route_alerts(self.route, ['Disk full'], OPS), OPS)
+        self.assertEqual(len(self.flush(digest)), 1)
+        digest.add(route_alerts(self.route, ['Login failures'], OPS), OPS)
+        self.assertEqual(len(self.flush(digest)), 1)
+        self.assertEqual(digest.counters['over_budget'], 1)
+        self.assertIn('room-ops', digest.pending)
+        # a forced flush sends the held alerts whatever the budget.
+        self.assertEqual(len(self.flush(digest, force=True)), 2)
+        self.assertEqual(digest.pending, {})
+
+    def test_alerts_that_do_not_fit_are_carried(self):
+        route = script.Route(None, ['*'], ['*'], ['*'], ['*'], 'x' * 3000)
+        digest = script.AlertDigest(0, 0)
+        digest.add(route_alerts(route, ['Alert ' + str(i) for i in range(5)], OPS), OPS)
+        messages = self.flush(digest)
+        self.assertEqual(len(messages), 1)
+        self.assertIn('3 more alert(s) follow in the next digest.', messages[0][1])
+        self.assertEqual(digest.counters['carried'], 3)
+        messages = self.flush(digest, force=True)
+        self.assertEqual(sum(message.count('has triggered.') for (room, message) in messages), 5)
+        self.assertEqual(digest.pending, {})
+
+    def test_oversized_lines_are_cut_short(self):
+        route = script.Route(None, ['*'], ['*'], ['*'], ['*'], 'x' * 6900)
+        digest = script.AlertDigest(0, 0)
+        digest.add(route_alerts(route, ['Disk full', 'Login failures', 'CPU high'], OPS), OPS)
+        messages = self.flush(digest, force=True)
+        # every digest carries one alert, cut short to fit, until none are left.
+        self.assertEqual(len(messages), 3)
+        for (room, message) in messages:
+            self.assertEqual(message.count('has triggered.'), 1)
+            self.assertLessEqual(len(message.encode('utf-8')), script.WEBEX_MESSAGE_BYTES)
+            self.assertTrue([line for line in message.split('\n') if 'has triggered.' in line][0].endswith('...'))
+        self.assertEqual(digest.pending, {})
+
+    def test_forced_flush_stops_when_a_room_fails(self):
+        self.webex.failing.add('room-ops')
+        digest = script.AlertDigest(0, 0)
+        digest.add(route_alerts(self.route, ['Disk full', 'Login failures'], OPS), OPS)
+        self.assertEqual(self.flush(digest, force=True), [])
+        self.assertEqual(len(digest.pending['room-ops']['alerts']), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+# Copyright 2021 Paychex, Inc.
+# Licensed pursuant to the terms of the Apache License, Version 2.0 (the "License");
+# your use of the Work is subject to the terms and conditions of the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Disclaimer of Warranty. Unless required by applicable law or agreed to in writing, Licensor
+# provides the Work (and each Contributor provides its Contributions) on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied, including,
+# without limitation, any warranties or conditions of TITLE, NON-INFRINGEMENT,
+# MERCHANTABILITY, OR FITNESS FOR A PARTICULAR PURPOSE. You are solely responsible
+# for determining the appropriateness of using or redistributing the Work and assume
+# any risks associated with your exercise of permissions under this License.
+
+# Checks that alert lines are packed in order into messages under the WebEx byte limit, and that a room is not sent
+# the rest of its messages once one fails.
+import os, sys, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_webex import FakeWebex, load_script
+
+script = load_script()
+
+
+class PackMessagesTest(unittest.TestCase):
+    def test_short_lines_share_one_message(self):
+        lines = ['Alert ' + str(i) + ' has triggered.' for i in range(10)]
+        self.assertEqual(script.pack_messages(lines), ['\n'.join(lines)])
+
+    def test_lines_are_split_in_order_under_the_limit(self):
+        lines = [str(i) + ' ' + 'x' * 995 for i in range(30)]
+        messages = script.pack_messages(lines)
+        self.assertGreater(len(messages), 1)
+        for message in messages:
+            self.assertLessEqual(len(message.encode('utf-8')), script.WEBEX_MESSAGE_BYTES)
+        # every line is sent once, whole and in order.
+        self.assertEqual('\n'.join(messages).split('\n'), lines)
+
+    def test_limit_is_counted_in_bytes(self):
+        # each line is 3000 characters but 6000 bytes, so two can not share a message.
+        lines = ['é' * 3000, 'ü' * 3000]
+        self.assertEqual(script.pack_messages(lines), lines)
+
+    def test_line_exactly_at_the_limit_is_kept_whole(self):
+        line = 'x' * script.WEBEX_MESSAGE_BYTES
+        self.assertEqual(script.pack_messages([line, 'next']), [line, 'next'])
+
+    def test_oversized_line_is_cut_short(self):
+        messages = script.pack_messages(['é' * script.WEBEX_MESSAGE_BYTES, 'next'])
+        self.assertEqual(len(messages), 2)
+        self.assertLessEqual(len(messages[0].encode('utf-8')), script.WEBEX_MESSAGE_BYTES)
+        # the cut does not split a character in two.
+        self.assertTrue(messages[0].endswith('é...'))
+        self.assertEqual(messages[1], 'next')
+
+    def test_no_lines_no_messages(self):
+        self.assertEqual(script.pack_messages([]), [])
+
+
+class SendRoomTest(unittest.TestCase):
+    def test_failed_message_stops_the_rest(self):
+        webex = FakeWebex()
+        webex.failing.add('room-ops')
+        bucket = script.TokenBucket(1000, 1000)
+        room_metrics = script.send_room(webex, False, 'Ops', 'room-ops', ['first', 'second'], bucket)
+        self.assertFalse(room_metrics['delivered'])
+        self.assertEqual(room_metrics['attempts'], 1)
+
+    def test_messages_are_sent_in_order(self):
+        webex = FakeWebex()
+        bucket = script.TokenBucket(1000, 1000)
+        room_metrics = script.send_room(webex, False, 'Ops', 'room-ops', ['first', 'second', 'third'], bucket)
+        self.assertTrue(room_metrics['delivered'])
+        self.assertEqual(webex.messages, [('room-ops', 'first'), ('room-ops', 'second'), ('room-ops', 'third')])
+
+
+if __name__ == '__main__':
+    unittest.main()
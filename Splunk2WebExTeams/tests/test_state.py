@@ -0,0 +1,105 @@
+# Copyright 2021 Paychex, Inc.
+# Licensed pursuant to the terms of the Apache License, Version 2.0 (the "License");
+# your use of the Work is subject to the terms and conditions of the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Disclaimer of Warranty. Unless required by applicable law or agreed to in writing, Licensor
+# provides the Work (and each Contributor provides its Contributions) on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied, including,
+# without limitation, any warranties or conditions of TITLE, NON-INFRINGEMENT,
+# MERCHANTABILITY, OR FITNESS FOR A PARTICULAR PURPOSE. You are solely responsible
+# for determining the appropriateness of using or redistributing the Work and assume
+# any risks associated with your exercise of permissions under this License.
+
+# Checks the watermarks and sent alerts kept in the state file, the savepoint that puts the watermarks back after a
+# failed delivery, and that runs with different filters sharing one state file keep out of each other's way.
+import os, shutil, sys, tempfile, time, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_webex import load_script
+
+script = load_script()
+NOW = int(time.time())
+
+
+def scope(search_name, room_list=('ops',)):
+    return script.state_scope([script.Route(None, search_name, ['*'], ['*'], list(room_list), '')])
+
+
+class StateTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.state_file = os.path.join(self.directory, 'WebExBot.state')
+
+    def state(self, search_name=('*',), timeout=1, max_lookback=60):
+        state = script.AlertState(self.state_file, timeout, max_lookback, scope(list(search_name)))
+        self.addCleanup(state.db.close)
+        return state
+
+    def poll(self, state, poll_start, sids, failed=0):
+        self.assertTrue(state.begin())
+        state.advance('sh1', poll_start)
+        script.finish_poll(state, poll_start, sids, failed)
+
+    def test_unpolled_host_searches_the_default_window(self):
+        state = self.state()
+        self.assertTrue(state.begin())
+        self.assertEqual(state.time_filters(['sh1'], NOW - 600, NOW), {'sh1': NOW - 600})
+        state.commit()
+
+    def test_watermark_moves_to_the_poll_start(self):
+        state = self.state()
+        self.poll(state, NOW - 300, ['sid_1'])
+        self.assertTrue(state.begin())
+        self.assertEqual(state.time_filters(['sh1', 'sh2'], NOW - 600, NOW),
+                         {'sh1': NOW - 300 - script.WATERMARK_OVERLAP, 'sh2': NOW - 600})
+        self.assertTrue(state.delivered('sid_1'))
+        self.assertFalse(state.delivered('sid_2'))
+        state.commit()
+
+    def test_failed_delivery_keeps_the_watermark(self):
+        state = self.state()
+        self.poll(state, NOW - 300, [])
+        # one route failed, so the watermark stays, but what was delivered is still recorded.
+        self.poll(state, NOW, ['sid_1'], failed=1)
+        self.assertTrue(state.begin())
+        self.assertEqual(state.time_filters(['sh1'], NOW - 600, NOW), {'sh1': NOW - 300 - script.WATERMARK_OVERLAP})
+        self.assertTrue(state.delivered('sid_1'))
+        state.commit()
+
+    def test_lookback_is_capped(self):
+        state = self.state(max_lookback=10)
+        self.poll(state, NOW - 7200, [])
+        self.assertTrue(state.begin())
+        self.assertEqual(state.time_filters(['sh1'], NOW - 600, NOW), {'sh1': NOW - 600})
+        state.commit()
+
+    def test_filters_keep_their_own_watermarks(self):
+        team_a = self.state(['disk*'])
+        team_b = self.state(['login*'])
+        self.poll(team_a, NOW, ['sid_1'])
+        self.assertTrue(team_b.begin())
+        self.assertEqual(team_b.time_filters(['sh1'], NOW - 600, NOW), {'sh1': NOW - 600})
+        self.assertFalse(team_b.delivered('sid_1'))
+        team_b.commit()
+
+    def test_scope_follows_filters_and_rooms(self):
+        self.assertEqual(scope(['disk*']), scope(['disk*']))
+        self.assertNotEqual(scope(['disk*']), scope(['login*']))
+        self.assertNotEqual(scope(['disk*'], ['ops']), scope(['disk*'], ['db']))
+
+    def test_busy_state_file_is_reported(self):
+        first = self.state()
+        second = self.state(timeout=0.1)
+        self.assertTrue(first.begin())
+        self.assertFalse(second.begin())
+        first.commit()
+        self.assertTrue(second.begin())
+        second.commit()
+
+
+if __name__ == '__main__':
+    unittest.main()